@@ -4,9 +4,34 @@ from datetime import datetime
 import pytz # type: ignore # Necesario para zonas horarias
 from typing import Optional
 import random # Para simular clima variable (¡REEMPLAZAR CON API REAL!)
+from functools import lru_cache
 
 # --- Funciones de Herramientas ---
 
+@lru_cache(maxsize=1024)
+def _resolve_timezone_name(location: str) -> str:
+    """
+    Resuelve una ubicación (ID de zona IANA o nombre de ciudad) a un nombre de zona horaria.
+    La resolución es pura (no depende de la hora actual), así que se memoiza: la búsqueda
+    lineal en pytz.common_timezones solo se hace una vez por ubicación.
+    """
+    # Intenta encontrar una zona horaria que coincida (esto es básico,
+    # una implementación real podría usar geolocalización o una búsqueda más robusta)
+    try:
+        pytz.timezone(location) # Asumir que es un ID de zona válido primero
+        return location
+    except pytz.UnknownTimeZoneError:
+        pass
+    # Si no es un ID válido, buscar en las zonas comunes (simplificado)
+    for tz_name in pytz.common_timezones:
+        if location.lower() in tz_name.lower().replace('_', ' '):
+            print(f"Zona horaria encontrada para '{location}': {tz_name}")
+            return tz_name
+    # Si no se encuentra, devolver UTC e indicar el problema
+    print(f"Advertencia: No se encontró zona horaria para '{location}'. Devolviendo UTC.")
+    return "UTC"
+
+
 def get_current_datetime(location: Optional[str] = None) -> str:
     """
     Obtiene la fecha y hora actual. Si se proporciona una ubicación (como nombre de ciudad o
@@ -15,26 +40,7 @@ def get_current_datetime(location: Optional[str] = None) -> str:
     """
     try:
         if location:
-            # Intenta encontrar una zona horaria que coincida (esto es básico,
-            # una implementación real podría usar geolocalización o una búsqueda más robusta)
-            target_tz_str = location # Asumir que es un ID de zona válido primero
-            try:
-                target_tz = pytz.timezone(target_tz_str)
-            except pytz.UnknownTimeZoneError:
-                # Si no es un ID válido, buscar en las zonas comunes (simplificado)
-                found_tz = None
-                for tz_name in pytz.common_timezones:
-                    if location.lower() in tz_name.lower().replace('_', ' '):
-                        found_tz = tz_name
-                        break
-                if found_tz:
-                    target_tz = pytz.timezone(found_tz)
-                    print(f"Zona horaria encontrada para '{location}': {found_tz}")
-                else:
-                    # Si no se encuentra, devolver UTC e indicar el problema
-                    print(f"Advertencia: No se encontró zona horaria para '{location}'. Devolviendo UTC.")
-                    target_tz = pytz.utc
-
+            target_tz = pytz.timezone(_resolve_timezone_name(location))
             now = datetime.now(target_tz)
         else:
             # Si no hay ubicación, usar UTC
@@ -209,4 +215,17 @@ TOOL_NAME_TO_FUNCTION_MAP = {
     "get_current_datetime": get_current_datetime,
     "get_current_weather": get_current_weather,
     "simple_calculator": simple_calculator,
-}
\ No newline at end of file
+}
+
+# --- Políticas de Caché de Resultados por Herramienta ---
+# "pure": el resultado solo depende de los argumentos, se cachea sin caducidad.
+# "ttl": el resultado es estable durante un tiempo (segundos).
+# "never": el resultado depende del momento de la llamada, no se cachea.
+# Las herramientas sin política declarada se tratan como "never".
+
+TOOL_CACHE_POLICIES = {
+    "simple_calculator": {"mode": "pure"},
+    "get_current_weather": {"mode": "ttl", "ttl_seconds": 600},
+    # La hora cambia en cada llamada; lo estable (la resolución de zona horaria) ya se memoiza arriba.
+    "get_current_datetime": {"mode": "never"},
+}
@@ -0,0 +1,135 @@
+# backend/agent_tools/tool_cache.py
+# Memoización determinista de resultados de herramientas.
+# La clave es (nombre de herramienta, argumentos en JSON canónico) y la política
+# (pure / ttl / never) se declara por herramienta en TOOL_CACHE_POLICIES.
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+from .available_tools import TOOL_CACHE_POLICIES
+
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "4096"))
+
+
+def canonical_args(args: Dict[str, Any]) -> str:
+    """JSON canónico: mismas claves y valores producen siempre la misma cadena, sin importar el orden."""
+    return json.dumps(args, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+class _InFlight:
+    """Ejecución en curso de una herramienta y cuántas llamadas esperan su resultado."""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class ToolResultCache:
+    """
+    Caché LRU acotada de resultados de herramientas. Las llamadas concurrentes con la misma
+    clave se agrupan: la herramienta se ejecuta una sola vez en su propia tarea y todas las
+    llamadas esperan su resultado. Cancelar una llamada (plazo, desconexión) no afecta a las
+    demás; la ejecución solo se cancela cuando ya no la espera nadie.
+    """
+
+    def __init__(self, policies: Dict[str, Dict[str, Any]], max_entries: int):
+        self.policies = policies
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict() # clave -> (resultado, expira_en)
+        self._in_flight: Dict[Tuple[str, str], _InFlight] = {}
+        self._metrics: Dict[str, Dict[str, int]] = {}
+
+    def _policy(self, tool_name: str) -> Dict[str, Any]:
+        return self.policies.get(tool_name, {"mode": "never"})
+
+    def _count(self, tool_name: str, metric: str) -> None:
+        metrics = self._metrics.setdefault(tool_name, {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0})
+        metrics[metric] += 1
+
+    def _get(self, key: Tuple[str, str]):
+        cached = self._entries.get(key)
+        if cached is None:
+            return None
+        result, expires_at = cached
+        if expires_at and time.monotonic() > expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def _put(self, key: Tuple[str, str], result: str, policy: Dict[str, Any]) -> None:
+        if policy["mode"] == "never" or self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + policy["ttl_seconds"] if policy["mode"] == "ttl" else 0.0
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def call(self, tool_name: str, function_to_call: Callable[..., str], function_args: Dict[str, Any]) -> str:
+        policy = self._policy(tool_name)
+        key = (tool_name, canonical_args(function_args))
+
+        cached = self._get(key)
+        if cached is not None:
+            self._count(tool_name, "hits")
+            print(f"      Resultado de '{tool_name}' servido desde la caché de herramientas.")
+            return cached
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            self._count(tool_name, "misses")
+            in_flight = _InFlight(asyncio.ensure_future(self._execute(key, tool_name, function_to_call, function_args, policy)))
+            self._in_flight[key] = in_flight
+        else:
+            self._count(tool_name, "coalesced")
+
+        in_flight.waiters += 1
+        try:
+            # shield: cancelar esta llamada no cancela la tarea que comparten las demás
+            return await asyncio.shield(in_flight.task)
+        finally:
+            in_flight.waiters -= 1
+            if in_flight.waiters == 0 and not in_flight.task.done():
+                # Era la última llamada esperando: abandonar la ejecución (no se cachea). Se quita ya
+                # del mapa para que una llamada nueva no se una a una tarea que se está cancelando.
+                in_flight.task.cancel()
+                if self._in_flight.get(key) is in_flight:
+                    del self._in_flight[key]
+
+    async def _execute(self, key: Tuple[str, str], tool_name: str, function_to_call: Callable[..., str],
+                       function_args: Dict[str, Any], policy: Dict[str, Any]) -> str:
+        try:
+            # Las herramientas son síncronas (y pueden llamar a APIs lentas): se ejecutan en un hilo
+            result = await asyncio.to_thread(function_to_call, **function_args)
+        except Exception:
+            self._count(tool_name, "errors")
+            raise
+        else:
+            self._put(key, result, policy)
+            return result
+        finally:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None and in_flight.task is asyncio.current_task():
+                del self._in_flight[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        tools = {}
+        for tool_name, metrics in self._metrics.items():
+            lookups = metrics["hits"] + metrics["misses"] + metrics["coalesced"]
+            tools[tool_name] = {
+                **metrics,
+                "policy": self._policy(tool_name)["mode"],
+                "hit_rate": round((metrics["hits"] + metrics["coalesced"]) / lookups, 4) if lookups else 0.0,
+            }
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "in_flight": len(self._in_flight), "tools": tools}
+
+
+tool_result_cache = ToolResultCache(TOOL_CACHE_POLICIES, TOOL_CACHE_MAX_ENTRIES)
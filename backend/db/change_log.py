@@ -0,0 +1,113 @@
+# backend/db/change_log.py
+# Seguimiento de cambios de agentes y flujos. Cada alta, modificación o borrado añade una fila
+# a change_log (en la misma transacción) y la versión de la entidad pasa a ser el id de esa fila.
+# - Las escrituras ORM se registran solas (evento after_flush).
+# - Las escrituras Core masivas (services/bulk.py) llaman a record_bulk_changes.
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import models as db_models
+
+# Los cambios más recientes que esto no se devuelven todavía: un id menor puede estar aún sin
+# confirmar en otra transacción y, si la versión del cliente lo adelantara, ese cambio se perdería.
+CHANGES_SETTLE_SECONDS = float(os.getenv("CHANGES_SETTLE_SECONDS", "2"))
+
+TRACKED_MODELS = {db_models.Agent: "agent", db_models.Flow: "flow"}
+ENTITY_MODELS = {entity: model for model, entity in TRACKED_MODELS.items()}
+
+
+def record_changes(connection, entity: str, changes: List[Tuple[str, str]]) -> Dict[str, int]:
+    """Inserta los cambios (id, op) y actualiza la versión de las entidades que siguen existiendo."""
+    now = datetime.utcnow()
+    connection.execute(
+        insert(db_models.ChangeLog.__table__),
+        [{"entity": entity, "entity_id": entity_id, "op": op, "changed_at": now} for entity_id, op in changes]
+    )
+    upserted = {entity_id for entity_id, op in changes if op == "upsert"}
+    if not upserted:
+        return {}
+    table = ENTITY_MODELS[entity].__table__
+    change_log = db_models.ChangeLog.__table__
+    latest = (
+        select(func.max(change_log.c.id))
+        .where(change_log.c.entity == entity, change_log.c.entity_id == table.c.id)
+        .scalar_subquery()
+    )
+    connection.execute(update(table).where(table.c.id.in_(upserted)).values(version=latest))
+    return dict(connection.execute(select(table.c.id, table.c.version).where(table.c.id.in_(upserted))).all())
+
+
+@event.listens_for(Session, "after_flush")
+def _record_orm_changes(session, flush_context):
+    changes: Dict[str, List[Tuple[str, str]]] = {}
+    objects: Dict[str, Any] = {}
+    for obj in session.new:
+        if type(obj) in TRACKED_MODELS:
+            changes.setdefault(TRACKED_MODELS[type(obj)], []).append((obj.id, "upsert"))
+            objects[obj.id] = obj
+    for obj in session.dirty:
+        if type(obj) in TRACKED_MODELS and session.is_modified(obj, include_collections=False):
+            changes.setdefault(TRACKED_MODELS[type(obj)], []).append((obj.id, "upsert"))
+            objects[obj.id] = obj
+    for obj in session.deleted:
+        if type(obj) in TRACKED_MODELS:
+            changes.setdefault(TRACKED_MODELS[type(obj)], []).append((obj.id, "delete"))
+    connection = session.connection() if changes else None
+    for entity, entity_changes in changes.items():
+        for entity_id, version in record_changes(connection, entity, entity_changes).items():
+            # Sin marcar el objeto como modificado (no debe provocar otro UPDATE)
+            set_committed_value(objects[entity_id], "version", version)
+
+
+async def record_bulk_changes(session: AsyncSession, entity: str, entity_ids: Iterable[str]) -> None:
+    changes = [(entity_id, "upsert") for entity_id in entity_ids]
+    if changes:
+        await session.run_sync(lambda sync_session: record_changes(sync_session.connection(), entity, changes))
+
+
+async def settled_version(db: AsyncSession) -> int:
+    """Versión hasta la que es seguro sincronizar (ver CHANGES_SETTLE_SECONDS)."""
+    settled_before = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    result = await db.execute(select(func.max(db_models.ChangeLog.id)).where(db_models.ChangeLog.changed_at <= settled_before))
+    return result.scalar() or 0
+
+
+async def changes_since(db: AsyncSession, since: int, limit: int) -> Dict[str, Any]:
+    """Cambios posteriores a `since`, colapsados por entidad (gana el último) y con los datos actuales."""
+    latest = (await db.execute(select(func.max(db_models.ChangeLog.id)))).scalar() or 0
+    if since > latest: # La BD se recreó o el cliente trae una versión de otra instalación
+        return {"version": latest, "has_more": False, "full_resync_required": True,
+                "agents": [], "flows": [], "deleted_agent_ids": [], "deleted_flow_ids": []}
+
+    settled_before = datetime.utcnow() - timedelta(seconds=CHANGES_SETTLE_SECONDS)
+    rows = (await db.execute(
+        select(db_models.ChangeLog.id, db_models.ChangeLog.entity, db_models.ChangeLog.entity_id, db_models.ChangeLog.op)
+        .where(db_models.ChangeLog.id > since, db_models.ChangeLog.changed_at <= settled_before)
+        .order_by(db_models.ChangeLog.id).limit(limit + 1)
+    )).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    last_op: Dict[Tuple[str, str], str] = {}
+    for _, entity, entity_id, op in rows:
+        last_op[(entity, entity_id)] = op
+    result: Dict[str, Any] = {
+        "version": rows[-1].id if rows else since, "has_more": has_more, "full_resync_required": False,
+        "agents": [], "flows": [], "deleted_agent_ids": [], "deleted_flow_ids": [],
+    }
+    for entity, model in ENTITY_MODELS.items():
+        upserted = [entity_id for (e, entity_id), op in last_op.items() if e == entity and op == "upsert"]
+        deleted = [entity_id for (e, entity_id), op in last_op.items() if e == entity and op == "delete"]
+        if upserted: # Una consulta IN por tipo de entidad
+            found = (await db.execute(select(model).where(model.id.in_(upserted)))).scalars().all()
+            result[f"{entity}s"] = found
+            # Borrado en un cambio posterior a esta página: se informa ya como borrado
+            deleted += sorted(set(upserted) - {item.id for item in found})
+        result[f"deleted_{entity}_ids"] = deleted
+    return result
@@ -1,19 +1,46 @@
 # backend/db/database.py
+import asyncio
 import os
-from dotenv import load_dotenv
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from http.cookies import SimpleCookie
+from typing import Callable, Optional
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
 
-load_dotenv() # Cargar variables de .env
+from ..settings import env_bool # Importar settings carga el .env
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not DATABASE_URL:
     raise ValueError("No DATABASE_URL set for SQLAlchemy")
 
+# Réplica de lectura opcional. Si no se configura, todas las lecturas van al primario.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+
+# --- Configuración del motor y del pool ---
+# echo=True es útil para desarrollo para ver las consultas SQL generadas. Desactívalo en producción (DB_ECHO=false).
+ENGINE_OPTIONS = {
+    "echo": env_bool("DB_ECHO", True),
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    # Reciclar conexiones antes de que MySQL las cierre por wait_timeout
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    # Verificar la conexión al sacarla del pool (evita errores tras reinicios o cortes de red)
+    "pool_pre_ping": env_bool("DB_POOL_PRE_PING", True),
+    # Caché de sentencias SQL compiladas (0 la desactiva)
+    "query_cache_size": int(os.getenv("DB_QUERY_CACHE_SIZE", "500")),
+}
+# Ventana (segundos) durante la que un cliente que acaba de escribir lee del primario
+DB_REPLICA_STICKY_SECONDS = float(os.getenv("DB_REPLICA_STICKY_SECONDS", "5"))
+
 # Crear un motor asíncrono de SQLAlchemy
-# echo=True es útil para desarrollo para ver las consultas SQL generadas. Desactívalo en producción.
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = create_async_engine(DATABASE_URL, **ENGINE_OPTIONS)
+replica_engine = create_async_engine(DATABASE_REPLICA_URL, **ENGINE_OPTIONS) if DATABASE_REPLICA_URL else None
 
 # Crear una clase de sesión asíncrona configurada
 # expire_on_commit=False previene que los atributos de los objetos SQLAlchemy expiren después de un commit,
@@ -25,17 +52,251 @@ AsyncSessionLocal = sessionmaker(
     autoflush=False, # Desactivar autoflush para control manual si es necesario
 )
 
+# Sesiones de lectura contra la réplica (o el primario si no hay réplica)
+ReplicaSessionLocal = sessionmaker(
+    bind=replica_engine or engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+    autoflush=False,
+)
+
 # Clase base para nuestros modelos ORM declarativos
 Base = declarative_base()
 
+# --- Métricas del pool de conexiones ---
+class PoolMetrics:
+    """
+    Tiempo de espera para obtener una conexión del pool y tiempo que cada conexión
+    permanece prestada (checkout -> checkin). Muestras recientes en ventanas acotadas.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.wait_times = deque(maxlen=window)
+        self.checkout_durations = deque(maxlen=window)
+        self.checkouts = 0
+
+    @staticmethod
+    def _summary(samples) -> dict:
+        if not samples:
+            return {"count": 0, "avg_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        ordered = sorted(samples)
+        return {
+            "count": len(ordered),
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2),
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "pool_status": engine.pool.status(),
+            "checked_out": engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else None,
+            "replica_pool_status": replica_engine.pool.status() if replica_engine else None,
+            "total_checkouts": self.checkouts,
+            "wait_time": self._summary(self.wait_times),
+            "checkout_duration": self._summary(self.checkout_durations),
+        }
+
+pool_metrics = PoolMetrics()
+
+def _instrument_pool(target_engine) -> None:
+    @event.listens_for(target_engine.sync_engine, "checkout")
+    def _on_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.perf_counter()
+        pool_metrics.checkouts += 1
+
+    @event.listens_for(target_engine.sync_engine, "checkin")
+    def _on_pool_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        if checked_out_at is not None:
+            pool_metrics.checkout_durations.append(time.perf_counter() - checked_out_at)
+
+_instrument_pool(engine)
+if replica_engine is not None:
+    _instrument_pool(replica_engine)
+
+# --- Enrutado a la réplica con "read-your-writes" ---
+# Tras una escritura, las lecturas del mismo cliente van al primario durante
+# DB_REPLICA_STICKY_SECONDS para no ver datos aún no replicados.
+# El instante de la última escritura viaja con el cliente y no en memoria del worker: la
+# respuesta que escribe lo devuelve en la cookie db_last_write y en la cabecera X-Last-Write,
+# y el cliente lo reenvía (la cookie sola, o la cabecera si no usa cookies). Así funciona con
+# varios workers o instancias y no mezcla a clientes que comparten IP detrás de un proxy.
+# Falsificar el valor solo puede forzar lecturas del primario.
+LAST_WRITE_COOKIE = "db_last_write"
+LAST_WRITE_HEADER = "X-Last-Write"
+
+class _ClientWriteState:
+    __slots__ = ("last_write", "wrote_at")
+
+    def __init__(self, last_write: Optional[float]):
+        self.last_write = last_write # Enviado por el cliente (epoch en segundos)
+        self.wrote_at: Optional[float] = None # Escritura confirmada durante esta petición
+
+_client_write_state: ContextVar[Optional[_ClientWriteState]] = ContextVar("db_client_write_state", default=None)
+
+def mark_client_write() -> None:
+    state = _client_write_state.get()
+    if state is not None:
+        state.wrote_at = time.time()
+
+def should_read_from_primary() -> bool:
+    if replica_engine is None:
+        return True
+    state = _client_write_state.get()
+    last_write = state and (state.wrote_at or state.last_write)
+    # abs(): tolera relojes algo desajustados entre instancias sin permitir fijar el primario para siempre
+    return bool(last_write) and abs(time.time() - last_write) < DB_REPLICA_STICKY_SECONDS
+
+def _parse_last_write(headers: dict) -> Optional[float]:
+    raw = headers.get(LAST_WRITE_HEADER.lower().encode())
+    if raw is None and b"cookie" in headers:
+        morsel = SimpleCookie(headers[b"cookie"].decode("latin-1")).get(LAST_WRITE_COOKIE)
+        raw = morsel.value.encode() if morsel else None
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+class ReadYourWritesMiddleware:
+    """Middleware ASGI: lee el instante de la última escritura del cliente y devuelve el nuevo si escribe."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        state = _ClientWriteState(_parse_last_write(dict(scope.get("headers") or [])))
+
+        async def send_with_last_write(message):
+            if message["type"] == "http.response.start" and state.wrote_at is not None:
+                value = f"{state.wrote_at:.3f}"
+                cookie = f"{LAST_WRITE_COOKIE}={value}; Max-Age={int(DB_REPLICA_STICKY_SECONDS) + 1}; Path=/; HttpOnly; SameSite=Lax"
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode()), (LAST_WRITE_HEADER.lower().encode(), value.encode()),
+                ]}
+            await send(message)
+
+        token = _client_write_state.set(state)
+        try:
+            await self.app(scope, receive, send_with_last_write)
+        finally:
+            _client_write_state.reset(token)
+
+@event.listens_for(Session, "after_flush")
+def _track_flush_writes(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_statement_writes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+# --- Acciones tras el commit ---
+# Para efectos fuera de la BD (p. ej. invalidar cachés en memoria) que no deben ocurrir
+# antes de que el cambio sea visible, ni en absoluto si la transacción se revierte.
+def on_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """Ejecuta `callback` cuando se confirme la transacción actual de `session`."""
+    session.sync_session.info.setdefault("after_commit", []).append(callback)
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    for callback in session.info.pop("after_commit", ()):
+        callback()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_commit(session):
+    session.info.pop("after_commit", None)
+
+async def _commit(session: AsyncSession) -> None:
+    await session.commit()
+    if session.sync_session.info.pop("wrote", False):
+        mark_client_write()
+
+async def _acquire_connection(session: AsyncSession) -> None:
+    # Obtener la conexión de forma explícita para medir la espera en el pool
+    started = time.perf_counter()
+    await session.connection()
+    pool_metrics.wait_times.append(time.perf_counter() - started)
+
+@event.listens_for(Session, "before_flush")
+def _block_writes_in_read_only_sessions(session, flush_context, instances):
+    if session.info.get("read_only"):
+        raise RuntimeError("Intento de escritura en una sesión de solo lectura (read_session).")
+
 # Función de dependencia para obtener una sesión de base de datos
+# (CRUD: una sesión durante toda la petición, commit al final)
+# Declararla con Depends(get_db_session, scope="function"): así el commit ocurre antes de enviar
+# la respuesta, y con él mark_client_write (cabecera X-Last-Write) y las acciones on_commit.
 async def get_db_session() -> AsyncSession:
     async with AsyncSessionLocal() as session:
         try:
+            await _acquire_connection(session)
             yield session
-            await session.commit() # Commit al final si todo fue bien
+            await _commit(session) # Commit al final si todo fue bien
         except Exception:
             await session.rollback() # Rollback en caso de error
             raise
         finally:
-            await session.close()
\ No newline at end of file
+            await session.close()
+
+# --- Sesiones de vida corta para las rutas de invocación ---
+# Las invocaciones pasan la mayor parte del tiempo esperando al LLM y a las herramientas.
+# En lugar de retener una conexión del pool durante toda la petición, cargan lo que
+# necesitan en un read_session(), sueltan la conexión, y abren un write_session() solo
+# para persistir resultados.
+
+@asynccontextmanager
+async def read_session():
+    """
+    Sesión de solo lectura: sin commit; la conexión vuelve al pool al salir del bloque.
+    Lee de la réplica salvo que el cliente actual haya escrito hace poco.
+    """
+    session_factory = AsyncSessionLocal if should_read_from_primary() else ReplicaSessionLocal
+    async with session_factory() as session:
+        session.sync_session.info["read_only"] = True
+        await _acquire_connection(session)
+        yield session
+        # close() (al salir del bloque) devuelve la conexión; los objetos cargados
+        # quedan desvinculados pero con sus atributos ya cargados.
+
+# Dependencia para endpoints de solo lectura (listados y consultas por ID)
+async def get_read_db_session() -> AsyncSession:
+    async with read_session() as session:
+        yield session
+
+@asynccontextmanager
+async def write_session():
+    """Sesión de escritura corta: commit al salir del bloque, rollback si hubo error."""
+    async with AsyncSessionLocal() as session:
+        try:
+            await _acquire_connection(session)
+            yield session
+            await _commit(session)
+        except Exception:
+            await session.rollback()
+            raise
+
+# --- Arranque y readiness ---
+
+async def warm_up_pools(connections: int) -> None:
+    """Abre `connections` conexiones por engine y las devuelve al pool, para que las primeras peticiones no paguen el connect."""
+    for target_engine in (engine, replica_engine):
+        if target_engine is None or connections <= 0:
+            continue
+        opened = await asyncio.gather(*(target_engine.connect() for _ in range(min(connections, ENGINE_OPTIONS["pool_size"]))))
+        for connection in opened:
+            await connection.close()
+
+async def ping_database(timeout: float = 2.0) -> None:
+    """SELECT 1 contra el primario; lanza excepción si no responde a tiempo."""
+    async def _ping():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    await asyncio.wait_for(_ping(), timeout=timeout)
+
+async def dispose_engines() -> None:
+    await engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
@@ -0,0 +1,77 @@
+# backend/db/init_db.py
+# Crea las tablas que falten y añade a las existentes las columnas nuevas de los modelos.
+# Fuera del arranque normal de la API para no ejecutarlo en cada worker: python -m backend.db.init_db
+# (en desarrollo también se puede arrancar con DB_CREATE_ALL=true).
+# create_all no modifica tablas que ya existen: las columnas añadidas después de crear
+# agents/flows (timeouts, caché, límites de herramientas, seguimiento de cambios) se añaden
+# aquí con ALTER TABLE, y las filas existentes reciben su versión inicial en change_log.
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import inspect, select, update
+
+from .. import settings # noqa: F401 (carga .env antes de crear el engine)
+from .database import engine, Base
+from . import models # noqa: F401 (registra los modelos en Base.metadata)
+from .change_log import ENTITY_MODELS, record_changes
+
+# Tablas que ya existían en instalaciones anteriores y han ganado columnas desde entonces
+UPGRADED_TABLES = ("agents", "flows")
+
+
+def _add_missing_columns(connection) -> list:
+    inspector = inspect(connection)
+    added = []
+    for table_name in UPGRADED_TABLES:
+        table = Base.metadata.tables[table_name]
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}"
+            if column.nullable:
+                ddl += " NULL"
+            else: # Solo columnas con default escalar (p. ej. version): las filas existentes lo reciben
+                ddl += f" NOT NULL DEFAULT {column.default.arg!r}"
+            connection.exec_driver_sql(ddl)
+            added.append(f"{table_name}.{column.name}")
+    return added
+
+
+def _backfill_change_tracking(connection) -> int:
+    """Filas sin versión (anteriores al seguimiento de cambios): updated_at y una entrada en change_log."""
+    backfilled = 0
+    for entity, model in ENTITY_MODELS.items():
+        table = model.__table__
+        connection.execute(update(table).where(table.c.updated_at.is_(None)).values(updated_at=datetime.utcnow()))
+        ids = connection.execute(select(table.c.id).where(table.c.version == 0)).scalars().all()
+        if ids:
+            record_changes(connection, entity, [(entity_id, "upsert") for entity_id in ids])
+            backfilled += len(ids)
+    return backfilled
+
+
+def upgrade_schema(connection) -> None:
+    added = _add_missing_columns(connection)
+    if added:
+        print(f"Columnas añadidas: {', '.join(added)}")
+    backfilled = _backfill_change_tracking(connection)
+    if backfilled:
+        print(f"Versión inicial asignada a {backfilled} agentes/flujos existentes.")
+
+
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        # await conn.run_sync(Base.metadata.drop_all) # Descomentar para borrar y recrear tablas en cada inicio (¡CUIDADO!)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+        print("Tablas de base de datos creadas (si no existían).")
+
+
+async def main():
+    await create_db_and_tables()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,9 @@
 # backend/db/models.py
-from sqlalchemy import Column, String, Text, ForeignKey, JSON # JSON para la lista de agent_ids
+from sqlalchemy import Column, String, Text, ForeignKey, JSON, Float, Integer, DateTime, BigInteger # JSON para la lista de agent_ids
 from sqlalchemy.orm import relationship
 from .database import Base # Importar Base de nuestro archivo database.py
 import uuid # Para generar IDs por defecto
+from datetime import datetime
 
 def generate_uuid():
     return str(uuid.uuid4())
@@ -17,6 +18,17 @@ class Agent(Base):
     # NUEVO: Campo para almacenar la lista de nombres de herramientas permitidas para este agente
     # Ejemplo: ["get_current_weather", "simple_calculator"]
     tools_enabled = Column(JSON, nullable=True, default=[]) # Lista de strings
+    # Umbral de similitud (0-1) para reutilizar respuestas de prompts casi duplicados.
+    # NULL = caché de prompts desactivada para este agente.
+    semantic_cache_threshold = Column(Float, nullable=True)
+    # Plazo por defecto (segundos) de una invocación de este agente. NULL = plazo global.
+    timeout_seconds = Column(Integer, nullable=True)
+    # Límites del bucle de herramientas (ver services/tool_loop.py). NULL = valores globales.
+    max_tool_rounds = Column(Integer, nullable=True)
+    max_tool_result_chars = Column(Integer, nullable=True)
+    # Seguimiento de cambios (ver db/change_log.py): version = id de su último registro en change_log
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(BigInteger, nullable=False, default=0)
 
     # Relación (si quisiéramos acceder a los flujos donde este agente es usado,
     # pero para una lista de IDs en Flow, esta relación es más compleja.
@@ -36,10 +48,71 @@ class Flow(Base):
     # SQLAlchemy puede manejar tipos JSON que se mapean a tipos JSON nativos de la BD
     # o a TEXT si la BD no tiene un tipo JSON nativo (MySQL sí lo tiene).
     agent_ids = Column(JSON, nullable=False) # Debería ser una lista de strings (UUIDs de agentes)
+    # Plazo por defecto (segundos) de una invocación de este flujo. NULL = plazo global.
+    timeout_seconds = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(BigInteger, nullable=False, default=0)
 
     def __repr__(self):
         return f"<Flow(id={self.id}, name='{self.name}')>"
 
 # No necesitamos definir aquí relaciones inversas explícitas si Flow.agent_ids
 # es solo una lista de IDs. Si fuera una tabla de asociación (muchos a muchos),
-# entonces sí definiríamos `relationship` en ambos modelos.
\ No newline at end of file
+# entonces sí definiríamos `relationship` en ambos modelos.
+
+
+class IdempotencyRecord(Base):
+    """Respuestas guardadas por clave de idempotencia (nivel opcional en BD, ver services/idempotency.py)."""
+    __tablename__ = "idempotency_records"
+
+    key = Column(String(255), primary_key=True) # "<scope>:<Idempotency-Key>"
+    fingerprint = Column(String(64), nullable=False) # sha256 del cuerpo de la petición
+    status_code = Column(Integer, nullable=False)
+    response_body = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyRecord(key={self.key}, status_code={self.status_code})>"
+
+
+class LLMUsageEvent(Base):
+    """Un evento por llamada al LLM. Se escribe por lotes desde services/usage.py."""
+    __tablename__ = "llm_usage_events"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    agent_id = Column(String(36), nullable=False, index=True) # "ad-hoc" para system prompts ad-hoc
+    flow_id = Column(String(36), nullable=False, index=True) # "" si no se invocó dentro de un flujo
+    model = Column(String(100), nullable=False)
+    prompt_tokens = Column(Integer, nullable=False)
+    completion_tokens = Column(Integer, nullable=False)
+    latency_ms = Column(Integer, nullable=False)
+    cost_usd = Column(Float, nullable=False)
+
+class LLMUsageHourly(Base):
+    """Agregado horario por agente, flujo y modelo. Los endpoints de uso consultan esta tabla."""
+    __tablename__ = "llm_usage_hourly"
+
+    hour = Column(DateTime, primary_key=True)
+    agent_id = Column(String(36), primary_key=True)
+    flow_id = Column(String(36), primary_key=True)
+    model = Column(String(100), primary_key=True)
+    calls = Column(BigInteger, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    cost_usd = Column(Float, nullable=False, default=0.0)
+    latency_ms_total = Column(BigInteger, nullable=False, default=0)
+
+class ChangeLog(Base):
+    """
+    Registro de cambios de agentes y flujos para la sincronización incremental del frontend.
+    El id autoincremental es la versión global; los borrados quedan como tombstones (op="delete").
+    """
+    __tablename__ = "change_log"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    entity = Column(String(10), nullable=False) # "agent" | "flow"
+    entity_id = Column(String(36), nullable=False, index=True)
+    op = Column(String(10), nullable=False) # "upsert" | "delete"
+    changed_at = Column(DateTime, nullable=False, index=True)
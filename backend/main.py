@@ -1,22 +1,30 @@
 # backend/main.py
-from fastapi import FastAPI, HTTPException, Depends # Depends se usará más adelante
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, WebSocket, WebSocketDisconnect # Depends se usará más adelante
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field # Field para validaciones/defaults
 from sqlalchemy.future import select # Necesario para SQLAlchemy 2.0 style queries si lo usas
 import openai
-import os
-from pathlib import Path    
-from dotenv import load_dotenv
-load_dotenv(Path(__file__).resolve().parent / ".env")
+import asyncio
+import time
+from datetime import datetime, timedelta
 import json
 
-from typing import List, Dict, Union, Optional, Any # Any podría ser útil para logs
+from typing import List, Dict, Union, Optional, Any, Callable # Any podría ser útil para logs
 import uuid # Para generar IDs únicos para los agentes
 
+from . import settings # Carga el .env; debe importarse antes que el resto de módulos del backend
+
 # --- Importaciones de Base de Datos ---
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import func, select, JSON # Asegúrate de importar func y select
-from .db.database import engine, Base, get_db_session # Importar de nuestra carpeta db
+from .db.database import ( # Importar de nuestra carpeta db
+    engine, replica_engine, get_db_session, get_read_db_session, read_session, pool_metrics, ReadYourWritesMiddleware, LAST_WRITE_HEADER,
+    warm_up_pools, ping_database, dispose_engines, on_commit
+)
+from .db.init_db import create_db_and_tables
+from .db import change_log # Registra el listener que anota los cambios de agentes y flujos
 from .db import models as db_models # Importar nuestros modelos SQLAlchemy
 from . import schemas # Crearemos este archivo para los modelos Pydantic
 
@@ -27,36 +35,81 @@ from .schemas import (
 )
 
 from .agent_tools.available_tools import AVAILABLE_TOOLS_SCHEMAS, TOOL_NAME_TO_FUNCTION_MAP
+from .agent_tools.tool_cache import tool_result_cache
+from .services.prompt_cache import prompt_cache, build_scope
+from .services.cancellation import (
+    Deadline, InvocationCancelled, resolve_deadline, run_cancellable, record_cancelled, list_cancelled
+)
+from .services.admission import admission_controller, classify_request
+from .services.idempotency import idempotency_store
+from .services.usage import usage_recorder, NO_FLOW_ID
+from .services.responses import FastJSONResponse, weak_etag, not_modified, set_etag
+from .services.ws_sessions import (
+    AgentSession, SessionClosed, SlowConsumer, session_registry, WS_IDLE_TIMEOUT_SECONDS,
+    WS_CLOSE_NORMAL, WS_CLOSE_POLICY, WS_CLOSE_TRY_AGAIN_LATER
+)
+from .services.bulk import BulkImporter, export_ndjson
+from .services.tool_loop import (
+    DEFAULT_MAX_TOOL_ROUNDS, DEFAULT_MAX_TOOL_RESULT_CHARS, truncate_tool_result, round_stats
+)
+from .services import llm
+from .services.config_cache import config_cache, AgentConfig, FlowConfig
+from .services.profiling import (
+    ProfilingMiddleware, phase, profiled_handler, instrument_engine, require_admin_token,
+    list_slow_requests, list_profiles, get_profile
+)
 
 
-try:
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    if not client.api_key:
-        raise ValueError("OPENAI_API_KEY no encontrada.")
-except Exception as e:
-    print(f"Error al inicializar el cliente de OpenAI: {e}")
-    client = None
+# --- Arranque y apagado (lifespan) ---
+# Nada costoso ocurre al importar: el cliente de OpenAI, el pool de la BD y las cachés se
+# preparan aquí, y /readyz no responde 200 hasta que todo está listo.
+async def _startup_step(name: str, coro, timings: Dict[str, float]) -> None:
+    started = time.perf_counter()
+    try:
+        await coro
+    except Exception as e: # Un precalentamiento fallido no impide arrancar; /readyz lo comprobará
+        print(f"Advertencia: falló el paso de arranque '{name}': {e}")
+    timings[name] = round(time.perf_counter() - started, 3)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    print("Aplicación iniciándose...")
+    app.state.ready = False
+    timings: Dict[str, float] = {}
+    if settings.DB_CREATE_ALL: # Solo desarrollo; en producción: python -m backend.db.init_db
+        await _startup_step("create_all", create_db_and_tables(), timings)
+    llm.init_client()
+    steps = [_startup_step("db_pool", warm_up_pools(settings.DB_WARM_CONNECTIONS), timings)]
+    if settings.LLM_WARMUP:
+        steps.append(_startup_step("llm_connection", llm.warm_up(), timings))
+    steps.append(_startup_step("hot_configs", config_cache.preload_hot(settings.PRELOAD_HOT_CONFIGS), timings))
+    await asyncio.gather(*steps)
+    usage_recorder.start() # Escritura por lotes de la contabilidad de tokens
+
+    app.state.startup_seconds = round(time.perf_counter() - started, 3)
+    app.state.startup_timings = timings
+    app.state.startup_over_budget = app.state.startup_seconds > settings.STARTUP_BUDGET_SECONDS
+    if app.state.startup_over_budget:
+        print(f"Advertencia: el arranque tardó {app.state.startup_seconds}s (presupuesto: {settings.STARTUP_BUDGET_SECONDS}s). Pasos: {timings}")
+    else:
+        print(f"Aplicación lista en {app.state.startup_seconds}s. Pasos: {timings}")
+    app.state.ready = True
+    yield
 
-# --- NUEVO: Función para crear tablas de la BD (para desarrollo) ---
-async def create_db_and_tables():
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all) # Descomentar para borrar y recrear tablas en cada inicio (¡CUIDADO!)
-        await conn.run_sync(Base.metadata.create_all)
-        print("Tablas de base de datos creadas (si no existían).")
+    app.state.ready = False # Dejar de recibir tráfico nuevo mientras se apaga
+    await usage_recorder.stop() # Persistir los eventos de uso que queden en memoria
+    await llm.close_client()
+    await dispose_engines()
 
 app = FastAPI(
     title="API del Gestor Multiagentes",
     version="0.3.0", # Incrementamos versión
-    description="API con persistencia en MySQL para agentes y flujos."
+    description="API con persistencia en MySQL para agentes y flujos.",
+    default_response_class=FastJSONResponse, # orjson si está instalado
+    lifespan=lifespan,
 )
 
-# --- NUEVO: Evento de startup para crear tablas ---
-@app.on_event("startup")
-async def on_startup():
-    print("Aplicación iniciándose...")
-    await create_db_and_tables()
-    # Aquí podrías poner más lógica de inicialización si es necesario
-
 origins = ["http://localhost", "http://localhost:3000"]
 app.add_middleware(
     CORSMiddleware,
@@ -64,7 +117,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[LAST_WRITE_HEADER], # El frontend la reenvía (ver ReadYourWritesMiddleware)
 )
+# Enrutado de lecturas a la réplica con read-your-writes por cliente
+app.add_middleware(ReadYourWritesMiddleware)
+# Desglose por fases de cada petición y profiler bajo demanda (el más externo, para medirlo todo)
+app.add_middleware(ProfilingMiddleware)
+for _engine in (engine, replica_engine):
+    if _engine is not None:
+        instrument_engine(_engine)
 
 # --- "Base de datos" en memoria ---  Esto ya se podria eliminar si usamos una BD real
 # Usaremos un diccionario para guardar los agentes. La clave será el ID del agente.
@@ -81,10 +142,6 @@ class AgentConfigBase(BaseModel):
 class AgentConfigCreate(AgentConfigBase):
     pass # Hereda todo de AgentConfigBase, usado para la creación
 
-class AgentConfig(AgentConfigBase):
-    id: str = Field(..., description="ID único del agente, generado automáticamente.")
-    # Aquí podríamos añadir 'created_at', 'updated_at' si tuviéramos una BD real
-
 class AgentInvokeRequest(BaseModel):
     # Opción 1: Usar un agente existente por su ID
     agent_id: Optional[str] = Field(None, description="ID de un agente preconfigurado para usar su system_prompt.")
@@ -115,9 +172,6 @@ class FlowConfigBase(BaseModel):
 class FlowConfigCreate(FlowConfigBase):
     pass
 
-class FlowConfig(FlowConfigBase):
-    id: str = Field(..., description="ID único del flujo, generado automáticamente.")
-
 class FlowInvokeRequest(BaseModel):
     initial_user_prompt: str = Field(..., description="El prompt inicial del usuario para el primer agente del flujo.")
 
@@ -139,7 +193,7 @@ class FlowInvokeResponse(BaseModel):
 @app.post("/api/v1/agents", response_model=schemas.Agent, status_code=201)
 async def create_agent_endpoint(
     agent_data: schemas.AgentCreate,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     if agent_data.tools_enabled:
         valid_tool_names = [tool_schema["function"]["name"] for tool_schema in AVAILABLE_TOOLS_SCHEMAS]
@@ -152,7 +206,11 @@ async def create_agent_endpoint(
     db_agent = db_models.Agent(
         name=agent_data.name,
         system_prompt=agent_data.system_prompt,
-        tools_enabled=agent_data.tools_enabled or []
+        tools_enabled=agent_data.tools_enabled or [],
+        semantic_cache_threshold=agent_data.semantic_cache_threshold,
+        timeout_seconds=agent_data.timeout_seconds,
+        max_tool_rounds=agent_data.max_tool_rounds,
+        max_tool_result_chars=agent_data.max_tool_result_chars
     )
     db.add(db_agent)
     await db.flush()
@@ -161,19 +219,28 @@ async def create_agent_endpoint(
 
 
 @app.get("/api/v1/agents", response_model=List[schemas.Agent])
+@profiled_handler
 async def list_agents_endpoint(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_read_db_session)
 ):
     # Usar select() directamente con el modelo para SQLAlchemy 2.0 style
     stmt = select(db_models.Agent).offset(skip).limit(limit)
     result = await db.execute(stmt)
     agents = result.scalars().all()
+    # ETag a partir de (id, versión): si el cliente ya tiene esta página, 304 sin serializar ni enviar nada
+    etag = _list_etag("agents", skip, limit, agents)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    set_etag(response, etag)
     return agents
 
 @app.get("/api/v1/agents/{agent_id}", response_model=schemas.Agent)
-async def get_agent_endpoint(agent_id: str, db: AsyncSession = Depends(get_db_session)):
+async def get_agent_endpoint(agent_id: str, db: AsyncSession = Depends(get_read_db_session)):
     agent = await db.get(db_models.Agent, agent_id)
     if not agent:
         raise HTTPException(status_code=404, detail="Agente no encontrado.")
@@ -183,7 +250,7 @@ async def get_agent_endpoint(agent_id: str, db: AsyncSession = Depends(get_db_se
 async def update_agent_endpoint(
     agent_id: str,
     agent_data: schemas.AgentUpdate,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_agent = await db.get(db_models.Agent, agent_id)
     if not db_agent:
@@ -206,12 +273,13 @@ async def update_agent_endpoint(
     db.add(db_agent)
     await db.flush()
     await db.refresh(db_agent)
+    on_commit(db, lambda: config_cache.invalidate_agent(agent_id)) # Hasta el commit otros leerían la versión anterior
     return db_agent
 
 @app.delete("/api/v1/agents/{agent_id}", status_code=204)
 async def delete_agent_endpoint(
     agent_id: str,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_agent = await db.get(db_models.Agent, agent_id)
     if not db_agent:
@@ -261,6 +329,7 @@ async def delete_agent_endpoint(
     # Si no está en uso, proceder a eliminar
     await db.delete(db_agent)
     await db.flush() # Aplicar el cambio a la BD
+    on_commit(db, lambda: config_cache.invalidate_agent(agent_id))
     # No es necesario `await db.commit()` aquí si `get_db_session` lo maneja
     return # Devuelve 204 No Content
 
@@ -269,7 +338,7 @@ async def delete_agent_endpoint(
 @app.post("/api/v1/flows", response_model=schemas.Flow, status_code=201)
 async def create_flow_endpoint(
     flow_data: schemas.FlowCreate,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     # 1) Verificar que existan los agentes
     for agent_id in flow_data.agent_ids:
@@ -280,7 +349,8 @@ async def create_flow_endpoint(
     db_flow = db_models.Flow(
         name=flow_data.name,
         description=flow_data.description,
-        agent_ids=flow_data.agent_ids
+        agent_ids=flow_data.agent_ids,
+        timeout_seconds=flow_data.timeout_seconds
     )
     db.add(db_flow)
 
@@ -292,29 +362,34 @@ async def create_flow_endpoint(
 
 
 @app.get("/api/v1/flows", response_model=List[schemas.Flow])
+@profiled_handler
 async def list_flows_endpoint(
-    skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db_session)
+    request: Request, response: Response,
+    skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_read_db_session)
 ):
     result = await db.execute(
         db_models.Flow.__table__.select().offset(skip).limit(limit)
     )
     flows = result.fetchall()
+    etag = _list_etag("flows", skip, limit, flows)
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    set_etag(response, etag)
     return flows
 
 @app.get("/api/v1/flows/{flow_id}", response_model=schemas.Flow)
-async def get_flow_endpoint(flow_id: str, db: AsyncSession = Depends(get_db_session)):
+async def get_flow_endpoint(flow_id: str, db: AsyncSession = Depends(get_read_db_session)):
     flow = await db.get(db_models.Flow, flow_id)
     if not flow:
         raise HTTPException(status_code=404, detail="Flujo no encontrado.")
     return flow
 
-MAX_TOOL_CALLS_PER_INVOCATION = 5 # Para evitar bucles infinitos
-
 @app.put("/api/v1/flows/{flow_id}", response_model=schemas.Flow)
 async def update_flow_endpoint(
     flow_id: str,
     flow_data: schemas.FlowUpdate,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_flow = await db.get(db_models.Flow, flow_id)
     if not db_flow:
@@ -334,12 +409,13 @@ async def update_flow_endpoint(
     db.add(db_flow)
     await db.flush()
     await db.refresh(db_flow)
+    on_commit(db, lambda: config_cache.invalidate_flow(flow_id))
     return db_flow
 
 @app.delete("/api/v1/flows/{flow_id}", status_code=204)
 async def delete_flow_endpoint(
     flow_id: str,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_flow = await db.get(db_models.Flow, flow_id)
     if not db_flow:
@@ -347,88 +423,116 @@ async def delete_flow_endpoint(
     
     await db.delete(db_flow)
     await db.flush()
+    on_commit(db, lambda: config_cache.invalidate_flow(flow_id))
     return
 
 # ... (resto de tus endpoints: invoke_agent_endpoint, invoke_flow_endpoint, list_available_tools, etc.)
 # Asegúrate de que las importaciones necesarias como `json`, `func` y `select` de SQLAlchemy estén presentes.
 
 
-# --- Endpoint de Invocación de Agente Individual (AHORA CON BD) ---
-@app.post("/api/v1/agent/invoke", response_model=schemas.AgentInvokeResponse)
-async def invoke_agent_endpoint(
-    request_data: schemas.AgentInvokeRequest, # Corregido a schemas.AgentInvokeRequest
-    db: AsyncSession = Depends(get_db_session)
-):
-    if not client:
-        raise HTTPException(status_code=500, detail="Cliente de OpenAI no inicializado.")
-
-    actual_system_prompt = ""
-    agent_name_for_log = "Ad-hoc"
-    agent_id_for_log = "ad-hoc" # Usar el ID real si se usa un agente existente
-
-    agent_tools_to_pass_to_llm = [] 
-    agent_enabled_tool_names = []  
-
-    if request_data.agent_id:
-        agent_config_db = await db.get(db_models.Agent, request_data.agent_id)
-        if not agent_config_db:
-            raise HTTPException(status_code=404, detail=f"Agente con ID '{request_data.agent_id}' no encontrado.")
-        actual_system_prompt = agent_config_db.system_prompt
-        agent_name_for_log = agent_config_db.name
-        agent_id_for_log = agent_config_db.id 
-        agent_enabled_tool_names = agent_config_db.tools_enabled or []
-
-        if agent_enabled_tool_names:
-            for tool_schema in AVAILABLE_TOOLS_SCHEMAS:
-                if tool_schema["function"]["name"] in agent_enabled_tool_names:
-                    agent_tools_to_pass_to_llm.append(tool_schema)
-        
-        print(f"Usando agente: {agent_name_for_log} (ID: {agent_id_for_log}) con herramientas: {agent_enabled_tool_names}")
-    elif request_data.system_prompt:
-        actual_system_prompt = request_data.system_prompt
-        print(f"Usando system_prompt ad-hoc (sin herramientas por defecto)")
-    else:
-         raise HTTPException(status_code=400, detail="Se debe proveer 'agent_id' o un 'system_prompt'.")
-
-    messages = [
-        {"role": "system", "content": actual_system_prompt},
-        {"role": "user", "content": request_data.user_prompt}
-    ]
-
-    print(f"\n--- Iniciando Invocación de Agente: {agent_name_for_log} ---")
-    print(f"  User Prompt Inicial: {request_data.user_prompt[:200]}...")
-    if agent_tools_to_pass_to_llm:
-         print(f"  Herramientas disponibles para el LLM: {[t['function']['name'] for t in agent_tools_to_pass_to_llm]}")
-
+# --- Llamadas al LLM y a herramientas con plazo ---
+# Cliente asíncrono: si la invocación se cancela, la petición HTTP al LLM se aborta con ella.
+# El timeout de cada intento es el tiempo que le queda al plazo de la petición, y solo se
+# reintenta (errores transitorios) si queda plazo suficiente.
+async def _create_chat_completion(deadline: Deadline, usage_context: Dict[str, Optional[str]], **openai_call_params):
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        deadline.check()
+        try:
+            with phase("llm", openai_call_params["model"]):
+                chat_completion = await llm.client.chat.completions.create(timeout=deadline.remaining(), **openai_call_params)
+            break
+        except openai.APITimeoutError:
+            if deadline.expired:
+                raise InvocationCancelled("deadline")
+            raise
+        except llm.RETRYABLE_ERRORS as e:
+            attempt += 1
+            if attempt > llm.LLM_MAX_RETRIES or deadline.remaining() < llm.LLM_RETRY_MIN_REMAINING_SECONDS:
+                raise
+            print(f"Error transitorio del LLM ({type(e).__name__}), reintento {attempt}/{llm.LLM_MAX_RETRIES}.")
+            await asyncio.sleep(min(0.5 * attempt, deadline.remaining()))
+    # Contabilidad de tokens/coste: solo se encola en memoria, se persiste por lotes en segundo plano
+    usage_recorder.record(
+        usage_context.get("agent_id"), usage_context.get("flow_id"),
+        getattr(chat_completion, "model", None) or openai_call_params["model"],
+        getattr(chat_completion, "usage", None), time.perf_counter() - started
+    )
+    return chat_completion
+
+async def _call_tool(function_name: str, function_args: dict, deadline: Deadline) -> str:
+    deadline.check()
+    try:
+        with phase("tool", function_name):
+            return await asyncio.wait_for(
+                tool_result_cache.call(function_name, TOOL_NAME_TO_FUNCTION_MAP[function_name], function_args),
+                timeout=deadline.remaining()
+            )
+    except asyncio.TimeoutError:
+        raise InvocationCancelled("deadline")
+
+
+async def _run_agent_conversation(
+    messages: List[dict],
+    agent_tools_to_pass_to_llm: List[dict],
+    deadline: Deadline,
+    progress: Dict[str, Any],
+    usage_context: Dict[str, Optional[str]],
+    on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    max_tool_rounds: Optional[int] = None,
+    max_tool_result_chars: Optional[int] = None,
+) -> str:
+    """
+    Bucle LLM <-> herramientas sobre `messages` (se modifica en sitio) hasta obtener la respuesta
+    final de texto. `progress` se va actualizando para poder registrar el avance si se cancela;
+    en progress["rounds"] quedan los tokens de prompt de cada ronda (ver services/tool_loop.py).
+    `on_event`, si se pasa, recibe un evento por cada llamada a herramienta y su resultado
+    (lo usan las sesiones WebSocket para informar al cliente en vivo).
+    """
+    max_tool_rounds = max_tool_rounds or DEFAULT_MAX_TOOL_ROUNDS
+    max_tool_result_chars = max_tool_result_chars or DEFAULT_MAX_TOOL_RESULT_CHARS
     tool_calls_count = 0
-    openai_call_attempts = 0
-    MAX_TOOL_CALLS_PER_INVOCATION = 5 
+    tool_rounds = 0
+    previous_prompt_tokens = None
 
-    while tool_calls_count < MAX_TOOL_CALLS_PER_INVOCATION:
+    # Una llamada por ronda de herramientas más la de la respuesta final
+    while tool_rounds <= max_tool_rounds:
+        last_round = tool_rounds == max_tool_rounds
         try:
-            openai_call_attempts += 1
-            print(f"--> Enviando a OpenAI (Llamada LLM #{openai_call_attempts}): {len(messages)} mensajes.")
+            print(f"--> Enviando a OpenAI (Llamada LLM #{progress['llm_calls'] + 1}): {len(messages)} mensajes.")
 
             openai_call_params = {
-                "model": "gpt-3.5-turbo", 
+                "model": "gpt-3.5-turbo",
                 "messages": messages,
                 "temperature": 0.7,
                 "max_tokens": 350
             }
             if agent_tools_to_pass_to_llm:
                 openai_call_params["tools"] = agent_tools_to_pass_to_llm
-                openai_call_params["tool_choice"] = "auto"
+                # Rondas agotadas: el modelo tiene que contestar con lo que ya tiene
+                openai_call_params["tool_choice"] = "none" if last_round else "auto"
 
-            chat_completion = client.chat.completions.create(**openai_call_params)
+            chat_completion = await _create_chat_completion(deadline, usage_context, **openai_call_params)
             response_message = chat_completion.choices[0].message
-
-        except Exception as e: 
+            progress["llm_calls"] += 1
+            current_round = round_stats(progress["llm_calls"], getattr(chat_completion, "usage", None), previous_prompt_tokens)
+            previous_prompt_tokens = current_round["prompt_tokens"]
+            progress["rounds"].append(current_round)
+            if current_round["prompt_tokens"] is not None:
+                print(f"    Tokens de prompt: {current_round['prompt_tokens']} (+{current_round['prompt_tokens_added']} en esta ronda)")
+
+        except InvocationCancelled:
+            raise
+        except Exception as e:
             print(f"Error en llamada a OpenAI: {e}")
             raise HTTPException(status_code=500, detail=f"Error en llamada a OpenAI: {str(e)}")
 
-        if response_message.tool_calls:
+        if response_message.tool_calls and not last_round:
             print(f" <-- LLM solicitó {len(response_message.tool_calls)} llamada(s) a herramientas.")
-            messages.append(response_message) 
+            tool_rounds += 1
+            current_round["tool_calls"] = len(response_message.tool_calls)
+            messages.append(response_message)
 
             for tool_call in response_message.tool_calls:
                 tool_calls_count += 1
@@ -454,24 +558,35 @@ async def invoke_agent_endpoint(
                     continue
 
                 if function_name in TOOL_NAME_TO_FUNCTION_MAP:
-                    function_to_call = TOOL_NAME_TO_FUNCTION_MAP[function_name]
+                    if on_event:
+                        on_event({"type": "tool_call", "name": function_name, "arguments": function_args})
                     try:
                         print(f"      Ejecutando: {function_name}(**{function_args})")
-                        function_response = function_to_call(**function_args)
+                        function_response = await _call_tool(function_name, function_args, deadline)
                         response_preview = str(function_response)
                         if len(response_preview) > 200:
                             response_preview = response_preview[:197] + "..."
-                        print(f"      Respuesta Herramienta: {response_preview}") 
+                        print(f"      Respuesta Herramienta: {response_preview}")
 
+                    except InvocationCancelled:
+                        raise
                     except Exception as e:
                         print(f"    ERROR al ejecutar la herramienta '{function_name}': {str(e)}")
                         function_response = json.dumps({"error": f"Error al ejecutar la herramienta: {str(e)}"})
-
+                        response_preview = function_response
+
+                    progress["tool_calls"].append(function_name)
+                    if on_event:
+                        on_event({"type": "tool_result", "name": function_name, "content": response_preview})
+                    tool_content, truncated = truncate_tool_result(str(function_response), max_tool_result_chars)
+                    if truncated:
+                        current_round["truncated_tool_results"] += 1
+                        print(f"      Resultado recortado a {max_tool_result_chars} caracteres (tenía {len(str(function_response))}).")
                     messages.append({
                         "tool_call_id": tool_call.id,
                         "role": "tool",
                         "name": function_name,
-                        "content": str(function_response), 
+                        "content": tool_content,
                     })
                 else:
                     print(f"    ERROR: Función '{function_name}' desconocida.")
@@ -481,55 +596,173 @@ async def invoke_agent_endpoint(
                         "name": function_name,
                         "content": json.dumps({"error": f"Función '{function_name}' no implementada o desconocida."}),
                     })
-        else: 
+        elif response_message.content or not response_message.tool_calls:
             print(f" <-- LLM devolvió respuesta final de texto.")
-            agent_text_response = response_message.content or "El agente no proporcionó contenido."
-            print(f"--- Invocación de Agente '{agent_name_for_log}' Finalizada ---")
-            return schemas.AgentInvokeResponse(
-                agent_response=agent_text_response,
-                used_system_prompt=actual_system_prompt
-            )
+            progress["final_content"] = response_message.content
+            return response_message.content or "El agente no proporcionó contenido."
+        else:
+            break # Pidió herramientas incluso con tool_choice="none"
 
-    print(f"ERROR: Se excedió el máximo de llamadas a herramientas ({MAX_TOOL_CALLS_PER_INVOCATION}).")
-    raise HTTPException(status_code=400, detail=f"Se excedió el máximo de {MAX_TOOL_CALLS_PER_INVOCATION} llamadas a herramientas.")
+    print(f"ERROR: Se excedió el máximo de rondas de herramientas ({max_tool_rounds}).")
+    raise HTTPException(status_code=400, detail=f"Se excedió el máximo de {max_tool_rounds} rondas de llamadas a herramientas.")
 
 
-
-# --- Endpoint de Invocación de Flujo (AHORA CON BD) ---
-@app.post("/api/v1/flows/{flow_id}/invoke", response_model=schemas.FlowInvokeResponse)
-async def invoke_flow_endpoint(
-    flow_id: str,
-    request_data: schemas.FlowInvokeRequest, # Corregido a schemas.FlowInvokeRequest
-    db: AsyncSession = Depends(get_db_session)
+# --- Endpoint de Invocación de Agente Individual (AHORA CON BD) ---
+@app.post("/api/v1/agent/invoke", response_model=schemas.AgentInvokeResponse)
+@profiled_handler
+async def invoke_agent_endpoint(
+    request_data: schemas.AgentInvokeRequest, # Corregido a schemas.AgentInvokeRequest
+    request: Request,
+    x_request_timeout: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
 ):
-    if not client:
+    # Sin Depends(get_db_session): la invocación abre sesiones cortas solo cuando las necesita
+    async def execute(connection):
+        return await _invoke_agent(request_data, connection, x_request_timeout, classify_request(request))
+
+    if not idempotency_key:
+        return await execute(request)
+    return await idempotency_store.run("agent_invoke", idempotency_key, request_data.model_dump(), request, execute)
+
+async def _invoke_agent(
+    request_data: schemas.AgentInvokeRequest,
+    connection: Any, # Request o SharedConnection: su desconexión cancela la invocación
+    x_request_timeout: Optional[str],
+    priority_class: str,
+) -> schemas.AgentInvokeResponse:
+    if not llm.client:
         raise HTTPException(status_code=500, detail="Cliente de OpenAI no inicializado.")
 
-    flow_config_db = await db.get(db_models.Flow, flow_id)
-    if not flow_config_db:
-        raise HTTPException(status_code=404, detail=f"Flujo con ID '{flow_id}' no encontrado.")
+    actual_system_prompt = ""
+    agent_name_for_log = "Ad-hoc"
+    agent_id_for_log = "ad-hoc" # Usar el ID real si se usa un agente existente
+    agent_default_timeout = None
+    agent_max_tool_rounds = None # None = DEFAULT_MAX_TOOL_ROUNDS / DEFAULT_MAX_TOOL_RESULT_CHARS
+    agent_max_tool_result_chars = None
 
-    current_input_prompt = request_data.initial_user_prompt
-    log_steps: List[schemas.FlowInvokeLogStep] = []
-    final_flow_output = ""
+    agent_tools_to_pass_to_llm = []
+    agent_enabled_tool_names = []
 
-    print(f"\n--- Iniciando Invocación de Flujo: {flow_config_db.name} (ID: {flow_id}) ---")
-    print(f"Prompt Inicial del Usuario: {current_input_prompt}")
+    if request_data.agent_id:
+        # Desde la caché de configuración (o una sesión corta de lectura si no está)
+        agent_config = await config_cache.get_agent(request_data.agent_id)
+        if not agent_config:
+            raise HTTPException(status_code=404, detail=f"Agente con ID '{request_data.agent_id}' no encontrado.")
+        actual_system_prompt = agent_config.system_prompt
+        agent_name_for_log = agent_config.name
+        agent_id_for_log = agent_config.id
+        agent_enabled_tool_names = list(agent_config.tools_enabled)
+        agent_default_timeout = agent_config.timeout_seconds
+        agent_max_tool_rounds = agent_config.max_tool_rounds
+        agent_max_tool_result_chars = agent_config.max_tool_result_chars
+        agent_tools_to_pass_to_llm = list(agent_config.tools) # Bundle de herramientas ya construido
 
-    for i, agent_id_in_flow in enumerate(flow_config_db.agent_ids):
-        agent_config_db_step = await db.get(db_models.Agent, agent_id_in_flow)
-        if not agent_config_db_step:
-            error_detail = f"Configuración del Agente ID '{agent_id_in_flow}' no encontrada."
-            print(f"ERROR: {error_detail}")
-            raise HTTPException(status_code=500, detail=error_detail)
+        print(f"Usando agente: {agent_name_for_log} (ID: {agent_id_for_log}) con herramientas: {agent_enabled_tool_names}")
+    elif request_data.system_prompt:
+        actual_system_prompt = request_data.system_prompt
+        print(f"Usando system_prompt ad-hoc (sin herramientas por defecto)")
+    else:
+         raise HTTPException(status_code=400, detail="Se debe proveer 'agent_id' o un 'system_prompt'.")
+
+    deadline = resolve_deadline(x_request_timeout, agent_default_timeout)
+
+    messages = [
+        {"role": "system", "content": actual_system_prompt},
+        {"role": "user", "content": request_data.user_prompt}
+    ]
 
-        actual_system_prompt_step = agent_config_db_step.system_prompt
-        print(f"\n  Paso {i+1}/{len(flow_config_db.agent_ids)} - Agente: {agent_config_db_step.name} (ID: {agent_id_in_flow})")
+    print(f"\n--- Iniciando Invocación de Agente: {agent_name_for_log} (plazo: {deadline.seconds:.0f}s) ---")
+    print(f"  User Prompt Inicial: {request_data.user_prompt[:200]}...")
+    if agent_tools_to_pass_to_llm:
+         print(f"  Herramientas disponibles para el LLM: {[t['function']['name'] for t in agent_tools_to_pass_to_llm]}")
+
+    # --- Caché de prompts casi duplicados ---
+    # Solo para agentes sin herramientas: con herramientas la respuesta depende de datos externos (hora, clima...).
+    cache_scope = None
+    if request_data.agent_id and agent_config.semantic_cache_threshold and not agent_tools_to_pass_to_llm:
+        cache_scope = build_scope(actual_system_prompt, "gpt-3.5-turbo", temperature=0.7, max_tokens=350)
+        cached_response = prompt_cache.lookup(
+            cache_scope, request_data.user_prompt, agent_config.semantic_cache_threshold, agent_id_for_log
+        )
+        if cached_response is not None:
+            print(f"--- Invocación de Agente '{agent_name_for_log}' servida desde la caché de prompts ---")
+            return schemas.AgentInvokeResponse(
+                agent_response=cached_response,
+                used_system_prompt=actual_system_prompt
+            )
+
+    progress = {"llm_calls": 0, "tool_calls": [], "final_content": None, "rounds": []}
+    try:
+        # Control de admisión: espera en cola (o 429) antes de consumir cuota del LLM. La espera
+        # cuenta dentro del plazo y se abandona si el cliente se desconecta.
+        async with admission_controller.slot(priority_class, connection, deadline):
+            agent_text_response = await run_cancellable(
+                connection, _run_agent_conversation(
+                    messages, agent_tools_to_pass_to_llm, deadline, progress,
+                    {"agent_id": request_data.agent_id, "flow_id": None},
+                    max_tool_rounds=agent_max_tool_rounds, max_tool_result_chars=agent_max_tool_result_chars
+                ), deadline
+            )
+    except InvocationCancelled as e:
+        steps = [{"kind": "llm_call", "status": "completed"} for _ in range(progress["llm_calls"])]
+        steps += [{"kind": "tool_call", "name": name, "status": "completed"} for name in progress["tool_calls"]]
+        steps.append({"kind": "pending", "status": "cancelled"})
+        invocation_id = record_cancelled("agent", agent_id_for_log, e.reason, steps)
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"Invocación del agente '{agent_name_for_log}' cancelada ({e.reason}). ID de invocación: {invocation_id}"
+        )
+
+    if cache_scope and progress["final_content"]:
+        prompt_cache.store(cache_scope, request_data.user_prompt, agent_text_response)
+    print(f"--- Invocación de Agente '{agent_name_for_log}' Finalizada ---")
+    return schemas.AgentInvokeResponse(
+        agent_response=agent_text_response,
+        used_system_prompt=actual_system_prompt,
+        rounds=progress["rounds"]
+    )
+
+
+async def _run_flow_steps(
+    flow_config: FlowConfig,
+    agents_by_id: Dict[str, AgentConfig],
+    initial_user_prompt: str,
+    deadline: Deadline,
+    log_steps: List[schemas.FlowInvokeLogStep],
+) -> str:
+    """Ejecuta los agentes del flujo en orden; cada paso queda en `log_steps` en cuanto termina."""
+    current_input_prompt = initial_user_prompt
+    final_flow_output = ""
+
+    for i, agent_id_in_flow in enumerate(flow_config.agent_ids):
+        deadline.check()
+        agent_config_step = agents_by_id[agent_id_in_flow]
+
+        actual_system_prompt_step = agent_config_step.system_prompt
+        print(f"\n  Paso {i+1}/{len(flow_config.agent_ids)} - Agente: {agent_config_step.name} (ID: {agent_id_in_flow})")
         print(f"    System Prompt: {actual_system_prompt_step[:100]}...")
         print(f"    Input Prompt: {current_input_prompt[:100]}...")
 
+        cache_scope = None
+        cache_threshold = agent_config_step.semantic_cache_threshold
+        if cache_threshold:
+            cache_scope = build_scope(actual_system_prompt_step, "gpt-3.5-turbo", temperature=0.7, max_tokens=300)
+            cached_response = prompt_cache.lookup(cache_scope, current_input_prompt, cache_threshold, agent_id_in_flow)
+            if cached_response is not None:
+                print(f"    Output Respuesta (caché de prompts): {cached_response[:100]}...")
+                log_steps.append(schemas.FlowInvokeLogStep(
+                    agent_id=agent_id_in_flow, agent_name=agent_config_step.name,
+                    input_prompt=current_input_prompt, output_response=cached_response,
+                    system_prompt_used=actual_system_prompt_step
+                ))
+                current_input_prompt = cached_response
+                final_flow_output = cached_response
+                continue
+
         try:
-            chat_completion = client.chat.completions.create(
+            chat_completion = await _create_chat_completion(
+                deadline,
+                {"agent_id": agent_id_in_flow, "flow_id": flow_config.id},
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": actual_system_prompt_step},
@@ -539,36 +772,387 @@ async def invoke_flow_endpoint(
             )
             agent_text_response = chat_completion.choices[0].message.content if chat_completion.choices and chat_completion.choices[0].message.content else "No se recibió respuesta del agente."
             print(f"    Output Respuesta: {agent_text_response[:100]}...")
+            if cache_scope and chat_completion.choices and chat_completion.choices[0].message.content:
+                prompt_cache.store(cache_scope, current_input_prompt, agent_text_response)
 
+        except InvocationCancelled:
+            raise
         except Exception as e:
-            error_message = f"Error al invocar al agente '{agent_config_db_step.name}' (ID: {agent_id_in_flow}) en el paso {i+1} del flujo: {str(e)}"
+            error_message = f"Error al invocar al agente '{agent_config_step.name}' (ID: {agent_id_in_flow}) en el paso {i+1} del flujo: {str(e)}"
             print(f"ERROR: {error_message}")
             log_steps.append(schemas.FlowInvokeLogStep(
-                agent_id=agent_id_in_flow, agent_name=agent_config_db_step.name,
+                agent_id=agent_id_in_flow, agent_name=agent_config_step.name,
                 input_prompt=current_input_prompt, output_response=f"ERROR: {error_message}",
                 system_prompt_used=actual_system_prompt_step
             ))
             raise HTTPException(status_code=500, detail=error_message)
 
         log_steps.append(schemas.FlowInvokeLogStep(
-            agent_id=agent_id_in_flow, agent_name=agent_config_db_step.name,
+            agent_id=agent_id_in_flow, agent_name=agent_config_step.name,
             input_prompt=current_input_prompt, output_response=agent_text_response,
             system_prompt_used=actual_system_prompt_step
         ))
 
         current_input_prompt = agent_text_response
         final_flow_output = agent_text_response
-    
-    print(f"--- Invocación de Flujo '{flow_config_db.name}' Finalizada ---")
+
+    return final_flow_output
+
+
+# --- Sesión WebSocket de chat con un agente ---
+# Protocolo (JSON):
+#   cliente -> {"type": "message", "content": "..."} | {"type": "cancel"} | {"type": "ping"}
+#   servidor -> session | tool_call | tool_result | message | turn_cancelled | error | pong
+@app.websocket("/api/v1/agents/{agent_id}/session")
+async def agent_session_websocket(websocket: WebSocket, agent_id: str):
+    await websocket.accept()
+    # Reservar la plaza antes de cualquier await: si no, conexiones simultáneas pasarían todas el límite
+    if not session_registry.reserve():
+        session_registry.count("rejected_capacity")
+        await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER, reason="Límite de sesiones alcanzado en este worker.")
+        return
+    session = None
+    try:
+        if not llm.client:
+            await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER, reason="Cliente de OpenAI no inicializado.")
+            return
+
+        # La configuración del agente se resuelve una sola vez para toda la sesión
+        agent_config = await config_cache.get_agent(agent_id)
+        if not agent_config:
+            await websocket.close(code=WS_CLOSE_POLICY, reason=f"Agente con ID '{agent_id}' no encontrado.")
+            return
+        agent_enabled_tool_names = list(agent_config.tools_enabled)
+        session = AgentSession(
+            websocket, agent_config.id, agent_config.name, agent_config.system_prompt,
+            list(agent_config.tools), agent_config.timeout_seconds,
+            agent_config.max_tool_rounds, agent_config.max_tool_result_chars,
+        )
+    finally:
+        if session is None: # Cualquier salida anticipada (o error) devuelve la plaza reservada
+            session_registry.release_reservation()
+    session_registry.register(session)
+    session.start()
+    print(f"Sesión WebSocket {session.session_id} abierta con el agente '{session.agent_name}' (ID: {agent_id})")
+
+    turn_task: Optional[asyncio.Task] = None
+    close_code, close_reason = WS_CLOSE_NORMAL, ""
+    try:
+        await session.send({
+            "type": "session", "session_id": session.session_id, "agent_id": session.agent_id,
+            "agent_name": session.agent_name, "tools": agent_enabled_tool_names,
+        })
+        while True:
+            try:
+                data = await asyncio.wait_for(websocket.receive_json(), timeout=WS_IDLE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                if turn_task and not turn_task.done():
+                    continue # Un turno largo en curso no cuenta como inactividad
+                session_registry.count("closed_idle")
+                close_reason = "Sesión cerrada por inactividad."
+                break
+            session.last_activity = time.monotonic()
+            message_type = data.get("type") if isinstance(data, dict) else None
+
+            if message_type == "message":
+                content = data.get("content")
+                if not isinstance(content, str) or not content.strip():
+                    session.emit({"type": "error", "detail": "El mensaje debe tener un 'content' no vacío."})
+                elif turn_task and not turn_task.done():
+                    session.emit({"type": "error", "detail": "Ya hay un turno en curso; espera la respuesta o envía 'cancel'."})
+                else:
+                    turn_task = asyncio.create_task(_run_session_turn(session, content))
+            elif message_type == "cancel":
+                if turn_task and not turn_task.done():
+                    turn_task.cancel()
+            elif message_type == "ping":
+                session.emit({"type": "pong"})
+            else:
+                session.emit({"type": "error", "detail": f"Tipo de mensaje no soportado: {message_type!r}."})
+    except SlowConsumer:
+        session_registry.count("closed_slow_consumer")
+        close_code, close_reason = WS_CLOSE_POLICY, "El cliente no consume los mensajes a tiempo."
+    except SessionClosed:
+        pass # El envío falló: el cliente ya no está (se cuenta abajo)
+    except ValueError: # JSON inválido
+        close_code, close_reason = WS_CLOSE_POLICY, "Mensaje JSON no válido."
+    except (WebSocketDisconnect, RuntimeError):
+        pass # El cliente cerró la conexión (o la cerró un turno por cliente lento)
+    finally:
+        if turn_task and not turn_task.done():
+            turn_task.cancel() # Sin cliente no tiene sentido seguir gastando cuota del LLM
+        if session.send_failed:
+            session_registry.count("closed_send_failed")
+        session_registry.unregister(session)
+        await session.close(close_code, close_reason)
+        print(f"Sesión WebSocket {session.session_id} cerrada. {close_reason}")
+
+async def _run_session_turn(session: AgentSession, user_prompt: str) -> None:
+    messages = session.build_messages(user_prompt)
+    history_start = len(messages) - 1 # Desde el mensaje del usuario
+    deadline = resolve_deadline(None, session.timeout_seconds)
+    progress = {"llm_calls": 0, "tool_calls": [], "final_content": None, "rounds": []}
+    try:
+        # Sin `connection`: si el cliente se va, el turno entero se cancela al cerrar la sesión
+        async with admission_controller.slot(classify_request(session.websocket), deadline=deadline):
+            agent_text_response = await asyncio.wait_for(
+                _run_agent_conversation(
+                    messages, session.tools, deadline, progress,
+                    {"agent_id": session.agent_id, "flow_id": None}, on_event=session.emit,
+                    max_tool_rounds=session.max_tool_rounds, max_tool_result_chars=session.max_tool_result_chars
+                ),
+                timeout=deadline.remaining()
+            )
+        session.commit_turn(messages, history_start, agent_text_response)
+        session_registry.count("turns")
+        await session.send({
+            "type": "message", "content": agent_text_response,
+            "llm_calls": progress["llm_calls"], "tool_calls": progress["tool_calls"], "rounds": progress["rounds"],
+        })
+    except asyncio.CancelledError:
+        session.emit({"type": "turn_cancelled", "reason": "cancelled"})
+        raise
+    except (asyncio.TimeoutError, InvocationCancelled):
+        session.emit({"type": "turn_cancelled", "reason": "deadline"})
+    except HTTPException as e:
+        session.emit({"type": "error", "status_code": e.status_code, "detail": e.detail})
+    except SlowConsumer:
+        session_registry.count("closed_slow_consumer")
+        await session.close(WS_CLOSE_POLICY, "El cliente no consume los mensajes a tiempo.")
+    except SessionClosed:
+        pass # El envío falló y el socket ya se cerró: el bucle de la sesión termina solo
+
+# --- Importación/Exportación Masiva (NDJSON) ---
+@app.get("/api/v1/bulk/export")
+async def bulk_export_endpoint(kinds: str = "agent,flow"):
+    """Exporta agentes y/o flujos como NDJSON, en streaming desde un cursor de servidor."""
+    requested = {kind.strip() for kind in kinds.split(",") if kind.strip()}
+    if not requested or not requested <= {"agent", "flow"}:
+        raise HTTPException(status_code=400, detail="kinds debe contener 'agent' y/o 'flow'.")
+    return StreamingResponse(export_ndjson(sorted(requested)), media_type="application/x-ndjson")
+
+@app.post("/api/v1/bulk/import", response_model=schemas.BulkImportResult)
+async def bulk_import_endpoint(request: Request, mode: str = "insert"):
+    """
+    Importa NDJSON (las líneas de /bulk/export). mode=upsert actualiza los registros con el mismo id.
+    Las líneas inválidas se descartan y se informan; un error de BD detiene la importación
+    (los lotes ya confirmados se mantienen).
+    """
+    if mode not in ("insert", "upsert"):
+        raise HTTPException(status_code=400, detail="mode debe ser 'insert' o 'upsert'.")
+    report = await BulkImporter(upsert=mode == "upsert").run(request.stream())
+    print(f"Importación masiva: {report['agents']} agentes, {report['flows']} flujos, {report['invalid']} líneas inválidas.")
+    return report
+
+# --- Administración: peticiones lentas y perfiles (requieren X-Admin-Token) ---
+@app.get("/api/v1/admin/slow-requests", dependencies=[Depends(require_admin_token)])
+async def list_slow_requests_endpoint(limit: int = 50):
+    """Desglose por fases (BD, LLM, herramientas, codificación) de las peticiones más lentas que el umbral."""
+    return list_slow_requests(limit)
+
+@app.get("/api/v1/admin/profiles", dependencies=[Depends(require_admin_token)])
+async def list_profiles_endpoint():
+    return list_profiles()
+
+@app.get("/api/v1/admin/profiles/{profile_id}", dependencies=[Depends(require_admin_token)])
+async def get_profile_endpoint(profile_id: str):
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Perfil '{profile_id}' no encontrado (puede haber sido descartado).")
+    return profile
+
+@app.get("/api/v1/ws/stats")
+async def get_ws_session_stats_endpoint():
+    return session_registry.stats()
+
+
+# --- Endpoint de Invocación de Flujo (AHORA CON BD) ---
+@app.post("/api/v1/flows/{flow_id}/invoke", response_model=schemas.FlowInvokeResponse, response_model_exclude_none=True)
+@profiled_handler
+async def invoke_flow_endpoint(
+    flow_id: str,
+    request_data: schemas.FlowInvokeRequest, # Corregido a schemas.FlowInvokeRequest
+    request: Request,
+    x_request_timeout: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+):
+    async def execute(connection):
+        return await _invoke_flow(flow_id, request_data, connection, x_request_timeout, classify_request(request, flow_id))
+
+    if not idempotency_key:
+        return await execute(request)
+    return await idempotency_store.run(f"flow_invoke:{flow_id}", idempotency_key, request_data.model_dump(), request, execute)
+
+async def _invoke_flow(
+    flow_id: str,
+    request_data: schemas.FlowInvokeRequest,
+    connection: Any, # Request o SharedConnection: su desconexión cancela la invocación
+    x_request_timeout: Optional[str],
+    priority_class: str,
+) -> schemas.FlowInvokeResponse:
+    if not llm.client:
+        raise HTTPException(status_code=500, detail="Cliente de OpenAI no inicializado.")
+
+    # El flujo y sus agentes salen de la caché de configuración; lo que falte se carga con
+    # sesiones cortas de lectura (una consulta IN para los agentes). Durante las llamadas al
+    # LLM no se retiene ninguna conexión del pool.
+    flow_config = await config_cache.get_flow(flow_id)
+    if not flow_config:
+        raise HTTPException(status_code=404, detail=f"Flujo con ID '{flow_id}' no encontrado.")
+    agents_by_id = await config_cache.get_agents(flow_config.agent_ids)
+
+    for agent_id_in_flow in flow_config.agent_ids:
+        if agent_id_in_flow not in agents_by_id:
+            error_detail = f"Configuración del Agente ID '{agent_id_in_flow}' no encontrada."
+            print(f"ERROR: {error_detail}")
+            raise HTTPException(status_code=500, detail=error_detail)
+
+    deadline = resolve_deadline(x_request_timeout, flow_config.timeout_seconds)
+    log_steps: List[schemas.FlowInvokeLogStep] = []
+
+    print(f"\n--- Iniciando Invocación de Flujo: {flow_config.name} (ID: {flow_id}, plazo: {deadline.seconds:.0f}s) ---")
+    print(f"Prompt Inicial del Usuario: {request_data.initial_user_prompt}")
+
+    try:
+        async with admission_controller.slot(priority_class, connection, deadline): # Ver _invoke_agent
+            final_flow_output = await run_cancellable(
+                connection, _run_flow_steps(flow_config, agents_by_id, request_data.initial_user_prompt, deadline, log_steps), deadline
+            )
+    except InvocationCancelled as e:
+        steps = [
+            {"agent_id": step.agent_id, "agent_name": step.agent_name, "output_response": step.output_response, "status": "completed"}
+            for step in log_steps
+        ]
+        steps += [
+            {"agent_id": pending_agent_id, "status": "cancelled"}
+            for pending_agent_id in flow_config.agent_ids[len(log_steps):]
+        ]
+        invocation_id = record_cancelled("flow", flow_id, e.reason, steps)
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=f"Invocación del flujo '{flow_config.name}' cancelada ({e.reason}) tras {len(log_steps)} de {len(flow_config.agent_ids)} pasos. ID de invocación: {invocation_id}"
+        )
+
+    print(f"--- Invocación de Flujo '{flow_config.name}' Finalizada ---")
+    log, system_prompts = _compact_flow_log(log_steps, request_data.verbosity)
     return schemas.FlowInvokeResponse(
         final_output=final_flow_output,
         flow_id=flow_id,
-        flow_name=flow_config_db.name,
-        log=log_steps
+        flow_name=flow_config.name,
+        log=log,
+        system_prompts=system_prompts
+    )
+
+def _compact_flow_log(log_steps: List[schemas.FlowInvokeLogStep], verbosity: str):
+    """
+    Reduce el log según `verbosity`. Cada system prompt se envía una sola vez (por agent_id)
+    y la entrada solo en el primer paso, ya que la de los demás es la salida del anterior.
+    """
+    if verbosity == "final":
+        return None, None
+    log = [
+        schemas.FlowInvokeLogStep.model_construct(
+            agent_id=step.agent_id, agent_name=step.agent_name, output_response=step.output_response,
+            input_prompt=step.input_prompt if verbosity == "full" and i == 0 else None, system_prompt_used=None
+        )
+        for i, step in enumerate(log_steps)
+    ]
+    if verbosity == "steps":
+        return log, None
+    return log, {step.agent_id: step.system_prompt_used for step in log_steps}
+
+@app.get("/api/v1/admission/stats")
+async def get_admission_stats_endpoint():
+    """Profundidad de cola, invocaciones en curso, tiempos de espera y descartes por clase de prioridad."""
+    return admission_controller.stats()
+
+# --- Endpoints de Consumo de Tokens y Coste (leen de los agregados horarios) ---
+@app.get("/api/v1/usage/top", response_model=List[schemas.UsageTopEntry])
+async def get_usage_top_endpoint(dimension: str = "agent", hours: int = 24, limit: int = 10):
+    """Mayores consumidores (por coste estimado) en las últimas `hours` horas, por agente o por flujo."""
+    if dimension not in ("agent", "flow"):
+        raise HTTPException(status_code=400, detail="dimension debe ser 'agent' o 'flow'.")
+    table = db_models.LLMUsageHourly
+    group_column = table.agent_id if dimension == "agent" else table.flow_id
+    stmt = (
+        select(
+            group_column.label("id"),
+            func.sum(table.calls).label("calls"),
+            func.sum(table.prompt_tokens).label("prompt_tokens"),
+            func.sum(table.completion_tokens).label("completion_tokens"),
+            func.sum(table.cost_usd).label("cost_usd"),
+            func.sum(table.latency_ms_total).label("latency_ms_total"),
+        )
+        .where(table.hour >= datetime.utcnow() - timedelta(hours=hours))
+        .group_by(group_column)
+        .order_by(func.sum(table.cost_usd).desc(), func.sum(table.prompt_tokens + table.completion_tokens).desc())
+        .limit(limit)
     )
+    if dimension == "flow":
+        stmt = stmt.where(table.flow_id != NO_FLOW_ID)
+    async with read_session() as db:
+        rows = (await db.execute(stmt)).all()
+    return [
+        schemas.UsageTopEntry(
+            id=row.id, calls=row.calls, prompt_tokens=row.prompt_tokens, completion_tokens=row.completion_tokens,
+            cost_usd=round(row.cost_usd, 6), avg_latency_ms=round(row.latency_ms_total / row.calls, 1) if row.calls else 0.0
+        )
+        for row in rows
+    ]
+
+@app.get("/api/v1/usage/timeseries", response_model=List[schemas.UsageTimeseriesPoint])
+async def get_usage_timeseries_endpoint(hours: int = 24, agent_id: Optional[str] = None, flow_id: Optional[str] = None):
+    """Serie horaria de consumo, opcionalmente filtrada por agente y/o flujo."""
+    table = db_models.LLMUsageHourly
+    stmt = (
+        select(
+            table.hour,
+            func.sum(table.calls).label("calls"),
+            func.sum(table.prompt_tokens).label("prompt_tokens"),
+            func.sum(table.completion_tokens).label("completion_tokens"),
+            func.sum(table.cost_usd).label("cost_usd"),
+        )
+        .where(table.hour >= datetime.utcnow() - timedelta(hours=hours))
+        .group_by(table.hour)
+        .order_by(table.hour)
+    )
+    if agent_id:
+        stmt = stmt.where(table.agent_id == agent_id)
+    if flow_id:
+        stmt = stmt.where(table.flow_id == flow_id)
+    async with read_session() as db:
+        rows = (await db.execute(stmt)).all()
+    return [
+        schemas.UsageTimeseriesPoint(
+            hour=row.hour, calls=row.calls, prompt_tokens=row.prompt_tokens,
+            completion_tokens=row.completion_tokens, cost_usd=round(row.cost_usd, 6)
+        )
+        for row in rows
+    ]
+
+@app.get("/api/v1/usage/recorder/stats")
+async def get_usage_recorder_stats_endpoint():
+    return usage_recorder.stats()
+
+@app.get("/api/v1/metrics/db-pool")
+async def get_db_pool_metrics_endpoint():
+    """Estado del pool, espera para obtener conexión y duración de cada préstamo (checkout)."""
+    return pool_metrics.snapshot()
+
+@app.get("/api/v1/idempotency/stats")
+async def get_idempotency_stats_endpoint():
+    return idempotency_store.stats()
+
+@app.get("/api/v1/invocations/cancelled")
+async def list_cancelled_invocations_endpoint(limit: int = 50):
+    """Invocaciones canceladas recientemente (plazo vencido o cliente desconectado) con su progreso parcial."""
+    return list_cancelled(limit)
+
+# Las herramientas solo cambian con un despliegue: su ETag se calcula una vez
+TOOLS_ETAG = weak_etag([json.dumps(AVAILABLE_TOOLS_SCHEMAS, sort_keys=True)])
 
 @app.get("/api/v1/tools/available", response_model=List[schemas.AvailableTool])
-async def list_available_tools():
+async def list_available_tools(request: Request, response: Response):
     """
     Devuelve una lista de todas las herramientas disponibles en el sistema
     con sus descripciones y esquemas de parámetros.
@@ -582,14 +1166,43 @@ async def list_available_tools():
     # Simplemente devolvemos la constante que ya tenemos
     # Pydantic validará si su estructura coincide con List[schemas.AvailableTool]
     # Si no coincide, levantará un error en el servidor, lo cual es bueno para desarrollo.
+    cached = not_modified(request, TOOLS_ETAG)
+    if cached is not None:
+        return cached
+    set_etag(response, TOOLS_ETAG)
     return AVAILABLE_TOOLS_SCHEMAS
 
+@app.get("/api/v1/tools/cache/stats")
+async def get_tool_cache_stats_endpoint():
+    """Aciertos, fallos y llamadas agrupadas de la caché de resultados, por herramienta."""
+    return tool_result_cache.stats()
+
+@app.delete("/api/v1/tools/cache", status_code=204)
+async def clear_tool_cache_endpoint():
+    tool_result_cache.clear()
+    return
+
+# --- Endpoints de la Caché de Prompts Casi Duplicados ---
+@app.get("/api/v1/cache/prompts/stats", response_model=schemas.PromptCacheStats)
+async def get_prompt_cache_stats_endpoint():
+    return prompt_cache.stats()
+
+@app.get("/api/v1/cache/prompts/audit", response_model=List[schemas.PromptCacheAuditEntry])
+async def get_prompt_cache_audit_endpoint(limit: int = 100):
+    """Últimas reutilizaciones de la caché: qué prompt se sirvió con qué entrada y con qué similitud."""
+    return prompt_cache.audit_log(limit)
+
+@app.delete("/api/v1/cache/prompts", status_code=204)
+async def clear_prompt_cache_endpoint():
+    prompt_cache.clear()
+    return
+
 
 @app.put("/api/v1/flows/{flow_id}", response_model=schemas.Flow)
 async def update_flow_endpoint(
     flow_id: str,
     flow_data: schemas.FlowUpdate,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_flow = await db.get(db_models.Flow, flow_id)
     if not db_flow:
@@ -609,12 +1222,13 @@ async def update_flow_endpoint(
     db.add(db_flow)
     await db.flush()
     await db.refresh(db_flow)
+    on_commit(db, lambda: config_cache.invalidate_flow(flow_id))
     return db_flow
 
 @app.delete("/api/v1/flows/{flow_id}", status_code=204)
 async def delete_flow_endpoint(
     flow_id: str,
-    db: AsyncSession = Depends(get_db_session)
+    db: AsyncSession = Depends(get_db_session, scope="function")
 ):
     db_flow = await db.get(db_models.Flow, flow_id)
     if not db_flow:
@@ -622,13 +1236,86 @@ async def delete_flow_endpoint(
     
     await db.delete(db_flow)
     await db.flush()
+    on_commit(db, lambda: config_cache.invalidate_flow(flow_id))
     return
 
 
+# --- Sondas de salud ---
+@app.get("/healthz")
+async def healthz_endpoint():
+    """Liveness: el proceso responde. No comprueba dependencias."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz_endpoint():
+    """Readiness: arranque terminado, BD accesible y cliente del LLM inicializado."""
+    checks = {"startup": bool(getattr(app.state, "ready", False)), "llm_client": llm.client is not None}
+    try:
+        await ping_database()
+        checks["database"] = True
+    except Exception as e:
+        print(f"readyz: la BD no responde: {e}")
+        checks["database"] = False
+    body = {
+        "status": "ready" if all(checks.values()) else "not_ready",
+        "checks": checks,
+        "startup_seconds": getattr(app.state, "startup_seconds", None),
+        "startup_budget_seconds": settings.STARTUP_BUDGET_SECONDS,
+        "startup_over_budget": getattr(app.state, "startup_over_budget", None),
+        "startup_timings": getattr(app.state, "startup_timings", None),
+    }
+    return FastJSONResponse(content=body, status_code=200 if all(checks.values()) else 503)
+
+# --- Sincronización incremental del frontend ---
+# Carga inicial con /bootstrap (todo en una petición) y después solo los cambios con /changes?since=<version>.
+
+CHANGES_MAX_LIMIT = 5000
+
+def _list_etag(kind: str, skip: int, limit: int, items) -> str:
+    return weak_etag([kind, skip, limit, *(f"{item.id}:{item.version}" for item in items)])
+
+@app.get("/api/v1/changes", response_model=schemas.ChangesResponse)
+async def get_changes_endpoint(
+    since: int = 0, limit: int = 1000, db: AsyncSession = Depends(get_read_db_session)
+):
+    """
+    Agentes y flujos creados/modificados y IDs borrados desde la versión `since`.
+    Si has_more es true, repetir con since=version. Si full_resync_required es true, volver a /bootstrap.
+    """
+    return await change_log.changes_since(db, since, max(1, min(limit, CHANGES_MAX_LIMIT)))
+
+@app.get("/api/v1/bootstrap", response_model=schemas.BootstrapResponse)
+@profiled_handler
+async def get_bootstrap_endpoint(
+    request: Request, response: Response,
+    limit: int = 1000, db: AsyncSession = Depends(get_read_db_session)
+):
+    """Estado inicial del frontend en una sola petición: mensaje de estado, agentes, flujos, herramientas y versión."""
+    # La versión se toma antes de leer las listas: lo que cambie entre medias llegará (repetido) por /changes
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
+    version = await change_log.settled_version(db)
+    agents = (await db.execute(select(db_models.Agent).order_by(db_models.Agent.name).limit(limit))).scalars().all()
+    flows = (await db.execute(select(db_models.Flow).order_by(db_models.Flow.name).limit(limit))).scalars().all()
+    message = _root_message()
+    etag = weak_etag([message, TOOLS_ETAG, version, _list_etag("agents", 0, limit, agents), _list_etag("flows", 0, limit, flows)])
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    set_etag(response, etag)
+    return {"message": message, "version": version, "agents": agents, "flows": flows, "tools": AVAILABLE_TOOLS_SCHEMAS}
+
+@app.get("/api/v1/cache/configs/stats")
+async def get_config_cache_stats_endpoint():
+    return config_cache.stats()
+
+
 # --- Endpoints de / y /saludo (sin cambios) ---
+def _root_message() -> str:
+    return f"API del Gestor Multiagentes v{app.version}. Persistencia: MySQL. Estado OpenAI: {'OK' if llm.client and llm.client.api_key else 'ERROR'}"
+
 @app.get("/")
 async def get_root_endpoint(): # Renombrado
-    return {"message": f"API del Gestor Multiagentes v{app.version}. Persistencia: MySQL. Estado OpenAI: {'OK' if client and client.api_key else 'ERROR'}"}
+    return {"message": _root_message()}
 
 @app.get("/saludo/{nombre}")
 async def get_saludo_endpoint(nombre: str): # Renombrado
@@ -1,18 +1,25 @@
 # backend/schemas.py
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict # Dict no se usa aquí pero es común
+from typing import List, Optional, Dict, Literal # Dict no se usa aquí pero es común
+from datetime import datetime
 
 # --- Esquemas para Agentes ---
 class AgentBase(BaseModel):
     name: str = Field(min_length=3, max_length=100)
     system_prompt: str = Field(min_length=10)
     tools_enabled: Optional[List[str]] = Field(default_factory=list, description="Lista de nombres de herramientas habilitadas para este agente.") # NUEVO
+    semantic_cache_threshold: Optional[float] = Field(None, ge=0.5, le=1.0, description="Similitud mínima para reutilizar respuestas de prompts casi duplicados. None desactiva la caché.")
+    timeout_seconds: Optional[int] = Field(None, ge=1, le=3600, description="Plazo por defecto de una invocación (segundos). La cabecera X-Request-Timeout tiene prioridad.")
+    max_tool_rounds: Optional[int] = Field(None, ge=1, le=20, description="Máximo de rondas de llamadas a herramientas por invocación. None usa DEFAULT_MAX_TOOL_ROUNDS.")
+    max_tool_result_chars: Optional[int] = Field(None, ge=200, le=100000, description="Tamaño máximo de cada resultado de herramienta que se devuelve al modelo; lo que sobre se recorta. None usa DEFAULT_MAX_TOOL_RESULT_CHARS.")
 
 class AgentCreate(AgentBase):
     pass
 
 class Agent(AgentBase): # Esquema para devolver un agente (incluye ID)
     id: str
+    version: Optional[int] = None # Versión del último cambio (ver /api/v1/changes)
+    updated_at: Optional[datetime] = None
 
     class Config: # Pydantic V1
         from_attributes = True # Permite a Pydantic mapear desde modelos ORM
@@ -24,12 +31,15 @@ class FlowBase(BaseModel):
     name: str = Field(min_length=3, max_length=150)
     description: Optional[str] = Field(None, max_length=255)
     agent_ids: List[str] = Field(min_length=1)
+    timeout_seconds: Optional[int] = Field(None, ge=1, le=3600, description="Plazo por defecto de una invocación (segundos). La cabecera X-Request-Timeout tiene prioridad.")
 
 class FlowCreate(FlowBase):
     pass
 
 class Flow(FlowBase): # Esquema para devolver un flujo (incluye ID)
     id: str
+    version: Optional[int] = None
+    updated_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -40,20 +50,33 @@ class AgentInvokeRequest(BaseModel):
     system_prompt: Optional[str] = None
     user_prompt: str
 
+class AgentToolRound(BaseModel):
+    round: int
+    prompt_tokens: Optional[int] = None # usage.prompt_tokens de la llamada al LLM de esta ronda
+    prompt_tokens_added: Optional[int] = None # Respecto a la ronda anterior (respuesta + resultados de herramientas)
+    tool_calls: int = 0
+    truncated_tool_results: int = 0
+
 class AgentInvokeResponse(BaseModel):
     agent_response: str
     used_system_prompt: str
+    rounds: Optional[List[AgentToolRound]] = None # Sin valor si la respuesta salió de la caché de prompts
 
 # --- Esquemas para Invocación de Flujo ---
 class FlowInvokeRequest(BaseModel):
     initial_user_prompt: str
+    # "final": solo la salida final. "steps": además la salida de cada paso.
+    # "full": log completo, con los system prompts referenciados por agent_id en lugar de copiados.
+    verbosity: Literal["final", "steps", "full"] = "full"
 
 class FlowInvokeLogStep(BaseModel):
     agent_id: str
     agent_name: str
-    input_prompt: str
     output_response: str
-    system_prompt_used: str
+    # Solo en el primer paso (verbosity "full"): la entrada de cada paso es la salida del anterior
+    input_prompt: Optional[str] = None
+    # Solo de uso interno; en la respuesta los prompts van en FlowInvokeResponse.system_prompts
+    system_prompt_used: Optional[str] = None
 
     class Config:
         from_attributes = True # Si alguna vez creamos un modelo ORM para LogStep
@@ -62,7 +85,8 @@ class FlowInvokeResponse(BaseModel):
     final_output: str
     flow_id: str
     flow_name: str
-    log: List[FlowInvokeLogStep]
+    log: Optional[List[FlowInvokeLogStep]] = None # Ausente con verbosity "final"
+    system_prompts: Optional[Dict[str, str]] = None # agent_id -> system prompt, solo con verbosity "full"
 
 # --- NUEVO: Esquema para Herramientas Disponibles ---
 class ToolDefinition(BaseModel):
@@ -79,9 +103,85 @@ class AgentUpdate(AgentBase): # Opcional: puedes crear uno nuevo si los campos v
     name: Optional[str] = Field(None, min_length=3, max_length=100)
     system_prompt: Optional[str] = Field(None, min_length=10)
     tools_enabled: Optional[List[str]] = Field(None, description="Lista de nombres de herramientas habilitadas para este agente.")
+    semantic_cache_threshold: Optional[float] = Field(None, ge=0.5, le=1.0)
+    timeout_seconds: Optional[int] = Field(None, ge=1, le=3600)
+    max_tool_rounds: Optional[int] = Field(None, ge=1, le=20)
+    max_tool_result_chars: Optional[int] = Field(None, ge=200, le=100000)
 
 # --- Esquemas para Actualización de Flujos ---
 class FlowUpdate(FlowBase): # Opcional: puedes crear uno nuevo
     name: Optional[str] = Field(None, min_length=3, max_length=150)
     description: Optional[str] = Field(None, max_length=255)
-    agent_ids: Optional[List[str]] = Field(None, min_length=1)
\ No newline at end of file
+    agent_ids: Optional[List[str]] = Field(None, min_length=1)
+    timeout_seconds: Optional[int] = Field(None, ge=1, le=3600)
+
+# --- Esquemas para la Caché de Prompts ---
+class PromptCacheStats(BaseModel):
+    enabled: bool
+    capacity: int
+    entries: int
+    num_perm: int
+    ttl_seconds: float
+    index_bytes: int
+    hit_rate: float
+    lookups: int
+    exact_hits: int
+    similar_hits: int
+    misses: int
+    stores: int
+    evictions: int
+
+class PromptCacheAuditEntry(BaseModel):
+    timestamp: float
+    owner_id: str
+    entry_id: str
+    similarity: float
+    threshold: float
+    prompt_preview: str
+    cached_prompt_preview: str
+
+# --- Esquemas para Consumo de Tokens y Coste ---
+class UsageTopEntry(BaseModel):
+    id: str # agent_id o flow_id según la dimensión
+    calls: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+    avg_latency_ms: float
+
+class UsageTimeseriesPoint(BaseModel):
+    hour: datetime
+    calls: int
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+
+# --- Esquemas para Importación/Exportación Masiva ---
+class BulkImportError(BaseModel):
+    line: int
+    error: str
+
+class BulkImportResult(BaseModel):
+    agents: int # Agentes insertados (o actualizados con mode=upsert)
+    flows: int
+    chunks_committed: int
+    invalid: int # Líneas descartadas por validación o referencias no resueltas
+    errors: List[BulkImportError] # Como mucho las 100 primeras
+    aborted: Optional[str] = None # Error de BD que detuvo la importación (los lotes anteriores quedan guardados)
+
+# --- Esquemas para Sincronización Incremental ---
+class ChangesResponse(BaseModel):
+    version: int # Pasar como `since` en la siguiente llamada
+    has_more: bool
+    full_resync_required: bool = False # La versión del cliente no existe en el servidor: recargar con /bootstrap
+    agents: List[Agent] # Creados o modificados
+    flows: List[Flow]
+    deleted_agent_ids: List[str]
+    deleted_flow_ids: List[str]
+
+class BootstrapResponse(BaseModel):
+    message: str
+    version: int # Punto de partida para /api/v1/changes
+    agents: List[Agent]
+    flows: List[Flow]
+    tools: List[AvailableTool]
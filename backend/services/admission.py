@@ -0,0 +1,231 @@
+# backend/services/admission.py
+# Control de admisión delante de los endpoints de invocación.
+# Limita cuántas invocaciones corren a la vez, encola el resto en colas acotadas por clase
+# de prioridad (interactive antes que batch) y descarta con 429 + Retry-After cuando la
+# espera en cola supera el máximo de su clase, o de entrada si la espera estimada (duración
+# media reciente de las invocaciones x posición en la cola / slots) ya lo supera. Así la latencia
+# interactiva se mantiene predecible aunque haya trabajo batch en curso.
+# La espera en cola cuenta dentro del plazo de la invocación y se abandona si el cliente se
+# desconecta (InvocationCancelled, igual que durante la ejecución).
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, Request
+
+from .cancellation import Deadline, InvocationCancelled, wait_for_disconnect
+
+PRIORITY_CLASSES = ("interactive", "batch") # En orden de prioridad
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+# Fracción de los slots que puede ocupar el trabajo batch; el resto queda reservado para interactive
+ADMISSION_BATCH_MAX_SHARE = float(os.getenv("ADMISSION_BATCH_MAX_SHARE", "0.5"))
+ADMISSION_MAX_QUEUE_TIME_SECONDS = {
+    "interactive": float(os.getenv("ADMISSION_MAX_QUEUE_TIME_INTERACTIVE", "5")),
+    "batch": float(os.getenv("ADMISSION_MAX_QUEUE_TIME_BATCH", "60")),
+}
+
+PRIORITY_HEADER = "X-Priority"
+API_KEY_HEADER = "X-API-Key"
+
+
+def _parse_class_map(raw: str) -> Dict[str, str]:
+    """Convierte 'clave1:batch,clave2:interactive' en un diccionario, ignorando clases desconocidas."""
+    mapping = {}
+    for item in raw.split(","):
+        key, _, priority_class = item.strip().rpartition(":")
+        if key and priority_class in PRIORITY_CLASSES:
+            mapping[key] = priority_class
+    return mapping
+
+ADMISSION_API_KEY_CLASSES = _parse_class_map(os.getenv("ADMISSION_API_KEY_CLASSES", ""))
+ADMISSION_FLOW_CLASSES = _parse_class_map(os.getenv("ADMISSION_FLOW_CLASSES", ""))
+
+
+def classify_request(request: Request, flow_id: Optional[str] = None) -> str:
+    """
+    Clase de prioridad de una invocación: primero la configurada para el flujo, luego la de
+    la API key y por defecto interactive. El cliente puede rebajarse a batch con X-Priority,
+    pero nunca subir de clase.
+    """
+    priority_class = "interactive"
+    api_key = request.headers.get(API_KEY_HEADER)
+    if flow_id and flow_id in ADMISSION_FLOW_CLASSES:
+        priority_class = ADMISSION_FLOW_CLASSES[flow_id]
+    elif api_key and api_key in ADMISSION_API_KEY_CLASSES:
+        priority_class = ADMISSION_API_KEY_CLASSES[api_key]
+    if request.headers.get(PRIORITY_HEADER, "").lower() == "batch":
+        priority_class = "batch"
+    return priority_class
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int, max_queue: int, batch_max_share: float, max_queue_time: Dict[str, float]):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.batch_max_concurrent = max(1, int(max_concurrent * batch_max_share))
+        self.max_queue_time = max_queue_time
+        self._in_flight = {c: 0 for c in PRIORITY_CLASSES}
+        self._queues: Dict[str, deque] = {c: deque() for c in PRIORITY_CLASSES} # (future, encolado_en)
+        self._wait_times: Dict[str, deque] = {c: deque(maxlen=500) for c in PRIORITY_CLASSES}
+        self._service_times: deque = deque(maxlen=200)
+        self._counters = {c: {"admitted": 0, "shed_queue_full": 0, "shed_estimated_wait": 0, "shed_queue_time": 0, "cancelled_in_queue": 0} for c in PRIORITY_CLASSES}
+
+    def _total_in_flight(self) -> int:
+        return sum(self._in_flight.values())
+
+    def _total_queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _has_capacity(self, priority_class: str) -> bool:
+        if self._total_in_flight() >= self.max_concurrent:
+            return False
+        return priority_class != "batch" or self._in_flight["batch"] < self.batch_max_concurrent
+
+    def _avg_service_time(self) -> Optional[float]:
+        return sum(self._service_times) / len(self._service_times) if self._service_times else None
+
+    def _ahead(self, priority_class: str) -> int:
+        """Peticiones encoladas que se atenderán antes que una nueva de esta clase."""
+        return sum(len(self._queues[c]) for c in PRIORITY_CLASSES[:PRIORITY_CLASSES.index(priority_class) + 1])
+
+    def _estimated_wait(self, priority_class: str, ahead: int) -> Optional[float]:
+        """
+        Espera estimada de una petición nueva con `ahead` peticiones por delante. None sin datos aún.
+        Con los slots ocupados en momentos escalonados se libera uno cada duración_media / slots
+        de media, así que la petición en la posición `ahead` espera (ahead + 1) de esos intervalos.
+        """
+        avg_service = self._avg_service_time()
+        if avg_service is None:
+            return None
+        slots = self.batch_max_concurrent if priority_class == "batch" else self.max_concurrent
+        return avg_service * (ahead + 1) / slots
+
+    def _shed(self, priority_class: str, reason: str, detail: str) -> HTTPException:
+        self._counters[priority_class][reason] += 1
+        # Misma estimación que decide el descarte: reintentar antes no encontraría slot
+        retry_after = max(1, math.ceil(self._estimated_wait(priority_class, self._ahead(priority_class)) or 1.0))
+        print(f"Admisión: petición {priority_class} rechazada ({reason}). Retry-After: {retry_after}s")
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(retry_after)})
+
+    def _grant(self, priority_class: str, waited: float) -> None:
+        self._in_flight[priority_class] += 1
+        self._counters[priority_class]["admitted"] += 1
+        self._wait_times[priority_class].append(waited)
+
+    def _dispatch(self) -> None:
+        """Entrega los slots libres a los que esperan, siempre interactive antes que batch."""
+        for priority_class in PRIORITY_CLASSES:
+            queue = self._queues[priority_class]
+            while queue and self._has_capacity(priority_class):
+                future, enqueued_at = queue.popleft()
+                if future.done(): # Se rindió (timeout o desconexión) mientras esperaba
+                    continue
+                self._grant(priority_class, time.monotonic() - enqueued_at)
+                future.set_result(True)
+
+    async def acquire(self, priority_class: str, connection: Optional[Request] = None, deadline: Optional[Deadline] = None) -> None:
+        """
+        Espera un slot. `connection` (cualquier objeto con `is_disconnected()`) y `deadline` son
+        los de la invocación: si el cliente se va o el plazo vence en la cola, deja su sitio y
+        lanza InvocationCancelled.
+        """
+        queue = self._queues[priority_class]
+        # Sin nadie delante de igual o mayor prioridad y con capacidad: pasa directo
+        ahead = self._ahead(priority_class)
+        if ahead == 0 and self._has_capacity(priority_class):
+            self._grant(priority_class, 0.0)
+            return
+
+        if self._total_queued() >= self.max_queue:
+            raise self._shed(priority_class, "shed_queue_full", "Servidor saturado: la cola de invocaciones está llena.")
+        max_wait = self.max_queue_time[priority_class]
+        if deadline is not None:
+            deadline.check()
+            max_wait = min(max_wait, deadline.remaining())
+        estimated_wait = self._estimated_wait(priority_class, ahead)
+        if estimated_wait is not None and estimated_wait > max_wait:
+            # No va a conseguir slot a tiempo: mejor el 429 ahora que tras esperar max_wait
+            raise self._shed(priority_class, "shed_estimated_wait", f"Servidor saturado: espera estimada de {estimated_wait:.0f}s en cola.")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, time.monotonic())
+        queue.append(entry)
+        watcher = asyncio.ensure_future(wait_for_disconnect(connection)) if connection is not None else None
+        try:
+            # asyncio.wait (no wait_for): no cancela el future al vencer ni se traga la cancelación
+            # de quien espera si el slot llega a la vez
+            done, _ = await asyncio.wait([f for f in (future, watcher) if f is not None], timeout=max_wait, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            self._remove(priority_class, entry)
+            if future.done():
+                self.release(priority_class, 0.0) # Se le concedió el slot justo al cancelarse
+            else:
+                future.cancel()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        if future.done():
+            return
+        future.cancel() # _dispatch ya no se lo concederá
+        self._remove(priority_class, entry)
+        if watcher in done or (deadline is not None and deadline.expired):
+            self._counters[priority_class]["cancelled_in_queue"] += 1
+            raise InvocationCancelled("client_disconnected" if watcher in done else "deadline")
+        raise self._shed(priority_class, "shed_queue_time", f"Servidor saturado: sin slot libre tras {max_wait:.0f}s en cola.")
+
+    def _remove(self, priority_class: str, entry) -> None:
+        try:
+            self._queues[priority_class].remove(entry)
+        except ValueError:
+            pass
+
+    def release(self, priority_class: str, service_time: Optional[float] = None) -> None:
+        self._in_flight[priority_class] -= 1
+        if service_time:
+            self._service_times.append(service_time)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str, connection: Optional[Request] = None, deadline: Optional[Deadline] = None):
+        await self.acquire(priority_class, connection, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(priority_class, time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        classes = {}
+        for priority_class in PRIORITY_CLASSES:
+            waits = sorted(self._wait_times[priority_class])
+            classes[priority_class] = {
+                "in_flight": self._in_flight[priority_class],
+                "queue_depth": len(self._queues[priority_class]),
+                "max_queue_time_seconds": self.max_queue_time[priority_class],
+                "wait_avg_seconds": round(sum(waits) / len(waits), 4) if waits else 0.0,
+                "wait_p95_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 4) if waits else 0.0,
+                **self._counters[priority_class],
+            }
+        return {
+            "max_concurrent": self.max_concurrent,
+            "batch_max_concurrent": self.batch_max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self._total_in_flight(),
+            "queue_depth": self._total_queued(),
+            "classes": classes,
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    batch_max_share=ADMISSION_BATCH_MAX_SHARE,
+    max_queue_time=ADMISSION_MAX_QUEUE_TIME_SECONDS,
+)
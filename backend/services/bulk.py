@@ -0,0 +1,188 @@
+# backend/services/bulk.py
+# Importación/exportación masiva de agentes y flujos en NDJSON (un objeto JSON por línea,
+# con "kind": "agent" | "flow").
+# - Exportación: se lee con un cursor de servidor (stream + yield_per) y se va escribiendo
+#   línea a línea, así la memoria no crece con el tamaño del catálogo.
+# - Importación: se lee el cuerpo en streaming, se valida por lotes y cada lote se escribe
+#   en su propia transacción con INSERTs multi-fila (o upsert por id). Las referencias
+#   flujo -> agente se resuelven en una sola pasada: agentes ya importados en este mismo
+#   fichero más una consulta IN por lote para los que ya existían en la BD.
+import json
+import os
+from datetime import datetime
+from typing import Annotated, Any, AsyncIterator, Dict, List, Literal, Optional, Set, Union
+
+from pydantic import Field, TypeAdapter, ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from ..agent_tools.available_tools import AVAILABLE_TOOLS_SCHEMAS
+from ..db.change_log import record_bulk_changes
+from ..db.database import read_session, write_session
+from ..db import models as db_models
+from .. import schemas
+from .config_cache import config_cache
+
+BULK_IMPORT_CHUNK_SIZE = int(os.getenv("BULK_IMPORT_CHUNK_SIZE", "500"))
+BULK_EXPORT_BATCH_SIZE = int(os.getenv("BULK_EXPORT_BATCH_SIZE", "500"))
+BULK_MAX_REPORTED_ERRORS = 100
+
+AGENT_FIELDS = (
+    "id", "name", "system_prompt", "tools_enabled", "semantic_cache_threshold", "timeout_seconds",
+    "max_tool_rounds", "max_tool_result_chars",
+)
+FLOW_FIELDS = ("id", "name", "description", "agent_ids", "timeout_seconds")
+VALID_TOOL_NAMES = frozenset(tool_schema["function"]["name"] for tool_schema in AVAILABLE_TOOLS_SCHEMAS)
+
+
+class AgentBulkRecord(schemas.AgentBase):
+    kind: Literal["agent"]
+    id: Optional[str] = Field(None, min_length=1, max_length=36)
+
+class FlowBulkRecord(schemas.FlowBase):
+    kind: Literal["flow"]
+    id: Optional[str] = Field(None, min_length=1, max_length=36)
+
+# Validación de cada línea directamente desde JSON (sin json.loads intermedio)
+_record_adapter = TypeAdapter(Annotated[Union[AgentBulkRecord, FlowBulkRecord], Field(discriminator="kind")])
+
+
+# --- Exportación ---
+
+async def export_ndjson(kinds: List[str]) -> AsyncIterator[bytes]:
+    # Agentes primero: así el fichero se puede reimportar tal cual (los flujos referencian agentes)
+    exports = [("agent", db_models.Agent, AGENT_FIELDS), ("flow", db_models.Flow, FLOW_FIELDS)]
+    async with read_session() as db:
+        for kind, model, fields in exports:
+            if kind not in kinds:
+                continue
+            # Columnas sueltas en lugar de entidades: nada se acumula en la identity map
+            result = await db.stream(
+                select(*(getattr(model, field) for field in fields)).order_by(model.id)
+                .execution_options(yield_per=BULK_EXPORT_BATCH_SIZE)
+            )
+            async for rows in result.mappings().partitions():
+                yield "".join(
+                    json.dumps({"kind": kind, **row}, ensure_ascii=False) + "\n" for row in rows
+                ).encode("utf-8")
+
+
+# --- Importación ---
+
+async def _iter_lines(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    pending = b""
+    async for chunk in body:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _upsert_statement(dialect: str, model, rows: List[Dict[str, Any]], fields: tuple):
+    updatable = [field for field in fields if field != "id"] + ["updated_at"]
+    if dialect == "mysql":
+        stmt = mysql_insert(model).values(rows)
+        return stmt.on_duplicate_key_update({field: getattr(stmt.inserted, field) for field in updatable})
+    dialect_insert = postgresql_insert if dialect == "postgresql" else sqlite_insert
+    stmt = dialect_insert(model).values(rows)
+    return stmt.on_conflict_do_update(index_elements=["id"], set_={field: getattr(stmt.excluded, field) for field in updatable})
+
+
+class BulkImporter:
+    def __init__(self, upsert: bool):
+        self.upsert = upsert
+        self.known_agent_ids: Set[str] = set() # Agentes importados en esta misma petición
+        self.report = {"agents": 0, "flows": 0, "chunks_committed": 0, "invalid": 0, "errors": [], "aborted": None}
+
+    def _error(self, line_number: int, message: str) -> None:
+        self.report["invalid"] += 1
+        if len(self.report["errors"]) < BULK_MAX_REPORTED_ERRORS:
+            self.report["errors"].append({"line": line_number, "error": message})
+
+    async def run(self, body: AsyncIterator[bytes]) -> Dict[str, Any]:
+        chunk: List[tuple] = []
+        line_number = 0
+        async for raw_line in _iter_lines(body):
+            line_number += 1
+            if not raw_line.strip():
+                continue
+            try:
+                record = _record_adapter.validate_json(raw_line)
+            except ValidationError as e:
+                first = e.errors()[0]
+                self._error(line_number, f"{'.'.join(str(p) for p in first['loc'])}: {first['msg']}")
+                continue
+            if isinstance(record, AgentBulkRecord) and record.tools_enabled:
+                unknown = [name for name in record.tools_enabled if name not in VALID_TOOL_NAMES]
+                if unknown:
+                    self._error(line_number, f"Herramientas desconocidas: {', '.join(unknown)}")
+                    continue
+            chunk.append((line_number, record))
+            if len(chunk) >= BULK_IMPORT_CHUNK_SIZE:
+                if not await self._write_chunk(chunk):
+                    return self.report
+                chunk = []
+        if chunk:
+            await self._write_chunk(chunk)
+        return self.report
+
+    async def _write_chunk(self, chunk: List[tuple]) -> bool:
+        agent_rows: List[Dict[str, Any]] = []
+        flow_rows: List[tuple] = []
+        now = datetime.utcnow()
+        for line_number, record in chunk:
+            row = record.model_dump(exclude={"kind"})
+            row["id"] = row["id"] or db_models.generate_uuid()
+            row["updated_at"] = now # Los INSERT Core no aplican el default/onupdate del modelo
+            if isinstance(record, AgentBulkRecord):
+                row["tools_enabled"] = row["tools_enabled"] or []
+                agent_rows.append(row)
+            else:
+                flow_rows.append((line_number, row))
+
+        try:
+            async with write_session() as db:
+                # Referencias de los flujos: una sola consulta IN para las que no vienen en el fichero
+                chunk_agent_ids = {row["id"] for row in agent_rows}
+                referenced = {agent_id for _, row in flow_rows for agent_id in row["agent_ids"]}
+                missing = referenced - self.known_agent_ids - chunk_agent_ids
+                if missing:
+                    result = await db.execute(select(db_models.Agent.id).where(db_models.Agent.id.in_(missing)))
+                    missing -= set(result.scalars().all())
+                valid_flow_rows = []
+                for line_number, row in flow_rows:
+                    unresolved = [agent_id for agent_id in row["agent_ids"] if agent_id in missing]
+                    if unresolved:
+                        self._error(line_number, f"Agentes no encontrados: {', '.join(unresolved)}")
+                    else:
+                        valid_flow_rows.append(row)
+
+                dialect = db.bind.dialect.name
+                for entity, model, rows, fields in (("agent", db_models.Agent, agent_rows, AGENT_FIELDS), ("flow", db_models.Flow, valid_flow_rows, FLOW_FIELDS)):
+                    if not rows:
+                        continue
+                    if self.upsert:
+                        await db.execute(_upsert_statement(dialect, model, rows, fields))
+                    else:
+                        await db.execute(insert(model), rows) # executemany -> INSERT multi-fila
+                    # Sin eventos ORM: el registro de cambios se hace aquí, en la misma transacción
+                    await record_bulk_changes(db, entity, [row["id"] for row in rows])
+        except Exception as e:
+            self.report["aborted"] = f"Error al escribir el lote que empieza en la línea {chunk[0][0]}: {e}"
+            print(f"Importación masiva abortada: {self.report['aborted']}")
+            return False
+
+        self.known_agent_ids |= chunk_agent_ids
+        if self.upsert: # Las configuraciones actualizadas no deben servirse desde la caché
+            for row in agent_rows:
+                config_cache.invalidate_agent(row["id"])
+            for row in valid_flow_rows:
+                config_cache.invalidate_flow(row["id"])
+        self.report["agents"] += len(agent_rows)
+        self.report["flows"] += len(valid_flow_rows)
+        self.report["chunks_committed"] += 1
+        return True
@@ -0,0 +1,126 @@
+# backend/services/cancellation.py
+# Plazos (deadlines) por petición y cancelación de invocaciones en curso cuando el
+# cliente se desconecta o el plazo vence. Así no seguimos gastando cuota del LLM ni
+# capacidad del worker en resultados que nadie va a recibir.
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+
+INVOKE_DEFAULT_TIMEOUT_SECONDS = float(os.getenv("INVOKE_DEFAULT_TIMEOUT_SECONDS", "120"))
+INVOKE_MAX_TIMEOUT_SECONDS = float(os.getenv("INVOKE_MAX_TIMEOUT_SECONDS", "600"))
+DISCONNECT_POLL_INTERVAL_SECONDS = float(os.getenv("DISCONNECT_POLL_INTERVAL_SECONDS", "0.5"))
+CANCELLED_INVOCATIONS_HISTORY = int(os.getenv("CANCELLED_INVOCATIONS_HISTORY", "200"))
+
+# Cabecera con la que el cliente indica cuántos segundos está dispuesto a esperar
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class InvocationCancelled(Exception):
+    """La invocación se abandonó: venció el plazo o el cliente se desconectó."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason # "deadline" | "client_disconnected"
+
+    @property
+    def status_code(self) -> int:
+        # 499 (Client Closed Request) no es estándar, pero es la convención habitual de los proxies
+        return 504 if self.reason == "deadline" else 499
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self) -> None:
+        """Lanza InvocationCancelled si el plazo ya venció; se llama antes de empezar trabajo nuevo."""
+        if self.expired:
+            raise InvocationCancelled("deadline")
+
+
+def resolve_deadline(header_value: Optional[str], configured_default: Optional[float] = None) -> Deadline:
+    """
+    Plazo efectivo: la cabecera X-Request-Timeout si viene, si no el valor por defecto del
+    agente/flujo y, en último caso, el global. Siempre acotado por INVOKE_MAX_TIMEOUT_SECONDS.
+    """
+    seconds = configured_default or INVOKE_DEFAULT_TIMEOUT_SECONDS
+    if header_value:
+        try:
+            seconds = float(header_value)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"La cabecera {DEADLINE_HEADER} debe ser un número de segundos.")
+        if seconds <= 0:
+            raise HTTPException(status_code=400, detail=f"La cabecera {DEADLINE_HEADER} debe ser mayor que 0.")
+    return Deadline(min(seconds, INVOKE_MAX_TIMEOUT_SECONDS))
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    """Vuelve cuando el cliente se desconecta; `request` es cualquier objeto con `is_disconnected()`."""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL_SECONDS)
+
+
+async def run_cancellable(request: Request, work: Awaitable[Any], deadline: Deadline) -> Any:
+    """
+    Ejecuta `work` vigilando en paralelo la conexión del cliente y el plazo.
+    `request` puede ser cualquier objeto con `is_disconnected()` (p. ej. SharedConnection).
+    Si el cliente se desconecta o el plazo vence, cancela el trabajo en curso (y con él
+    las llamadas pendientes al LLM y a herramientas) y lanza InvocationCancelled.
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+
+    if task in done:
+        return task.result()
+
+    reason = "client_disconnected" if watcher in done else "deadline"
+    task.cancel()
+    try:
+        await task
+    except BaseException: # Solo queremos que termine de cancelarse
+        pass
+    raise InvocationCancelled(reason)
+
+
+# --- Registro de invocaciones canceladas (progreso parcial) ---
+
+_cancelled_invocations: deque = deque(maxlen=CANCELLED_INVOCATIONS_HISTORY)
+
+
+def record_cancelled(kind: str, target_id: str, reason: str, steps: List[Dict[str, Any]]) -> str:
+    """Guarda el progreso parcial de una invocación cancelada y devuelve su ID."""
+    invocation_id = uuid.uuid4().hex
+    _cancelled_invocations.append({
+        "invocation_id": invocation_id,
+        "kind": kind,
+        "target_id": target_id,
+        "reason": reason,
+        "cancelled_at": time.time(),
+        "steps": steps,
+    })
+    print(f"Invocación {kind} '{target_id}' cancelada ({reason}) tras {sum(1 for s in steps if s.get('status') == 'completed')} paso(s) completados. ID: {invocation_id}")
+    return invocation_id
+
+
+def list_cancelled(limit: int = 50) -> List[Dict[str, Any]]:
+    return list(_cancelled_invocations)[-limit:]
@@ -0,0 +1,187 @@
+# backend/services/config_cache.py
+# Caché en memoria de la configuración de agentes y flujos que usan los endpoints de invocación.
+# Cada entrada es una copia inmutable (no un objeto ORM) y caduca a los CONFIG_CACHE_TTL_SECONDS.
+# Las escrituras de este worker la invalidan al confirmarse (on_commit); en otros workers el cambio se ve como
+# mucho tras el TTL. CONFIG_CACHE_TTL_SECONDS=0 la desactiva (siempre se lee de la BD).
+# Al arrancar se precargan los agentes/flujos más usados según los agregados de uso.
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from ..agent_tools.available_tools import AVAILABLE_TOOLS_SCHEMAS
+from ..db.database import read_session
+from ..db import models as db_models
+
+CONFIG_CACHE_TTL_SECONDS = float(os.getenv("CONFIG_CACHE_TTL_SECONDS", "30"))
+CONFIG_CACHE_MAX_ENTRIES = int(os.getenv("CONFIG_CACHE_MAX_ENTRIES", "2000"))
+
+
+@lru_cache(maxsize=256)
+def tool_bundle(tool_names: Tuple[str, ...]) -> Tuple[dict, ...]:
+    """Esquemas de herramientas a pasar al LLM para un conjunto de nombres (se construye una vez)."""
+    return tuple(schema for schema in AVAILABLE_TOOLS_SCHEMAS if schema["function"]["name"] in tool_names)
+
+
+@dataclass(frozen=True)
+class AgentConfig:
+    id: str
+    name: str
+    system_prompt: str
+    tools_enabled: Tuple[str, ...]
+    tools: Tuple[dict, ...]
+    semantic_cache_threshold: Optional[float]
+    timeout_seconds: Optional[int]
+    max_tool_rounds: Optional[int]
+    max_tool_result_chars: Optional[int]
+
+    @classmethod
+    def from_model(cls, agent: db_models.Agent) -> "AgentConfig":
+        tools_enabled = tuple(agent.tools_enabled or ())
+        return cls(
+            id=agent.id, name=agent.name, system_prompt=agent.system_prompt,
+            tools_enabled=tools_enabled, tools=tool_bundle(tools_enabled),
+            semantic_cache_threshold=agent.semantic_cache_threshold, timeout_seconds=agent.timeout_seconds,
+            max_tool_rounds=agent.max_tool_rounds, max_tool_result_chars=agent.max_tool_result_chars,
+        )
+
+
+@dataclass(frozen=True)
+class FlowConfig:
+    id: str
+    name: str
+    agent_ids: Tuple[str, ...]
+    timeout_seconds: Optional[int]
+
+    @classmethod
+    def from_model(cls, flow: db_models.Flow) -> "FlowConfig":
+        return cls(id=flow.id, name=flow.name, agent_ids=tuple(flow.agent_ids), timeout_seconds=flow.timeout_seconds)
+
+
+class _TTLMap:
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() > entry[0]:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: Any) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ConfigCache:
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self._agents = _TTLMap(ttl_seconds, max_entries)
+        self._flows = _TTLMap(ttl_seconds, max_entries)
+        self._counters = {"hits": 0, "misses": 0, "preloaded_agents": 0, "preloaded_flows": 0}
+
+    async def get_agents(self, agent_ids: Iterable[str]) -> Dict[str, AgentConfig]:
+        """Configuración de varios agentes; los que falten se cargan con una sola consulta IN."""
+        found: Dict[str, AgentConfig] = {}
+        missing = set()
+        for agent_id in agent_ids:
+            config = self._agents.get(agent_id)
+            if config is None:
+                missing.add(agent_id)
+            else:
+                found[agent_id] = config
+        self._counters["hits"] += len(found)
+        if missing:
+            self._counters["misses"] += len(missing)
+            async with read_session() as db:
+                result = await db.execute(select(db_models.Agent).where(db_models.Agent.id.in_(missing)))
+                for agent in result.scalars().all():
+                    config = AgentConfig.from_model(agent)
+                    self._agents.put(agent.id, config)
+                    found[agent.id] = config
+        return found
+
+    async def get_agent(self, agent_id: str) -> Optional[AgentConfig]:
+        return (await self.get_agents([agent_id])).get(agent_id)
+
+    async def get_flows(self, flow_ids: Iterable[str]) -> Dict[str, FlowConfig]:
+        found: Dict[str, FlowConfig] = {}
+        missing = set()
+        for flow_id in flow_ids:
+            config = self._flows.get(flow_id)
+            if config is None:
+                missing.add(flow_id)
+            else:
+                found[flow_id] = config
+        self._counters["hits"] += len(found)
+        if missing:
+            self._counters["misses"] += len(missing)
+            async with read_session() as db:
+                result = await db.execute(select(db_models.Flow).where(db_models.Flow.id.in_(missing)))
+                for flow in result.scalars().all():
+                    config = FlowConfig.from_model(flow)
+                    self._flows.put(flow.id, config)
+                    found[flow.id] = config
+        return found
+
+    async def get_flow(self, flow_id: str) -> Optional[FlowConfig]:
+        return (await self.get_flows([flow_id])).get(flow_id)
+
+    def invalidate_agent(self, agent_id: str) -> None:
+        self._agents.pop(agent_id)
+
+    def invalidate_flow(self, flow_id: str) -> None:
+        self._flows.pop(flow_id)
+
+    async def preload_hot(self, limit: int, hours: int = 24) -> None:
+        """Precarga los agentes y flujos con más llamadas al LLM en las últimas `hours` horas."""
+        if limit <= 0:
+            return
+        table = db_models.LLMUsageHourly
+        since = datetime.utcnow() - timedelta(hours=hours)
+        async with read_session() as db:
+            hot_agents = (await db.execute(
+                select(table.agent_id).where(table.hour >= since)
+                .group_by(table.agent_id).order_by(func.sum(table.calls).desc()).limit(limit)
+            )).scalars().all()
+            hot_flows = (await db.execute(
+                select(table.flow_id).where(table.hour >= since, table.flow_id != "")
+                .group_by(table.flow_id).order_by(func.sum(table.calls).desc()).limit(limit)
+            )).scalars().all()
+        flows = await self.get_flows(hot_flows)
+        # Los agentes de los flujos calientes también, para que su primera invocación no toque la BD
+        agents = await self.get_agents(set(hot_agents) | {a for f in flows.values() for a in f.agent_ids})
+        self._counters["preloaded_agents"] += len(agents)
+        self._counters["preloaded_flows"] += len(flows)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttl_seconds": self._agents.ttl_seconds,
+            "agents": len(self._agents),
+            "flows": len(self._flows),
+            "tool_bundles": tool_bundle.cache_info().currsize,
+            **self._counters,
+        }
+
+
+config_cache = ConfigCache(CONFIG_CACHE_TTL_SECONDS, CONFIG_CACHE_MAX_ENTRIES)
@@ -0,0 +1,205 @@
+# backend/services/idempotency.py
+# Claves de idempotencia para los endpoints de invocación.
+# - Un reintento de una petición ya completada recibe la respuesta guardada.
+# - Un reintento que llega mientras la original sigue en curso se engancha a la misma
+#   ejecución en lugar de lanzar otra (y pagar dos veces al LLM).
+# Los resultados se guardan en memoria con TTL acotado y, opcionalmente, en la BD
+# para que sobrevivan a reinicios y se compartan entre workers.
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException, Request
+from pydantic import BaseModel
+from sqlalchemy import delete
+
+from ..db.database import read_session, write_session
+from ..db import models as db_models
+from .responses import FastJSONResponse
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+IDEMPOTENCY_DB_TIER = os.getenv("IDEMPOTENCY_DB_TIER", "false").lower() in ("1", "true", "yes")
+IDEMPOTENCY_MAX_KEY_LENGTH = 200
+# Errores que dependen del momento y no de la petición: nunca se guardan, un reintento con la
+# misma clave se vuelve a ejecutar. 408/499: plazo o desconexión del cliente (InvocationCancelled);
+# 429: descartada por el control de admisión; 425: demasiado pronto.
+TRANSIENT_STATUS_CODES = frozenset({408, 425, 429, 499})
+
+
+class SharedConnection:
+    """
+    Agrupa las peticiones enganchadas a una misma ejecución. Solo se considera
+    desconectada cuando TODAS se han desconectado: mientras alguien espere el
+    resultado, la ejecución sigue (ver run_cancellable).
+    """
+
+    def __init__(self, request: Request):
+        self.requests: List[Request] = [request]
+
+    def attach(self, request: Request) -> None:
+        self.requests.append(request)
+
+    async def is_disconnected(self) -> bool:
+        for request in self.requests:
+            if not await request.is_disconnected():
+                return False
+        return True
+
+
+class IdempotencyStore:
+    def __init__(self, ttl_seconds: int, max_entries: int, db_tier: bool):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db_tier = db_tier
+        self._completed: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._in_flight: Dict[str, Dict[str, Any]] = {}
+        self._last_purge = 0.0
+
+    @staticmethod
+    def fingerprint(payload: Any) -> str:
+        raw = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # --- Resultados completados ---
+
+    def _get_memory(self, full_key: str) -> Optional[Dict[str, Any]]:
+        stored = self._completed.get(full_key)
+        if stored is None:
+            return None
+        if time.time() > stored["expires_at"]:
+            del self._completed[full_key]
+            return None
+        self._completed.move_to_end(full_key)
+        return stored
+
+    def _put_memory(self, full_key: str, stored: Dict[str, Any]) -> None:
+        self._completed[full_key] = stored
+        self._completed.move_to_end(full_key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+    async def _get_db(self, full_key: str) -> Optional[Dict[str, Any]]:
+        async with read_session() as db:
+            record = await db.get(db_models.IdempotencyRecord, full_key)
+        if record is None or record.expires_at < datetime.utcnow():
+            return None
+        stored = {
+            "fingerprint": record.fingerprint,
+            "status_code": record.status_code,
+            "body": record.response_body,
+            "expires_at": time.time() + (record.expires_at - datetime.utcnow()).total_seconds(),
+        }
+        self._put_memory(full_key, stored)
+        return stored
+
+    async def _put_db(self, full_key: str, stored: Dict[str, Any]) -> None:
+        try:
+            async with write_session() as db:
+                now = datetime.utcnow()
+                await db.merge(db_models.IdempotencyRecord(
+                    key=full_key,
+                    fingerprint=stored["fingerprint"],
+                    status_code=stored["status_code"],
+                    response_body=stored["body"],
+                    created_at=now,
+                    expires_at=now + timedelta(seconds=self.ttl_seconds),
+                ))
+                # Purga perezosa de claves caducadas, como mucho una vez por minuto
+                if time.time() - self._last_purge > 60:
+                    self._last_purge = time.time()
+                    await db.execute(delete(db_models.IdempotencyRecord).where(db_models.IdempotencyRecord.expires_at < now))
+        except Exception as e:
+            print(f"Advertencia: no se pudo guardar la clave de idempotencia '{full_key}' en la BD: {e}")
+
+    def _on_done(self, full_key: str, fingerprint: str, task: asyncio.Task) -> None:
+        self._in_flight.pop(full_key, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            result = task.result()
+            body = result.model_dump(mode="json", exclude_none=True) if isinstance(result, BaseModel) else result
+            status_code = 200
+        elif isinstance(error, HTTPException) and error.status_code < 500 and error.status_code not in TRANSIENT_STATUS_CODES:
+            # Los errores del cliente deterministas (400, 404, 422...) se guardan. Los 5xx, las
+            # cancelaciones y los descartes por saturación no, para que un reintento se vuelva a ejecutar.
+            body = {"detail": error.detail}
+            status_code = error.status_code
+        else:
+            return
+        stored = {"fingerprint": fingerprint, "status_code": status_code, "body": body, "expires_at": time.time() + self.ttl_seconds}
+        self._put_memory(full_key, stored)
+        if self.db_tier:
+            asyncio.get_running_loop().create_task(self._put_db(full_key, stored))
+
+    # --- Punto de entrada ---
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        payload: Any,
+        request: Request,
+        execute: Callable[[Any], Awaitable[Any]],
+    ) -> Any:
+        """
+        Ejecuta `execute(connection)` una sola vez por (scope, key). `connection` es el objeto
+        cuya desconexión debe cancelar la ejecución (todas las peticiones enganchadas).
+        """
+        if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"La cabecera {IDEMPOTENCY_HEADER} no puede superar {IDEMPOTENCY_MAX_KEY_LENGTH} caracteres.")
+        full_key = f"{scope}:{key}"
+        fingerprint = self.fingerprint(payload)
+
+        stored = self._get_memory(full_key)
+        if stored is None and self.db_tier and full_key not in self._in_flight:
+            stored = await self._get_db(full_key)
+        if stored is not None:
+            self._check_fingerprint(stored["fingerprint"], fingerprint)
+            print(f"Idempotencia: devolviendo respuesta guardada para '{full_key}'.")
+            if stored["status_code"] >= 400:
+                raise HTTPException(status_code=stored["status_code"], detail=stored["body"].get("detail"))
+            return FastJSONResponse(content=stored["body"], status_code=stored["status_code"], headers={"Idempotent-Replayed": "true"})
+
+        in_flight = self._in_flight.get(full_key)
+        if in_flight is not None:
+            self._check_fingerprint(in_flight["fingerprint"], fingerprint)
+            in_flight["connection"].attach(request)
+            print(f"Idempotencia: reintento enganchado a la ejecución en curso de '{full_key}'.")
+        else:
+            connection = SharedConnection(request)
+            task = asyncio.get_running_loop().create_task(execute(connection))
+            in_flight = {"fingerprint": fingerprint, "task": task, "connection": connection}
+            self._in_flight[full_key] = in_flight
+            task.add_done_callback(lambda t: self._on_done(full_key, fingerprint, t))
+
+        # shield: que esta petición termine (o se cancele) no cancela la ejecución compartida
+        return await asyncio.shield(in_flight["task"])
+
+    @staticmethod
+    def _check_fingerprint(expected: str, actual: str) -> None:
+        if expected != actual:
+            raise HTTPException(
+                status_code=422,
+                detail=f"La clave {IDEMPOTENCY_HEADER} ya se usó con un cuerpo de petición distinto."
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "completed": len(self._completed),
+            "in_flight": len(self._in_flight),
+            "attached_requests": sum(len(f["connection"].requests) for f in self._in_flight.values()),
+            "ttl_seconds": self.ttl_seconds,
+            "max_entries": self.max_entries,
+            "db_tier": self.db_tier,
+        }
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_DB_TIER)
@@ -0,0 +1,52 @@
+# backend/services/llm.py
+# Cliente de OpenAI compartido. Se crea en el arranque de la aplicación (lifespan de main.py),
+# no al importar el módulo, y se puede "calentar" para que la primera invocación no pague
+# la resolución DNS ni el handshake TLS.
+# Es el cliente asíncrono: cancelar la tarea que espera una llamada (plazo vencido, cliente
+# desconectado) cierra la petición HTTP en curso, en lugar de dejarla corriendo en un hilo.
+# Sin reintentos automáticos del SDK (cada uno volvería a esperar el timeout completo);
+# los reintentos los hace main._create_chat_completion dentro del plazo de la invocación.
+import os
+from typing import Optional
+
+import openai
+
+LLM_WARMUP_TIMEOUT_SECONDS = float(os.getenv("LLM_WARMUP_TIMEOUT_SECONDS", "5"))
+# Reintentos ante errores transitorios (conexión, 429, 5xx), solo si queda plazo
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))
+# No se reintenta si quedan menos de estos segundos de plazo
+LLM_RETRY_MIN_REMAINING_SECONDS = float(os.getenv("LLM_RETRY_MIN_REMAINING_SECONDS", "5"))
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+client: Optional[openai.AsyncOpenAI] = None
+
+
+def init_client() -> Optional[openai.AsyncOpenAI]:
+    global client
+    try:
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        if not client.api_key:
+            raise ValueError("OPENAI_API_KEY no encontrada.")
+    except Exception as e:
+        print(f"Error al inicializar el cliente de OpenAI: {e}")
+        client = None
+    return client
+
+
+async def warm_up() -> bool:
+    """Abre la conexión keep-alive con la API (GET /models, sin coste de tokens)."""
+    if client is None:
+        return False
+    try:
+        await client.with_options(timeout=LLM_WARMUP_TIMEOUT_SECONDS).models.list()
+        return True
+    except Exception as e:
+        print(f"Advertencia: no se pudo precalentar la conexión con OpenAI: {e}")
+        return False
+
+
+async def close_client() -> None:
+    global client
+    if client is not None:
+        await client.close()
+        client = None
@@ -0,0 +1,251 @@
+# backend/services/profiling.py
+# Perfilado bajo demanda y captura de peticiones lentas.
+# - Cada petición HTTP lleva un registro de fases (BD, cada llamada al LLM, cada herramienta,
+#   codificación de la respuesta) en una ContextVar. Registrar una fase es solo un append.
+# - Si la petición supera SLOW_REQUEST_THRESHOLD_MS, su desglose se guarda en memoria.
+# - Con la cabecera X-Profile: <PROFILING_TOKEN> (o por muestreo, PROFILING_SAMPLE_RATE) se
+#   activa además un profiler de muestreo (hilo que lee sys._current_frames cada pocos ms)
+#   mientras dura la petición; el resultado se guarda y su ID va en la cabecera X-Profile-Id.
+import functools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from fastapi import Header, HTTPException
+from sqlalchemy import event
+
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "2000"))
+SLOW_REQUEST_HISTORY = int(os.getenv("SLOW_REQUEST_HISTORY", "100"))
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+PROFILING_MAX_STORED = int(os.getenv("PROFILING_MAX_STORED", "50"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or PROFILING_TOKEN
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+MAX_STACK_DEPTH = 64
+# Marcos en los que un hilo está ocioso (event loop esperando E/S, pool de hilos sin trabajo)
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("thread.py", "_worker")}
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.phases: List[tuple] = [] # (tipo, detalle, inicio, fin)
+        self.handler_done: Optional[float] = None
+        self.response_started: Optional[float] = None
+
+    def add(self, kind: str, detail: str, start: float, end: float) -> None:
+        self.phases.append((kind, detail, start, end))
+
+    def summary(self, status_code: int, finished: float, profile_id: Optional[str]) -> Dict[str, Any]:
+        phases = list(self.phases)
+        if self.handler_done is not None and self.response_started is not None:
+            phases.append(("encode", "serialización de la respuesta", self.handler_done, self.response_started))
+        if self.response_started is not None:
+            phases.append(("send", "envío de la respuesta", self.response_started, finished))
+        to_ms = lambda seconds: round(seconds * 1000, 2)
+        by_kind: Dict[str, float] = {}
+        for kind, _, start, end in phases:
+            by_kind[kind] = by_kind.get(kind, 0.0) + (end - start)
+        total = finished - self.started
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "total_ms": to_ms(total),
+            "captured_at": time.time(),
+            # Lo no atribuido a ninguna fase (validación, lógica propia, espera en cola...)
+            "by_kind_ms": {**{k: to_ms(v) for k, v in by_kind.items()}, "other": to_ms(max(0.0, total - sum(by_kind.values())))},
+            "phases": [
+                {"kind": kind, "detail": detail, "start_ms": to_ms(start - self.started), "duration_ms": to_ms(end - start)}
+                for kind, detail, start, end in sorted(phases, key=lambda p: p[2])
+            ],
+            "profile_id": profile_id,
+        }
+
+
+_current_profile: ContextVar[Optional[RequestProfile]] = ContextVar("request_profile", default=None)
+
+
+@contextmanager
+def phase(kind: str, detail: str = ""):
+    """Mide un bloque como fase de la petición actual. Sin petición en curso no hace nada."""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(kind, detail, start, time.perf_counter())
+
+
+def profiled_handler(endpoint):
+    """Marca el fin del endpoint para separar su tiempo del de la serialización de la respuesta."""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            profile = _current_profile.get()
+            if profile is not None:
+                profile.handler_done = time.perf_counter()
+    return wrapper
+
+
+def instrument_engine(engine) -> None:
+    """Registra cada sentencia SQL del engine como fase "db" de la petición en curso."""
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiling_starts", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["profiling_starts"].pop()
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.add("db", statement.split(None, 1)[0].upper() if statement else "", start, time.perf_counter())
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+# --- Profiler de muestreo ---
+
+class SamplingProfiler:
+    """Muestrea las pilas de todos los hilos del proceso. Solo uno activo a la vez por worker."""
+    _active = threading.Lock()
+
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000
+        self.samples = 0
+        self._stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._started = 0.0
+
+    @classmethod
+    def try_start(cls, interval_ms: float) -> Optional["SamplingProfiler"]:
+        if not cls._active.acquire(blocking=False):
+            return None # Ya hay otra petición perfilándose; no acumulamos sobrecarga
+        profiler = cls(interval_ms)
+        profiler._started = time.perf_counter()
+        profiler._thread.start()
+        return profiler
+
+    def _run(self) -> None:
+        own_thread = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, top: int = 100) -> Dict[str, Any]:
+        self._stop.set()
+        self._thread.join()
+        SamplingProfiler._active.release()
+        return {
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "duration_ms": round((time.perf_counter() - self._started) * 1000, 2),
+            # Pilas en formato "collapsed" (compatible con flamegraph.pl / speedscope)
+            "stacks": [{"stack": stack, "count": count} for stack, count in self._stacks.most_common(top)],
+        }
+
+
+# --- Almacenamiento en memoria ---
+
+_slow_requests: deque = deque(maxlen=SLOW_REQUEST_HISTORY)
+_profiles: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+
+def _store_profile(profile_id: str, data: Dict[str, Any]) -> None:
+    _profiles[profile_id] = data
+    while len(_profiles) > PROFILING_MAX_STORED:
+        _profiles.popitem(last=False)
+
+
+def list_slow_requests(limit: int = 50) -> List[Dict[str, Any]]:
+    return list(_slow_requests)[-limit:]
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    return [
+        {"profile_id": profile_id, "method": p["request"]["method"], "path": p["request"]["path"],
+         "total_ms": p["request"]["total_ms"], "samples": p["sampler"]["samples"]}
+        for profile_id, p in _profiles.items()
+    ]
+
+
+def get_profile(profile_id: str) -> Optional[Dict[str, Any]]:
+    return _profiles.get(profile_id)
+
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)) -> None:
+    """Dependencia para los endpoints de administración de perfiles."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Endpoints de administración desactivados: configura ADMIN_TOKEN o PROFILING_TOKEN.")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Cabecera X-Admin-Token no válida.")
+
+
+class ProfilingMiddleware:
+    """Middleware ASGI que registra las fases de cada petición y activa el profiler cuando toca."""
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _wants_sampler(headers: Dict[bytes, bytes]) -> bool:
+        requested = headers.get(PROFILE_HEADER.lower().encode())
+        if requested is not None and PROFILING_TOKEN and requested.decode("latin-1") == PROFILING_TOKEN:
+            return True
+        return PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profile = RequestProfile(scope["method"], scope["path"])
+        sampler = SamplingProfiler.try_start(PROFILING_INTERVAL_MS) if self._wants_sampler(dict(scope.get("headers") or [])) else None
+        profile_id = uuid.uuid4().hex if sampler else None
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                profile.response_started = time.perf_counter()
+                status["code"] = message["status"]
+                if profile_id:
+                    message = {**message, "headers": list(message.get("headers", [])) + [(PROFILE_ID_HEADER.lower().encode(), profile_id.encode())]}
+            await send(message)
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_profile.reset(token)
+            finished = time.perf_counter()
+            summary = profile.summary(status["code"], finished, profile_id)
+            if sampler:
+                _store_profile(profile_id, {"request": summary, "sampler": sampler.stop()})
+            if summary["total_ms"] >= SLOW_REQUEST_THRESHOLD_MS:
+                _slow_requests.append(summary)
+                print(f"Petición lenta: {summary['method']} {summary['path']} {summary['total_ms']:.0f} ms {summary['by_kind_ms']}")
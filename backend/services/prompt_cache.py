@@ -0,0 +1,237 @@
+# backend/services/prompt_cache.py
+# Caché de prompts "casi duplicados" delante de las llamadas al LLM.
+# Todo es local: normalizamos el texto, calculamos una firma MinHash sobre n-gramas de
+# caracteres y buscamos la firma más parecida en un índice compacto respaldado por NumPy.
+# No se usa ningún servicio externo de embeddings.
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError: # NumPy es opcional: sin él la caché queda desactivada
+    np = None
+
+PROMPT_CACHE_CAPACITY = int(os.getenv("PROMPT_CACHE_CAPACITY", "2048"))
+PROMPT_CACHE_TTL_SECONDS = float(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+PROMPT_CACHE_NUM_PERM = int(os.getenv("PROMPT_CACHE_NUM_PERM", "64"))
+PROMPT_CACHE_SHINGLE_SIZE = int(os.getenv("PROMPT_CACHE_SHINGLE_SIZE", "4"))
+PROMPT_CACHE_AUDIT_SIZE = int(os.getenv("PROMPT_CACHE_AUDIT_SIZE", "500"))
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Solo puntuación de frase, y no entre dígitos ("2.5" y "1,000" se conservan). Los operadores y
+# comparadores (+ - * / < > = ...) cambian el significado del prompt y nunca se eliminan.
+_SENTENCE_PUNCTUATION_RE = re.compile(r"(?<!\d)[.,;:!?¿¡]|[.,;:!?¿¡](?!\d)")
+_WHITESPACE_RE = re.compile(r"\s+")
+# Números y operadores de un prompt: dos prompts que difieran en ellos nunca son "casi duplicados"
+_LITERALS_RE = re.compile(r"\d+(?:[.,]\d+)*|[-+*/^%<>=]")
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    Normaliza un prompt para que diferencias triviales (mayúsculas, espacios,
+    puntuación de frase, acentos compuestos/descompuestos) no cuenten como prompts distintos.
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _SENTENCE_PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def prompt_literals(normalized: str) -> tuple:
+    return tuple(_LITERALS_RE.findall(normalized))
+
+
+def _shingle_hashes(normalized: str, size: int) -> List[int]:
+    if len(normalized) <= size:
+        grams = {normalized}
+    else:
+        grams = {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+    # blake2b de 4 bytes: estable entre procesos (a diferencia de hash())
+    return [int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=4).digest(), "little") for g in grams]
+
+
+class PromptCache:
+    """
+    Índice MinHash con capacidad fija. Las firmas viven en una matriz NumPy
+    (capacidad x num_perm, uint32) y las entradas se desalojan por LRU o por TTL.
+    Cada entrada pertenece a un "scope" (system prompt + modelo + parámetros), así que
+    nunca se reutiliza una respuesta generada con otra configuración.
+    """
+
+    def __init__(self, capacity: int, num_perm: int, ttl_seconds: float, shingle_size: int, audit_size: int):
+        self.capacity = capacity
+        self.num_perm = num_perm
+        self.ttl_seconds = ttl_seconds
+        self.shingle_size = shingle_size
+        self.enabled = np is not None and capacity > 0
+        self._lock = threading.Lock()
+        self._audit: deque = deque(maxlen=audit_size)
+        self._stats = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        if not self.enabled:
+            if np is None:
+                print("Advertencia: NumPy no está instalado. La caché de prompts similares queda desactivada.")
+            return
+
+        rng = np.random.RandomState(1)
+        self._perm_a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._perm_b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._signatures = np.zeros((capacity, num_perm), dtype=np.uint32)
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        self._lru: "OrderedDict[int, None]" = OrderedDict() # slot -> None, del menos al más reciente
+        self._scope_slots: Dict[str, set] = {}
+        self._exact: Dict[tuple, int] = {} # (scope, sha256 del prompt normalizado) -> slot
+        self._free_slots = list(range(capacity - 1, -1, -1))
+
+    def _signature(self, normalized: str):
+        hashes = np.array(_shingle_hashes(normalized, self.shingle_size), dtype=np.uint64)
+        # Permutaciones universales (a*x + b) mod p; el desbordamiento de uint64 es aceptable aquí
+        permuted = np.bitwise_and(
+            (np.outer(hashes, self._perm_a) + self._perm_b) % _MERSENNE_PRIME, _MAX_HASH
+        )
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _drop_slot(self, slot: int) -> None:
+        entry = self._entries.pop(slot)
+        self._lru.pop(slot, None)
+        scope_slots = self._scope_slots.get(entry["scope"])
+        if scope_slots is not None:
+            scope_slots.discard(slot)
+            if not scope_slots:
+                del self._scope_slots[entry["scope"]]
+        self._exact.pop((entry["scope"], entry["digest"]), None)
+        self._free_slots.append(slot)
+
+    def _expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created_at"] > self.ttl_seconds
+
+    def lookup(self, scope: str, prompt: str, threshold: float, owner_id: str) -> Optional[str]:
+        """Devuelve una respuesta cacheada si hay un prompt con similitud >= threshold en el mismo scope."""
+        if not self.enabled:
+            return None
+        normalized = normalize_prompt(prompt)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            self._stats["lookups"] += 1
+            best_slot, best_similarity = None, 0.0
+
+            exact_slot = self._exact.get((scope, digest))
+            if exact_slot is not None:
+                best_slot, best_similarity = exact_slot, 1.0
+            elif scope in self._scope_slots:
+                slots = np.fromiter(self._scope_slots[scope], dtype=np.int64)
+                signature = self._signature(normalized)
+                similarities = np.count_nonzero(self._signatures[slots] == signature, axis=1) / self.num_perm
+                literals = prompt_literals(normalized)
+                # El más parecido cuyos números/operadores coincidan ("2+2" no sirve para "2*2")
+                for idx in np.flatnonzero(similarities >= threshold)[np.argsort(-similarities[similarities >= threshold], kind="stable")]:
+                    if self._entries[int(slots[idx])]["literals"] == literals:
+                        best_slot, best_similarity = int(slots[idx]), float(similarities[idx])
+                        break
+
+            if best_slot is None:
+                self._stats["misses"] += 1
+                return None
+
+            entry = self._entries[best_slot]
+            if self._expired(entry, now):
+                self._drop_slot(best_slot)
+                self._stats["misses"] += 1
+                return None
+
+            self._lru.move_to_end(best_slot)
+            entry["hits"] += 1
+            self._stats["exact_hits" if exact_slot is not None else "similar_hits"] += 1
+            self._audit.append({
+                "timestamp": now,
+                "owner_id": owner_id,
+                "entry_id": entry["entry_id"],
+                "similarity": round(best_similarity, 4),
+                "threshold": threshold,
+                "prompt_preview": prompt[:120],
+                "cached_prompt_preview": entry["prompt_preview"],
+            })
+            print(f"Caché de prompts: reutilizada entrada {entry['entry_id']} (similitud {best_similarity:.3f}) para '{owner_id}'.")
+            return entry["response"]
+
+    def store(self, scope: str, prompt: str, response: str) -> None:
+        if not self.enabled:
+            return
+        normalized = normalize_prompt(prompt)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        signature = self._signature(normalized)
+
+        with self._lock:
+            existing = self._exact.get((scope, digest))
+            if existing is not None:
+                self._drop_slot(existing)
+            if not self._free_slots:
+                oldest_slot = next(iter(self._lru))
+                self._drop_slot(oldest_slot)
+                self._stats["evictions"] += 1
+
+            slot = self._free_slots.pop()
+            self._signatures[slot] = signature
+            self._entries[slot] = {
+                "entry_id": uuid.uuid4().hex[:12],
+                "scope": scope,
+                "digest": digest,
+                "literals": prompt_literals(normalized),
+                "response": response,
+                "prompt_preview": prompt[:120],
+                "created_at": time.time(),
+                "hits": 0,
+            }
+            self._lru[slot] = None
+            self._scope_slots.setdefault(scope, set()).add(slot)
+            self._exact[(scope, digest)] = slot
+            self._stats["stores"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            if self.enabled:
+                for slot in list(self._entries):
+                    self._drop_slot(slot)
+            self._audit.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self._stats["exact_hits"] + self._stats["similar_hits"]
+            return {
+                "enabled": self.enabled,
+                "capacity": self.capacity,
+                "entries": len(self._entries) if self.enabled else 0,
+                "num_perm": self.num_perm,
+                "ttl_seconds": self.ttl_seconds,
+                "index_bytes": int(self._signatures.nbytes) if self.enabled else 0,
+                "hit_rate": round(hits / self._stats["lookups"], 4) if self._stats["lookups"] else 0.0,
+                **self._stats,
+            }
+
+    def audit_log(self, limit: int = 100) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._audit)[-limit:]
+
+
+def build_scope(system_prompt: str, model: str, **params: Any) -> str:
+    """Clave de scope: solo se reutilizan respuestas generadas con el mismo system prompt, modelo y parámetros."""
+    raw = "\x1f".join([system_prompt, model] + [f"{k}={params[k]}" for k in sorted(params)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+prompt_cache = PromptCache(
+    capacity=PROMPT_CACHE_CAPACITY,
+    num_perm=PROMPT_CACHE_NUM_PERM,
+    ttl_seconds=PROMPT_CACHE_TTL_SECONDS,
+    shingle_size=PROMPT_CACHE_SHINGLE_SIZE,
+    audit_size=PROMPT_CACHE_AUDIT_SIZE,
+)
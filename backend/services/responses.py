@@ -0,0 +1,48 @@
+# backend/services/responses.py
+# Clase de respuesta JSON por defecto de la API.
+# - Las versiones recientes de FastAPI ya serializan directamente a bytes con Pydantic (en
+#   Rust) cuando el endpoint tiene response_model; ahí la JSONResponse por defecto es la
+#   más rápida y una clase propia desactivaría ese camino.
+# - En versiones anteriores se usa orjson, bastante más rápido que el json de la librería
+#   estándar en respuestas grandes (flujos largos). Si no está instalado, JSONResponse normal.
+# También los helpers de GET condicional (ETag / If-None-Match) de los listados.
+import hashlib
+import inspect
+from typing import Iterable, Optional
+
+from fastapi import Request, Response, routing
+from fastapi.responses import JSONResponse
+
+FASTAPI_NATIVE_JSON = "dump_json" in inspect.signature(routing.serialize_response).parameters
+
+FastJSONResponse = JSONResponse
+if not FASTAPI_NATIVE_JSON:
+    try:
+        import orjson # noqa: F401
+        from fastapi.responses import ORJSONResponse as FastJSONResponse
+    except ImportError:
+        pass
+
+
+# --- GET condicionales (ETag / If-None-Match) ---
+
+def weak_etag(parts: Iterable[object]) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """304 sin cuerpo si el cliente ya tiene esta versión; None si hay que enviar la respuesta."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # Comparación débil: se ignora el prefijo W/
+        candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+        if "*" in candidates or etag.removeprefix("W/") in candidates:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def set_etag(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    # no-cache: el navegador puede guardar la respuesta pero debe revalidarla siempre
+    response.headers["Cache-Control"] = "no-cache"
@@ -0,0 +1,40 @@
+# backend/services/tool_loop.py
+# Límites del bucle LLM <-> herramientas de un agente. En cada ronda se reenvían al modelo todos
+# los mensajes anteriores, así que lo que se añade en una ronda se paga en todas las siguientes:
+# - El número de rondas con herramientas está acotado (max_tool_rounds del agente o
+#   DEFAULT_MAX_TOOL_ROUNDS). Agotadas, se pide al modelo una respuesta final sin herramientas.
+# - Cada resultado de herramienta se recorta a max_tool_result_chars antes de añadirlo a los
+#   mensajes: se conservan el principio y el final, con una marca de lo omitido.
+# - Se informa de los tokens de prompt de cada ronda y de cuántos añadió respecto a la anterior.
+import os
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_MAX_TOOL_ROUNDS = int(os.getenv("DEFAULT_MAX_TOOL_ROUNDS", "5"))
+DEFAULT_MAX_TOOL_RESULT_CHARS = int(os.getenv("DEFAULT_MAX_TOOL_RESULT_CHARS", "4000"))
+# Parte del límite reservada al final del resultado (suele traer totales, errores o el cierre del JSON)
+TRUNCATION_TAIL_RATIO = 0.2
+
+
+def truncate_tool_result(content: str, max_chars: int) -> Tuple[str, bool]:
+    """Devuelve (contenido, recortado). El marcador indica al modelo que faltan datos."""
+    if len(content) <= max_chars:
+        return content, False
+    tail = int(max_chars * TRUNCATION_TAIL_RATIO)
+    head = max_chars - tail
+    marker = f"\n[... resultado recortado: {len(content) - max_chars} de {len(content)} caracteres omitidos ...]\n"
+    return content[:head] + marker + (content[-tail:] if tail else ""), True
+
+
+def round_stats(round_number: int, usage: Any, previous_prompt_tokens: Optional[int]) -> Dict[str, Any]:
+    """Estadísticas de una ronda a partir del `usage` de su llamada al LLM (puede faltar)."""
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    added = None
+    if prompt_tokens is not None:
+        added = prompt_tokens - previous_prompt_tokens if previous_prompt_tokens is not None else prompt_tokens
+    return {
+        "round": round_number,
+        "prompt_tokens": prompt_tokens,
+        "prompt_tokens_added": added,
+        "tool_calls": 0,
+        "truncated_tool_results": 0,
+    }
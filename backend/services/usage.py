@@ -0,0 +1,167 @@
+# backend/services/usage.py
+# Contabilidad de tokens y coste de cada llamada al LLM.
+# En el camino de la petición solo se añade el evento a un buffer en memoria (sin await,
+# sin INSERT). Una tarea de fondo vacía el buffer por lotes: un INSERT multi-fila de los
+# eventos crudos y un upsert de los agregados por (hora, agente, flujo, modelo), que son
+# los que consultan los endpoints de uso.
+import asyncio
+import json
+import os
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from ..db.database import write_session
+from ..db import models as db_models
+
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "2"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "20000"))
+
+# Precio estimado en USD por cada 1K tokens: (prompt, completion).
+# Se puede sobrescribir con USAGE_MODEL_PRICING='{"gpt-3.5-turbo": [0.0005, 0.0015]}'
+MODEL_PRICING_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+}
+MODEL_PRICING_PER_1K_TOKENS.update({k: tuple(v) for k, v in json.loads(os.getenv("USAGE_MODEL_PRICING", "{}")).items()})
+
+# Valores centinela (no NULL) para que la clave única de los agregados funcione en MySQL
+AD_HOC_AGENT_ID = "ad-hoc"
+NO_FLOW_ID = ""
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    # Los modelos con sufijo de versión (gpt-3.5-turbo-0125) usan el precio del modelo base
+    pricing = MODEL_PRICING_PER_1K_TOKENS.get(model) or next(
+        (p for name, p in MODEL_PRICING_PER_1K_TOKENS.items() if model.startswith(name)), (0.0, 0.0)
+    )
+    return (prompt_tokens * pricing[0] + completion_tokens * pricing[1]) / 1000
+
+
+class UsageRecorder:
+    def __init__(self, flush_interval: float, batch_size: int, buffer_max: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer_max = buffer_max
+        self._buffer: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._counters = {"recorded": 0, "flushed": 0, "dropped": 0, "flush_errors": 0}
+
+    def record(self, agent_id: Optional[str], flow_id: Optional[str], model: str, usage: Any, latency_seconds: float) -> None:
+        """Registra una llamada al LLM. No bloquea: solo encola en memoria."""
+        if usage is None:
+            return
+        if len(self._buffer) >= self.buffer_max:
+            self._counters["dropped"] += 1
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        self._buffer.append({
+            "created_at": datetime.utcnow(),
+            "agent_id": agent_id or AD_HOC_AGENT_ID,
+            "flow_id": flow_id or NO_FLOW_ID,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": int(latency_seconds * 1000),
+            "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
+        })
+        self._counters["recorded"] += 1
+        if len(self._buffer) >= self.batch_size and self._wake is not None:
+            self._wake.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._buffer: # Vaciar lo pendiente antes de apagar
+            if not await self.flush():
+                break
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            while self._buffer:
+                if not await self.flush():
+                    break
+
+    async def flush(self) -> bool:
+        batch: List[Dict[str, Any]] = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        if not batch:
+            return True
+        try:
+            async with write_session() as db:
+                await db.execute(insert(db_models.LLMUsageEvent), batch)
+                await self._upsert_rollups(db, batch)
+        except Exception as e:
+            self._counters["flush_errors"] += 1
+            print(f"Advertencia: no se pudo guardar un lote de {len(batch)} eventos de uso: {e}")
+            # Devolver el lote al buffer (hasta su capacidad) para reintentarlo en el siguiente ciclo
+            for event in reversed(batch[: self.buffer_max - len(self._buffer)]):
+                self._buffer.appendleft(event)
+            return False
+        self._counters["flushed"] += len(batch)
+        return True
+
+    @staticmethod
+    def _aggregate(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        rollups: Dict[tuple, Dict[str, Any]] = {}
+        for event in batch:
+            hour = event["created_at"].replace(minute=0, second=0, microsecond=0)
+            key = (hour, event["agent_id"], event["flow_id"], event["model"])
+            row = rollups.setdefault(key, {
+                "hour": hour, "agent_id": event["agent_id"], "flow_id": event["flow_id"], "model": event["model"],
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "latency_ms_total": 0,
+            })
+            row["calls"] += 1
+            row["prompt_tokens"] += event["prompt_tokens"]
+            row["completion_tokens"] += event["completion_tokens"]
+            row["cost_usd"] += event["cost_usd"]
+            row["latency_ms_total"] += event["latency_ms"]
+        return list(rollups.values())
+
+    async def _upsert_rollups(self, db, batch: List[Dict[str, Any]]) -> None:
+        rows = self._aggregate(batch)
+        table = db_models.LLMUsageHourly
+        counters = ("calls", "prompt_tokens", "completion_tokens", "cost_usd", "latency_ms_total")
+        dialect = db.bind.dialect.name
+        if dialect == "mysql":
+            stmt = mysql_insert(table).values(rows)
+            stmt = stmt.on_duplicate_key_update({c: getattr(table, c) + getattr(stmt.inserted, c) for c in counters})
+        else:
+            dialect_insert = postgresql_insert if dialect == "postgresql" else sqlite_insert
+            stmt = dialect_insert(table).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["hour", "agent_id", "flow_id", "model"],
+                set_={c: getattr(table, c) + getattr(stmt.excluded, c) for c in counters},
+            )
+        await db.execute(stmt)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "buffered": len(self._buffer), "running": self._task is not None}
+
+
+usage_recorder = UsageRecorder(USAGE_FLUSH_INTERVAL_SECONDS, USAGE_BATCH_SIZE, USAGE_BUFFER_MAX)
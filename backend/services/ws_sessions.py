@@ -0,0 +1,181 @@
+# backend/services/ws_sessions.py
+# Sesiones WebSocket de chat con un agente. La configuración del agente (prompt, herramientas)
+# se resuelve una sola vez al conectar y el historial vive en memoria mientras dure la
+# conexión, así cada turno no repite la búsqueda en BD ni el armado de herramientas.
+# - Backpressure: los eventos salen por una cola acotada. Si el cliente no lee, los eventos
+#   informativos (herramientas) se descartan y los esenciales (respuestas) esperan un máximo;
+#   pasado ese tiempo la sesión se cierra en lugar de acumular memoria.
+# - Si un envío falla (el cliente se fue), la sesión termina en lugar de esperar a la cola.
+# - Las sesiones inactivas se cierran tras WS_IDLE_TIMEOUT_SECONDS.
+# - Cada worker acepta como mucho WS_MAX_SESSIONS_PER_WORKER sesiones (cierre 1013 si no).
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+WS_MAX_SESSIONS_PER_WORKER = int(os.getenv("WS_MAX_SESSIONS_PER_WORKER", "100"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "300"))
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "64"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_MAX_HISTORY_TURNS = int(os.getenv("WS_MAX_HISTORY_TURNS", "20"))
+
+# Códigos de cierre WebSocket
+WS_CLOSE_NORMAL = 1000
+WS_CLOSE_POLICY = 1008 # Agente inexistente, mensaje inválido
+WS_CLOSE_TRY_AGAIN_LATER = 1013 # Límite de sesiones del worker alcanzado
+
+
+class SlowConsumer(Exception):
+    """El cliente no consume los eventos a tiempo."""
+
+
+class SessionClosed(Exception):
+    """Falló el envío al cliente; la sesión ya no puede entregar eventos."""
+
+
+class AgentSession:
+    def __init__(self, websocket: WebSocket, agent_id: str, agent_name: str, system_prompt: str,
+                 tools: List[dict], timeout_seconds: Optional[int],
+                 max_tool_rounds: Optional[int] = None, max_tool_result_chars: Optional[int] = None):
+        self.session_id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.agent_id = agent_id
+        self.agent_name = agent_name
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.timeout_seconds = timeout_seconds
+        self.max_tool_rounds = max_tool_rounds
+        self.max_tool_result_chars = max_tool_result_chars
+        # Historial por turnos: cada turno es la lista de mensajes (usuario, herramientas, respuesta)
+        # y se recorta por turnos completos para no separar una llamada a herramienta de su resultado
+        self.turns: List[List[Any]] = []
+        self.last_activity = time.monotonic()
+        self.dropped_events = 0
+        self._outbound: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_MAX)
+        self._sender: Optional[asyncio.Task] = None
+        self.send_failed = False
+
+    def build_messages(self, user_prompt: str) -> List[Any]:
+        messages: List[Any] = [{"role": "system", "content": self.system_prompt}]
+        for turn in self.turns:
+            messages.extend(turn)
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
+
+    def commit_turn(self, messages: List[Any], history_start: int, assistant_response: str) -> None:
+        """Guarda en el historial los mensajes de un turno terminado (desde el del usuario)."""
+        self.turns.append(messages[history_start:] + [{"role": "assistant", "content": assistant_response}])
+        del self.turns[:-WS_MAX_HISTORY_TURNS]
+
+    # --- Envío con backpressure ---
+
+    def start(self) -> None:
+        self._sender = asyncio.get_running_loop().create_task(self._send_loop())
+
+    async def _send_loop(self) -> None:
+        try:
+            while True:
+                event = await self._outbound.get()
+                await self.websocket.send_json(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e: # Desconexión, socket cerrado, evento no serializable...
+            self.send_failed = True
+            print(f"Sesión WebSocket {self.session_id}: falló el envío al cliente ({e!r}); se cierra la sesión.")
+            # Cerrar también la recepción para que el bucle de la sesión termine
+            try:
+                await self._close_socket(WS_CLOSE_NORMAL, "")
+            except Exception:
+                pass
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        """Evento informativo: si la cola está llena se descarta."""
+        try:
+            self._outbound.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped_events += 1
+
+    async def send(self, event: Dict[str, Any]) -> None:
+        """
+        Evento esencial: espera hueco en la cola como mucho WS_SEND_TIMEOUT_SECONDS.
+        Lanza SessionClosed si el envío ya falló (no es un cliente lento: ya no está).
+        """
+        if self._sender is None or self._sender.done():
+            raise SessionClosed()
+        put = asyncio.ensure_future(self._outbound.put(event))
+        try:
+            done, _ = await asyncio.wait((put, self._sender), timeout=WS_SEND_TIMEOUT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if put in done:
+            return
+        if self._sender in done:
+            raise SessionClosed()
+        raise SlowConsumer()
+
+    async def close(self, code: int = WS_CLOSE_NORMAL, reason: str = "") -> None:
+        if self._sender is not None:
+            # Dar una oportunidad a que salga lo pendiente antes de cerrar
+            deadline = time.monotonic() + 1.0
+            while not self._outbound.empty() and not self._sender.done() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            self._sender.cancel()
+        await self._close_socket(code, reason)
+
+    async def _close_socket(self, code: int, reason: str) -> None:
+        if self.websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except RuntimeError: # Ya cerrado por el otro extremo
+                pass
+
+
+class SessionRegistry:
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, AgentSession] = {}
+        self._reserved = 0 # Conexiones aceptadas que aún están resolviendo su agente
+        self._counters = {"opened": 0, "rejected_capacity": 0, "closed_idle": 0, "closed_slow_consumer": 0, "closed_send_failed": 0, "turns": 0}
+
+    def reserve(self) -> bool:
+        """
+        Reserva una plaza de forma síncrona (sin await entre comprobar y reservar), para que
+        conexiones simultáneas no superen el límite. Liberar con release_reservation() o
+        convertirla en sesión con register().
+        """
+        if len(self._sessions) + self._reserved >= self.max_sessions:
+            return False
+        self._reserved += 1
+        return True
+
+    def release_reservation(self) -> None:
+        self._reserved -= 1
+
+    def register(self, session: AgentSession) -> None:
+        self._reserved -= 1
+        self._sessions[session.session_id] = session
+        self._counters["opened"] += 1
+
+    def unregister(self, session: AgentSession) -> None:
+        self._sessions.pop(session.session_id, None)
+
+    def count(self, counter: str) -> None:
+        self._counters[counter] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active_sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "reserved_sessions": self._reserved,
+            "idle_timeout_seconds": WS_IDLE_TIMEOUT_SECONDS,
+            "dropped_events": sum(s.dropped_events for s in self._sessions.values()),
+            **self._counters,
+        }
+
+
+session_registry = SessionRegistry(WS_MAX_SESSIONS_PER_WORKER)
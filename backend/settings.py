@@ -0,0 +1,25 @@
+# backend/settings.py
+# Carga única del fichero .env. Se importa antes que cualquier otro módulo del backend
+# (main.py, db/init_db.py), porque varios módulos leen su configuración con os.getenv al importarse.
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv(Path(__file__).resolve().parent / ".env")
+
+
+def env_bool(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+# Crear las tablas al arrancar (solo desarrollo). En producción: python -m backend.db.init_db
+DB_CREATE_ALL = env_bool("DB_CREATE_ALL", False)
+# Conexiones que se abren por adelantado en el pool al arrancar
+DB_WARM_CONNECTIONS = int(os.getenv("DB_WARM_CONNECTIONS", "2"))
+# Abrir la conexión HTTP con la API del LLM al arrancar (hace una llamada ligera a /models)
+LLM_WARMUP = env_bool("LLM_WARMUP", True)
+# Agentes/flujos más usados (según los agregados de uso) que se precargan en la caché de configuración
+PRELOAD_HOT_CONFIGS = int(os.getenv("PRELOAD_HOT_CONFIGS", "50"))
+# Presupuesto de tiempo de arranque: si se supera se avisa en el log y en /readyz
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "10"))
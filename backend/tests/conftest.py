@@ -0,0 +1,12 @@
+# backend/tests/conftest.py
+# Los módulos del backend leen su configuración con os.getenv al importarse: valores de prueba
+# (SQLite local, sin llamadas reales al LLM) antes de que ningún test los importe.
+# Ejecutar desde la raíz del repositorio: python -m pytest backend/tests
+import os
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("DB_CREATE_ALL", "true")
+os.environ.setdefault("LLM_WARMUP", "false")
+os.environ.setdefault("DB_ECHO", "false")
@@ -0,0 +1,202 @@
+# backend/tests/test_admission.py
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.services import cancellation
+from backend.services.admission import AdmissionController
+from backend.services.cancellation import Deadline, InvocationCancelled
+
+
+def _controller(max_concurrent=2, max_queue=10, batch_share=0.5, interactive_wait=5.0, batch_wait=5.0):
+    return AdmissionController(max_concurrent, max_queue, batch_share, {"interactive": interactive_wait, "batch": batch_wait})
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_admits_directly_while_there_is_capacity():
+    async def scenario():
+        controller = _controller()
+        await controller.acquire("interactive")
+        await controller.acquire("interactive")
+        assert controller.stats()["in_flight"] == 2
+        assert controller.stats()["queue_depth"] == 0
+    asyncio.run(scenario())
+
+
+def test_released_slot_goes_to_interactive_before_batch():
+    async def scenario():
+        controller = _controller(max_concurrent=1, batch_share=1.0)
+        await controller.acquire("interactive")
+        batch = asyncio.ensure_future(controller.acquire("batch"))
+        await _settle()
+        interactive = asyncio.ensure_future(controller.acquire("interactive"))
+        await _settle()
+        controller.release("interactive", 0.1)
+        await _settle()
+        assert interactive.done() and not batch.done()
+        controller.release("interactive", 0.1)
+        await asyncio.wait_for(batch, 1)
+        assert controller.stats()["classes"]["batch"]["in_flight"] == 1
+    asyncio.run(scenario())
+
+
+def test_batch_is_limited_to_its_share_even_with_free_slots():
+    async def scenario():
+        controller = _controller(max_concurrent=4, batch_share=0.5)
+        await controller.acquire("batch")
+        await controller.acquire("batch")
+        third_batch = asyncio.ensure_future(controller.acquire("batch"))
+        await _settle()
+        assert not third_batch.done()
+        await controller.acquire("interactive") # Los slots reservados siguen libres para interactive
+        controller.release("batch", 0.1)
+        await asyncio.wait_for(third_batch, 1)
+        assert controller.stats()["classes"]["batch"]["in_flight"] == 2
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario():
+        controller = _controller(max_concurrent=1)
+        await controller.acquire("interactive")
+        waiter = asyncio.ensure_future(controller.acquire("interactive"))
+        await _settle()
+        waiter.cancel()
+        await _settle()
+        assert controller.stats()["queue_depth"] == 0
+        controller.release("interactive", 0.1)
+        assert controller.stats()["in_flight"] == 0
+    asyncio.run(scenario())
+
+
+def test_slot_granted_while_cancelling_is_given_back():
+    async def scenario():
+        controller = _controller(max_concurrent=1)
+        await controller.acquire("interactive")
+        waiter = asyncio.ensure_future(controller.acquire("interactive"))
+        await _settle()
+        controller.release("interactive", 0.1) # Concede el slot al que espera...
+        waiter.cancel() # ...que se cancela antes de poder usarlo
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.stats()["in_flight"] == 0 # Sin slots perdidos
+    asyncio.run(scenario())
+
+
+def test_waiting_past_the_class_limit_is_shed_with_retry_after():
+    async def scenario():
+        controller = _controller(max_concurrent=1, interactive_wait=0.05)
+        await controller.acquire("interactive")
+        with pytest.raises(HTTPException) as exc_info:
+            await controller.acquire("interactive")
+        assert exc_info.value.status_code == 429
+        assert int(exc_info.value.headers["Retry-After"]) >= 1
+        assert controller.stats()["classes"]["interactive"]["shed_queue_time"] == 1
+        assert controller.stats()["queue_depth"] == 0
+    asyncio.run(scenario())
+
+
+def test_shed_immediately_when_the_estimated_wait_exceeds_the_limit():
+    async def scenario():
+        controller = _controller(max_concurrent=1, interactive_wait=5.0)
+        await controller.acquire("interactive")
+        controller.release("interactive", 10.0) # Duración media reciente: 10 s
+        await controller.acquire("interactive")
+        with pytest.raises(HTTPException) as exc_info:
+            await asyncio.wait_for(controller.acquire("interactive"), 1) # Sin esperar los 5 s
+        assert exc_info.value.status_code == 429
+        assert controller.stats()["classes"]["interactive"]["shed_estimated_wait"] == 1
+    asyncio.run(scenario())
+
+
+def test_full_queue_is_shed():
+    async def scenario():
+        controller = _controller(max_concurrent=1, max_queue=1)
+        await controller.acquire("interactive")
+        queued = asyncio.ensure_future(controller.acquire("interactive"))
+        await _settle()
+        with pytest.raises(HTTPException) as exc_info:
+            await controller.acquire("interactive")
+        assert exc_info.value.status_code == 429
+        queued.cancel()
+    asyncio.run(scenario())
+
+
+def test_first_waiter_is_queued_with_realistic_service_times():
+    async def scenario():
+        controller = _controller(max_concurrent=8, interactive_wait=5.0)
+        for _ in range(8):
+            await controller.acquire("interactive")
+        controller.release("interactive", 8.0) # Un flujo normal: 8 s de media
+        await controller.acquire("interactive")
+        # Con 8 slots ocupados en momentos escalonados se libera uno cada ~1 s: debe esperar, no 429
+        waiter = asyncio.ensure_future(controller.acquire("interactive"))
+        await _settle()
+        assert not waiter.done()
+        assert controller.stats()["queue_depth"] == 1
+        controller.release("interactive", 8.0)
+        await asyncio.wait_for(waiter, 1)
+        assert controller.stats()["classes"]["interactive"]["shed_estimated_wait"] == 0
+    asyncio.run(scenario())
+
+
+def test_retry_after_matches_the_estimated_wait():
+    async def scenario():
+        controller = _controller(max_concurrent=2, max_queue=20, interactive_wait=5.0)
+        await controller.acquire("interactive")
+        await controller.acquire("interactive")
+        controller.release("interactive", 4.0) # Se libera un slot cada ~2 s
+        await controller.acquire("interactive")
+        queued = [asyncio.ensure_future(controller.acquire("interactive")) for _ in range(2)] # Esperas de 2 s y 4 s
+        await _settle()
+        with pytest.raises(HTTPException) as exc_info:
+            await controller.acquire("interactive") # Tercero en la cola: 6 s > 5 s
+        assert "6s" in exc_info.value.detail
+        assert exc_info.value.headers["Retry-After"] == "6"
+        for waiter in queued:
+            waiter.cancel()
+    asyncio.run(scenario())
+
+
+class FakeConnection:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self) -> bool:
+        return self.disconnected
+
+
+def test_client_disconnecting_while_queued_gives_up_its_place(monkeypatch):
+    monkeypatch.setattr(cancellation, "DISCONNECT_POLL_INTERVAL_SECONDS", 0.01)
+
+    async def scenario():
+        controller = _controller(max_concurrent=1, batch_share=1.0, batch_wait=60.0)
+        await controller.acquire("batch")
+        connection = FakeConnection()
+        waiter = asyncio.ensure_future(controller.acquire("batch", connection, Deadline(30)))
+        await _settle()
+        connection.disconnected = True
+        with pytest.raises(InvocationCancelled) as exc_info:
+            await asyncio.wait_for(waiter, 1)
+        assert exc_info.value.reason == "client_disconnected"
+        assert controller.stats()["queue_depth"] == 0
+        controller.release("batch", 0.1)
+        assert controller.stats()["in_flight"] == 0 # El slot no se lo llevó quien ya se fue
+    asyncio.run(scenario())
+
+
+def test_queue_wait_is_bounded_by_the_invocation_deadline():
+    async def scenario():
+        controller = _controller(max_concurrent=1, batch_share=1.0, batch_wait=60.0)
+        await controller.acquire("batch")
+        with pytest.raises(InvocationCancelled) as exc_info:
+            await asyncio.wait_for(controller.acquire("batch", FakeConnection(), Deadline(0.05)), 1) # No 60 s
+        assert exc_info.value.reason == "deadline"
+        assert controller.stats()["queue_depth"] == 0
+        assert controller.stats()["classes"]["batch"]["cancelled_in_queue"] == 1
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+# backend/tests/test_idempotency.py
+# Qué resultados se guardan para una Idempotency-Key y cuáles se vuelven a ejecutar.
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from backend.services.admission import AdmissionController
+from backend.services.cancellation import InvocationCancelled
+from backend.services.idempotency import IdempotencyStore
+
+PAYLOAD = {"user_prompt": "hola"}
+
+
+class FakeRequest:
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+def _store() -> IdempotencyStore:
+    return IdempotencyStore(ttl_seconds=60, max_entries=100, db_tier=False)
+
+
+async def _run(store, execute):
+    return await store.run("agent_invoke", "clave-1", PAYLOAD, FakeRequest(), execute)
+
+
+def test_request_shed_by_admission_is_executed_again_on_retry():
+    async def scenario():
+        store = _store()
+        controller = AdmissionController(1, 10, 0.5, {"interactive": 0.05, "batch": 0.05})
+        executions = []
+
+        async def execute(connection):
+            async with controller.slot("interactive"):
+                executions.append(1)
+                return {"agent_response": "ok"}
+
+        await controller.acquire("interactive") # Servidor ocupado
+        with pytest.raises(HTTPException) as exc_info:
+            await _run(store, execute)
+        assert exc_info.value.status_code == 429
+        assert "Retry-After" in exc_info.value.headers
+
+        controller.release("interactive", 0.01) # Servidor libre: el reintento se ejecuta
+        response = await _run(store, execute)
+        assert response == {"agent_response": "ok"} and executions == [1]
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("reason", ["client_disconnected", "deadline"])
+def test_cancelled_invocation_is_executed_again_on_retry(reason):
+    async def scenario():
+        store = _store()
+        attempts = []
+
+        async def execute(connection):
+            attempts.append(1)
+            if len(attempts) == 1:
+                error = InvocationCancelled(reason)
+                raise HTTPException(status_code=error.status_code, detail="cancelada")
+            return {"agent_response": "ok"}
+
+        with pytest.raises(HTTPException):
+            await _run(store, execute)
+        assert await _run(store, execute) == {"agent_response": "ok"}
+        assert len(attempts) == 2
+    asyncio.run(scenario())
+
+
+def test_deterministic_client_errors_are_replayed():
+    async def scenario():
+        store = _store()
+        attempts = []
+
+        async def execute(connection):
+            attempts.append(1)
+            raise HTTPException(status_code=404, detail="Agente no encontrado.")
+
+        for _ in range(2):
+            with pytest.raises(HTTPException) as exc_info:
+                await _run(store, execute)
+            assert exc_info.value.status_code == 404
+        assert len(attempts) == 1
+    asyncio.run(scenario())
+
+
+def test_successful_result_is_replayed():
+    async def scenario():
+        store = _store()
+        attempts = []
+
+        async def execute(connection):
+            attempts.append(1)
+            return {"agent_response": "ok"}
+
+        await _run(store, execute)
+        replayed = await _run(store, execute)
+        assert replayed.headers["Idempotent-Replayed"] == "true" and len(attempts) == 1
+    asyncio.run(scenario())
@@ -0,0 +1,35 @@
+# backend/tests/test_init_db.py
+# Actualización de una BD creada antes de las columnas nuevas de agents/flows.
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from backend.db.database import Base
+from backend.db.init_db import upgrade_schema
+
+
+async def _upgrade_legacy_database(url: str):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE agents (id VARCHAR(36) PRIMARY KEY, name VARCHAR(100) NOT NULL, system_prompt TEXT NOT NULL, tools_enabled JSON)"))
+        await conn.execute(text("CREATE TABLE flows (id VARCHAR(36) PRIMARY KEY, name VARCHAR(150) NOT NULL, description TEXT, agent_ids JSON NOT NULL)"))
+        await conn.execute(text("INSERT INTO agents VALUES ('a1', 'agente', 'prompt de prueba', '[]')"))
+        await conn.execute(text("INSERT INTO flows VALUES ('f1', 'flujo', NULL, '[\"a1\"]')"))
+    for _ in range(2): # Debe poder repetirse sin cambios
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(upgrade_schema)
+    async with engine.connect() as conn:
+        agent = (await conn.execute(text("SELECT version, updated_at, max_tool_rounds FROM agents"))).one()
+        flow = (await conn.execute(text("SELECT version, updated_at, timeout_seconds FROM flows"))).one()
+        changes = (await conn.execute(text("SELECT id, entity, entity_id FROM change_log ORDER BY id"))).all()
+    await engine.dispose()
+    return agent, flow, changes
+
+
+def test_upgrade_adds_columns_and_backfills_versions(tmp_path):
+    agent, flow, changes = asyncio.run(_upgrade_legacy_database(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}"))
+    assert [(entity, entity_id) for _, entity, entity_id in changes] == [("agent", "a1"), ("flow", "f1")]
+    assert agent.version == changes[0].id and agent.updated_at is not None and agent.max_tool_rounds is None
+    assert flow.version == changes[1].id and flow.updated_at is not None and flow.timeout_seconds is None
@@ -0,0 +1,75 @@
+# backend/tests/test_llm_calls.py
+# _create_chat_completion: cancelación real de la llamada y reintentos dentro del plazo.
+import asyncio
+import types
+
+import httpx
+import openai
+import pytest
+
+from backend import main
+from backend.services import llm
+from backend.services.cancellation import Deadline
+
+
+class FakeCompletions:
+    def __init__(self, delay: float = 0.0, failures: int = 0):
+        self.delay = delay
+        self.failures = failures
+        self.calls = 0
+        self.cancelled = 0
+
+    async def create(self, timeout=None, **params):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        message = types.SimpleNamespace(content="ok", tool_calls=None)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None, model=params["model"])
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    def install(**kwargs):
+        fake = FakeCompletions(**kwargs)
+        monkeypatch.setattr(llm, "client", types.SimpleNamespace(api_key="test", chat=types.SimpleNamespace(completions=fake)))
+        return fake
+    return install
+
+
+def _call(deadline_seconds: float):
+    return main._create_chat_completion(Deadline(deadline_seconds), {"agent_id": "a", "flow_id": None}, model="gpt-3.5-turbo", messages=[])
+
+
+def test_cancelling_the_invocation_aborts_the_llm_request(completions):
+    fake = completions(delay=10)
+
+    async def scenario():
+        task = asyncio.ensure_future(_call(30))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(scenario())
+    assert fake.cancelled == 1
+
+
+def test_transient_errors_are_retried_within_the_deadline(completions, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 1)
+    monkeypatch.setattr(llm, "LLM_RETRY_MIN_REMAINING_SECONDS", 1)
+    fake = completions(failures=1)
+    result = asyncio.run(_call(30))
+    assert result.choices[0].message.content == "ok" and fake.calls == 2
+
+
+def test_no_retry_when_the_deadline_is_almost_over(completions, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 3)
+    monkeypatch.setattr(llm, "LLM_RETRY_MIN_REMAINING_SECONDS", 5)
+    fake = completions(failures=1)
+    with pytest.raises(openai.APIConnectionError):
+        asyncio.run(_call(2))
+    assert fake.calls == 1
@@ -0,0 +1,42 @@
+# backend/tests/test_on_commit.py
+# Las acciones registradas con on_commit (p. ej. invalidar la caché de configuración) solo corren al confirmarse.
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from backend.db.database import on_commit
+
+
+def _run(finish):
+    async def scenario():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        calls = []
+        async with AsyncSession(engine) as session:
+            await session.execute(text("CREATE TABLE t (id INTEGER)"))
+            await session.execute(text("INSERT INTO t VALUES (1)"))
+            on_commit(session, lambda: calls.append("invalidated"))
+            await session.flush()
+            before = list(calls)
+            await finish(session)
+            after_first = list(calls)
+            await session.execute(text("INSERT INTO t VALUES (2)")) # Nueva transacción: sin acciones pendientes
+            await session.commit()
+        await engine.dispose()
+        return before, after_first, calls
+
+    return asyncio.run(scenario())
+
+
+def test_callback_runs_after_commit_only_once():
+    before, after_commit, final = _run(lambda session: session.commit())
+    assert before == []
+    assert after_commit == ["invalidated"]
+    assert final == ["invalidated"]
+
+
+def test_callback_is_discarded_on_rollback():
+    before, after_rollback, final = _run(lambda session: session.rollback())
+    assert before == []
+    assert after_rollback == []
+    assert final == []
@@ -0,0 +1,49 @@
+# backend/tests/test_prompt_cache.py
+import pytest
+
+from backend.services.prompt_cache import PromptCache, build_scope, normalize_prompt
+
+SCOPE = build_scope("Eres un asistente.", "gpt-3.5-turbo", temperature=0.7)
+
+
+@pytest.fixture
+def cache():
+    cache = PromptCache(capacity=32, num_perm=64, ttl_seconds=0, shingle_size=4, audit_size=10)
+    if not cache.enabled:
+        pytest.skip("NumPy no disponible")
+    return cache
+
+
+def test_normalize_keeps_operators_and_decimals():
+    assert normalize_prompt("What is 2*2") != normalize_prompt("What is 2+2?")
+    assert normalize_prompt("x < 3") != normalize_prompt("x > 3")
+    assert normalize_prompt("Precio: 2.5 euros") != normalize_prompt("Precio: 25 euros")
+    assert normalize_prompt("  ¿Qué hora ES?  ") == normalize_prompt("qué hora es")
+
+
+def test_trivial_differences_are_exact_hits(cache):
+    cache.store(SCOPE, "¿Cuál es la capital de Francia?", "París")
+    assert cache.lookup(SCOPE, "cual es la capital de francia", 1.0, "a") is None # acentos distintos: no exacto
+    assert cache.lookup(SCOPE, "¿Cuál es la capital   de Francia", 1.0, "a") == "París"
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("What is 2+2?", "What is 2*2"),
+    ("What is 2+2?", "What is 2-2?"),
+    ("Is x < 10 for x = 4?", "Is x > 10 for x = 4?"),
+    ("Resume las ventas de 2023 por región", "Resume las ventas de 2024 por región"),
+    ("Convierte 2.5 km a millas", "Convierte 25 km a millas"),
+])
+def test_near_duplicates_with_different_literals_never_match(cache, stored, asked):
+    cache.store(SCOPE, stored, "respuesta cacheada")
+    assert cache.lookup(SCOPE, asked, 0.5, "a") is None
+
+
+def test_similar_prompt_with_same_literals_matches(cache):
+    cache.store(SCOPE, "Resume las ventas de 2023 por región, por favor", "resumen")
+    assert cache.lookup(SCOPE, "Resume las ventas de 2023 por región", 0.5, "a") == "resumen"
+
+
+def test_other_scope_never_matches(cache):
+    cache.store(SCOPE, "Hola", "respuesta")
+    assert cache.lookup(build_scope("Otro prompt", "gpt-3.5-turbo"), "Hola", 0.5, "a") is None
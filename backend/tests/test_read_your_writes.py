@@ -0,0 +1,83 @@
+# backend/tests/test_read_your_writes.py
+# El instante de la última escritura viaja con el cliente y decide si se lee del primario.
+import asyncio
+import time
+
+import pytest
+
+from backend.db import database
+from backend.db.database import LAST_WRITE_COOKIE, ReadYourWritesMiddleware, mark_client_write, should_read_from_primary
+
+
+@pytest.fixture
+def with_replica(monkeypatch):
+    monkeypatch.setattr(database, "replica_engine", object()) # Sin réplica siempre se lee del primario
+    monkeypatch.setattr(database, "DB_REPLICA_STICKY_SECONDS", 5.0)
+
+
+def _call(headers=(), write=False):
+    """Ejecuta una petición por el middleware; devuelve (cabeceras de la respuesta, ¿leyó del primario?)."""
+    seen = {}
+
+    async def app(scope, receive, send):
+        if write:
+            mark_client_write()
+        seen["primary"] = should_read_from_primary()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def scenario():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "headers": [(k.encode(), v.encode()) for k, v in headers]}
+        await ReadYourWritesMiddleware(app)(scope, None, send)
+        return {k.decode(): v.decode() for k, v in sent[0]["headers"]}
+
+    response_headers = asyncio.run(scenario())
+    return response_headers, seen["primary"]
+
+
+def test_client_without_recent_write_reads_from_replica(with_replica):
+    response_headers, primary = _call()
+    assert primary is False
+    assert "x-last-write" not in response_headers
+
+
+def test_write_returns_last_write_in_header_and_cookie(with_replica):
+    response_headers, primary = _call(write=True)
+    assert primary is True # Las lecturas posteriores de la misma petición van al primario
+    assert float(response_headers["x-last-write"]) == pytest.approx(time.time(), abs=2)
+    assert response_headers["set-cookie"].startswith(f"{LAST_WRITE_COOKIE}={response_headers['x-last-write']};")
+
+
+def test_echoed_header_or_cookie_routes_to_primary_while_sticky(with_replica):
+    response_headers, _ = _call(write=True)
+    last_write = response_headers["x-last-write"]
+
+    assert _call([("x-last-write", last_write)])[1] is True
+    assert _call([("cookie", f"otra=1; {LAST_WRITE_COOKIE}={last_write}")])[1] is True
+    # Una petición sin el valor (otro cliente, aunque comparta IP) sigue leyendo de la réplica
+    assert _call()[1] is False
+
+
+def test_old_or_invalid_last_write_reads_from_replica(with_replica):
+    assert _call([("x-last-write", f"{time.time() - 60:.3f}")])[1] is False
+    assert _call([("x-last-write", "no-es-un-numero")])[1] is False
+
+
+def test_crud_write_through_the_app_returns_last_write():
+    from fastapi.testclient import TestClient
+    from backend.main import app
+
+    with TestClient(app) as client:
+        response = client.post("/api/v1/agents", json={"name": "agente rw", "system_prompt": "prompt de prueba largo"})
+        assert response.status_code == 201
+        # El commit (y mark_client_write) ocurre antes de enviar la respuesta
+        assert float(response.headers["x-last-write"]) == pytest.approx(time.time(), abs=5)
+        assert client.cookies.get(LAST_WRITE_COOKIE) == response.headers["x-last-write"]
+
+        client.cookies.clear()
+        assert "x-last-write" not in client.get("/api/v1/agents").headers # Las lecturas no lo renuevan
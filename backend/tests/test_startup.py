@@ -0,0 +1,18 @@
+# backend/tests/test_startup.py
+# El arranque completo (lifespan) contra SQLite cabe en STARTUP_BUDGET_SECONDS y deja la app lista.
+from fastapi.testclient import TestClient
+
+from backend import settings
+from backend.main import app
+
+
+def test_startup_fits_budget_and_app_is_ready():
+    with TestClient(app) as client:
+        assert app.state.startup_seconds <= settings.STARTUP_BUDGET_SECONDS
+        assert app.state.startup_over_budget is False
+        assert {"create_all", "db_pool", "hot_configs"} <= set(app.state.startup_timings)
+
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert response.json()["checks"] == {"startup": True, "llm_client": True, "database": True}
+    assert app.state.ready is False # El apagado deja de aceptar tráfico
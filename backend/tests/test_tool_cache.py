@@ -0,0 +1,64 @@
+# backend/tests/test_tool_cache.py
+import asyncio
+import threading
+
+from backend.agent_tools.tool_cache import ToolResultCache
+
+POLICIES = {"slow_tool": {"mode": "pure"}}
+
+
+def _slow_tool(release: threading.Event, calls: list):
+    def tool(x):
+        calls.append(x)
+        release.wait(5)
+        return f"resultado {x}"
+    return tool
+
+
+def test_cancelling_the_first_caller_does_not_cancel_coalesced_callers():
+    async def scenario():
+        cache = ToolResultCache(POLICIES, 16)
+        release, calls = threading.Event(), []
+        tool = _slow_tool(release, calls)
+        leader = asyncio.ensure_future(cache.call("slow_tool", tool, {"x": 1}))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(cache.call("slow_tool", tool, {"x": 1}))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        assert await follower == "resultado 1"
+        assert leader.cancelled()
+        assert calls == [1] # Una sola ejecución, y su resultado queda cacheado
+        assert await cache.call("slow_tool", tool, {"x": 1}) == "resultado 1"
+        assert cache.stats()["tools"]["slow_tool"]["coalesced"] == 1
+    asyncio.run(scenario())
+
+
+def test_execution_is_abandoned_when_every_caller_is_cancelled():
+    async def scenario():
+        cache = ToolResultCache(POLICIES, 16)
+        release, calls = threading.Event(), []
+        tool = _slow_tool(release, calls)
+        callers = [asyncio.ensure_future(cache.call("slow_tool", tool, {"x": 2})) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.sleep(0.05)
+        assert cache.stats()["in_flight"] == 0
+        release.set()
+        # Sin resultado cacheado: una llamada nueva vuelve a ejecutar la herramienta
+        assert await cache.call("slow_tool", tool, {"x": 2}) == "resultado 2"
+        assert calls == [2, 2]
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    async def scenario():
+        cache = ToolResultCache(POLICIES, 16)
+        def failing(x):
+            raise ValueError("fallo")
+        results = await asyncio.gather(*(cache.call("slow_tool", failing, {"x": 3}) for _ in range(2)), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert cache.stats()["entries"] == 0
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+# backend/tests/test_ws_sessions.py
+# Límite de sesiones con conexiones simultáneas y fin de la sesión cuando falla el envío.
+import asyncio
+
+import pytest
+from starlette.websockets import WebSocketState
+
+from backend.services import ws_sessions
+from backend.services.ws_sessions import AgentSession, SessionClosed, SessionRegistry
+
+
+class FakeWebSocket:
+    def __init__(self, fail_sends=False):
+        self.fail_sends = fail_sends
+        self.client_state = WebSocketState.CONNECTED
+        self.sent = []
+
+    async def send_json(self, event):
+        if self.fail_sends:
+            raise RuntimeError("Cannot call \"send\" once a close message has been sent.")
+        self.sent.append(event)
+
+    async def close(self, code=1000, reason=""):
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+def _session(websocket):
+    return AgentSession(websocket, "a1", "agente", "prompt", [], None)
+
+
+def test_simultaneous_connections_cannot_exceed_the_limit():
+    async def scenario():
+        registry = SessionRegistry(max_sessions=2)
+        accepted = []
+
+        async def connect():
+            if not registry.reserve():
+                return
+            await asyncio.sleep(0.01) # Carga del agente (consulta a la BD)
+            session = _session(FakeWebSocket())
+            registry.register(session)
+            accepted.append(session)
+
+        await asyncio.gather(*(connect() for _ in range(5)))
+        assert len(accepted) == 2
+        assert registry.stats()["active_sessions"] == 2
+        assert registry.stats()["reserved_sessions"] == 0
+    asyncio.run(scenario())
+
+
+def test_released_reservation_frees_the_place():
+    registry = SessionRegistry(max_sessions=1)
+    assert registry.reserve()
+    assert not registry.reserve()
+    registry.release_reservation() # Agente inexistente: salida anticipada
+    assert registry.reserve()
+
+
+def test_failed_send_ends_the_session_instead_of_reporting_a_slow_consumer(monkeypatch):
+    monkeypatch.setattr(ws_sessions, "WS_SEND_TIMEOUT_SECONDS", 5.0)
+
+    async def scenario():
+        websocket = FakeWebSocket(fail_sends=True)
+        session = _session(websocket)
+        session.start()
+        session.emit({"type": "tool_call"})
+        await asyncio.sleep(0.01)
+        assert session.send_failed
+        assert websocket.client_state == WebSocketState.DISCONNECTED # También termina la recepción
+        with pytest.raises(SessionClosed):
+            await asyncio.wait_for(session.send({"type": "message"}), 1) # Sin esperar los 5 s
+        await session.close()
+    asyncio.run(scenario())
+
+
+def test_send_waiting_for_room_notices_the_failed_sender(monkeypatch):
+    monkeypatch.setattr(ws_sessions, "WS_SEND_QUEUE_MAX", 1)
+    monkeypatch.setattr(ws_sessions, "WS_SEND_TIMEOUT_SECONDS", 5.0)
+
+    async def scenario():
+        websocket = FakeWebSocket()
+        session = _session(websocket)
+        blocked = asyncio.Event()
+
+        async def stuck_send(event):
+            await blocked.wait()
+            raise RuntimeError("conexión perdida")
+
+        websocket.send_json = stuck_send
+        session.start()
+        session.emit({"type": "uno"}) # Lo toma el envío, que se queda colgado
+        await asyncio.sleep(0.01)
+        session.emit({"type": "dos"}) # Llena la cola
+        pending = asyncio.ensure_future(session.send({"type": "message"}))
+        await asyncio.sleep(0.01)
+        blocked.set()
+        with pytest.raises(SessionClosed):
+            await asyncio.wait_for(pending, 1)
+        await session.close()
+    asyncio.run(scenario())
@@ -1,10 +1,23 @@
 // frontend/src/App.js
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import './App.css';
 
 // URLs de la API
 const API_BASE_URL = 'http://127.0.0.1:8000/api/v1';
 
+// Instante de la última escritura que devolvió el backend (cabecera X-Last-Write).
+// Se reenvía en cada petición para que, tras escribir, las lecturas no vayan a una réplica atrasada.
+let lastWrite = null;
+
+async function apiFetch(path, options = {}) {
+  const headers = { ...(options.headers || {}) };
+  if (lastWrite) headers['X-Last-Write'] = lastWrite;
+  const response = await fetch(`${API_BASE_URL}${path}`, { ...options, headers });
+  const written = response.headers.get('X-Last-Write');
+  if (written) lastWrite = written;
+  return response;
+}
+
 function App() {
   // --- Estados para conexión raíz ---
   const [rootMessage, setRootMessage] = useState('');
@@ -84,36 +97,95 @@ function App() {
   const [isFlowInvoking, setIsFlowInvoking] = useState(false);
   const [flowInvokeError, setFlowInvokeError] = useState(null);
 
+  // Al abortar la petición el backend detecta la desconexión y cancela el trabajo pendiente
+  const agentInvokeAbortRef = useRef(null);
+  const flowInvokeAbortRef = useRef(null);
+
+  // --- Estados para el Chat en Vivo (sesión WebSocket con un agente) ---
+  const [chatAgentId, setChatAgentId] = useState('');
+  const [chatMessages, setChatMessages] = useState([]);
+  const [chatInput, setChatInput] = useState('');
+  const [isChatConnected, setIsChatConnected] = useState(false);
+  const [isChatWaiting, setIsChatWaiting] = useState(false);
+  const [chatError, setChatError] = useState(null);
+  const chatSocketRef = useRef(null);
+
+  // --- Sincronización incremental de agentes y flujos ---
+  // Carga inicial con /bootstrap y, tras cada cambio, solo las diferencias con /changes?since=<versión>
+  const syncVersionRef = useRef(0);
+
 
   useEffect(() => {
-    fetch('http://127.0.0.1:8000/')
-      .then(response => {
-        if (!response.ok) throw new Error(`Error HTTP raíz: ${response.status}`);
-        return response.json();
-      })
-      .then(data => setRootMessage(data.message))
-      .catch(err => setRootError(err.message))
-      .finally(() => setRootLoading(false));
-
-    fetchAgentsList();
-    fetchFlowsList();
-    fetchAvailableSystemTools();
+    loadBootstrap();
+    // Al volver a la pestaña, traer solo lo que otros hayan cambiado mientras tanto
+    const handleFocus = () => syncChanges();
+    window.addEventListener('focus', handleFocus);
+    return () => window.removeEventListener('focus', handleFocus);
   }, []);
 
-  const fetchAgentsList = async () => {
+  const loadBootstrap = async () => {
     setIsLoadingAgents(true);
+    setIsLoadingFlows(true);
+    setIsLoadingSystemTools(true);
     setLoadAgentsError(null);
+    setLoadFlowsError(null);
+    setLoadSystemToolsError(null);
     try {
-      const response = await fetch(`${API_BASE_URL}/agents`);
+      const response = await apiFetch('/bootstrap');
       if (!response.ok) throw new Error(`Error HTTP: ${response.status}`);
       const data = await response.json();
-      setAgentsList(data);
+      setRootMessage(data.message);
+      setAgentsList(data.agents);
+      setFlowsList(data.flows);
+      setAvailableSystemTools(data.tools.map(tool => tool.function));
+      syncVersionRef.current = data.version;
     } catch (err) {
-      console.error("Error al cargar agentes:", err);
+      console.error("Error en la carga inicial:", err);
+      setRootError(err.message);
       setLoadAgentsError(err.message);
-      setAgentsList([]);
+      setLoadFlowsError(err.message);
+      setLoadSystemToolsError(err.message);
     } finally {
+      setRootLoading(false);
       setIsLoadingAgents(false);
+      setIsLoadingFlows(false);
+      setIsLoadingSystemTools(false);
+    }
+  };
+
+  // Sustituye/añade los elementos recibidos (salvo que ya tengamos una versión más nueva) y quita los borrados
+  const mergeById = (list, upserted, deletedIds) => {
+    const byId = new Map(list.map(item => [item.id, item]));
+    upserted.forEach(item => {
+      const current = byId.get(item.id);
+      if (!current || (current.version ?? 0) <= (item.version ?? 0)) byId.set(item.id, item);
+    });
+    deletedIds.forEach(id => byId.delete(id));
+    return Array.from(byId.values());
+  };
+
+  const applyChanges = ({ agents = [], flows = [], deleted_agent_ids = [], deleted_flow_ids = [] }) => {
+    if (agents.length || deleted_agent_ids.length) setAgentsList(prev => mergeById(prev, agents, deleted_agent_ids));
+    if (flows.length || deleted_flow_ids.length) setFlowsList(prev => mergeById(prev, flows, deleted_flow_ids));
+  };
+
+  const syncChanges = async () => {
+    try {
+      let hasMore = true;
+      while (hasMore) {
+        const response = await apiFetch(`/changes?since=${syncVersionRef.current}`);
+        if (!response.ok) throw new Error(`Error HTTP: ${response.status}`);
+        const data = await response.json();
+        if (data.full_resync_required) {
+          await loadBootstrap();
+          return;
+        }
+        applyChanges(data);
+        syncVersionRef.current = data.version;
+        hasMore = data.has_more;
+      }
+    } catch (err) {
+      console.error("Error al sincronizar cambios:", err);
     }
   };
 
@@ -123,7 +195,7 @@ function App() {
     setCreateAgentError(null);
     setCreateAgentSuccess('');
     try {
-      const response = await fetch(`${API_BASE_URL}/agents`, {
+      const response = await apiFetch('/agents', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -141,7 +213,8 @@ function App() {
       setNewAgentName('');
       setNewAgentSystemPrompt('');
       setNewAgentEnabledTools([]);
-      fetchAgentsList();
+      applyChanges({ agents: [newAgent] });
+      syncChanges();
     } catch (err) {
       console.error("Error al crear agente:", err);
       setCreateAgentError(err.message);
@@ -180,7 +253,7 @@ function App() {
     };
 
     try {
-      const response = await fetch(`${API_BASE_URL}/agents/${editingAgent.id}`, {
+      const response = await apiFetch(`/agents/${editingAgent.id}`, {
         method: 'PUT', // o 'PATCH' si tu backend lo soporta para actualizaciones parciales
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(agentDataToUpdate),
@@ -191,7 +264,8 @@ function App() {
       }
       const updatedAgent = await response.json();
       setUpdateAgentSuccess(`¡Agente "${updatedAgent.name}" actualizado!`);
-      fetchAgentsList();
+      applyChanges({ agents: [updatedAgent] });
+      syncChanges();
       handleCloseEditAgentModal();
     } catch (err) {
       console.error("Error al actualizar agente:", err);
@@ -207,7 +281,7 @@ function App() {
       setDeleteAgentError(null);
       setDeleteAgentSuccess('');
       try {
-        const response = await fetch(`${API_BASE_URL}/agents/${agentId}`, { method: 'DELETE' });
+        const response = await apiFetch(`/agents/${agentId}`, { method: 'DELETE' });
         if (!response.ok) {
           // Si la respuesta no es 204 No Content, intenta parsear el error
           if (response.status !== 204) {
@@ -216,7 +290,8 @@ function App() {
           }
         }
         setDeleteAgentSuccess(`Agente "${agentName}" eliminado.`);
-        fetchAgentsList();
+        applyChanges({ deleted_agent_ids: [agentId] });
+        syncChanges(); // Trae también los flujos de los que se ha quitado el agente
          if (selectedAgentIdForInvoke === agentId) { // Deseleccionar si era el agente invocado
             setSelectedAgentIdForInvoke('');
         }
@@ -238,23 +313,6 @@ function App() {
   };
 
 
-  const fetchAvailableSystemTools = async () => {
-    setIsLoadingSystemTools(true);
-    setLoadSystemToolsError(null);
-    try {
-      const response = await fetch(`${API_BASE_URL}/tools/available`);
-      if (!response.ok) throw new Error(`Error HTTP: ${response.status}`);
-      const data = await response.json();
-      setAvailableSystemTools(data.map(tool => tool.function));
-    } catch (err) {
-      console.error("Error al cargar herramientas del sistema:", err);
-      setLoadSystemToolsError(err.message);
-      setAvailableSystemTools([]);
-    } finally {
-      setIsLoadingSystemTools(false);
-    }
-  };
-
   const handleInvokeAgent = async (event) => {
     event.preventDefault();
     setIsAgentInvoking(true);
@@ -280,11 +338,13 @@ function App() {
         return;
     }
 
+    agentInvokeAbortRef.current = new AbortController();
     try {
-      const response = await fetch(`${API_BASE_URL}/agent/invoke`, {
+      const response = await apiFetch('/agent/invoke', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(requestBody),
+        signal: agentInvokeAbortRef.current.signal,
       });
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({ detail: `Error HTTP: ${response.status}` }));
@@ -294,30 +354,18 @@ function App() {
       setAgentInvokeResponse(data.agent_response);
       setUsedSystemPromptInAgentResponse(data.used_system_prompt);
     } catch (err) {
-      console.error("Error al invocar al agente:", err);
-      setAgentInvokeError(err.message);
+      if (err.name === 'AbortError') {
+        setAgentInvokeError("Invocación cancelada.");
+      } else {
+        console.error("Error al invocar al agente:", err);
+        setAgentInvokeError(err.message);
+      }
     } finally {
+      agentInvokeAbortRef.current = null;
       setIsAgentInvoking(false);
     }
   };
 
-  const fetchFlowsList = async () => {
-    setIsLoadingFlows(true);
-    setLoadFlowsError(null);
-    try {
-      const response = await fetch(`${API_BASE_URL}/flows`);
-      if (!response.ok) throw new Error(`Error HTTP: ${response.status}`);
-      const data = await response.json();
-      setFlowsList(data);
-    } catch (err) {
-      console.error("Error al cargar flujos:", err);
-      setLoadFlowsError(err.message);
-      setFlowsList([]);
-    } finally {
-      setIsLoadingFlows(false);
-    }
-  };
-
   const handleCreateFlow = async (event) => {
     event.preventDefault();
     setIsCreatingFlow(true);
@@ -330,7 +378,7 @@ function App() {
         return;
     }
     try {
-      const response = await fetch(`${API_BASE_URL}/flows`, {
+      const response = await apiFetch('/flows', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -348,7 +396,8 @@ function App() {
       setNewFlowName('');
       setNewFlowDescription('');
       setNewFlowAgentIds('');
-      fetchFlowsList();
+      applyChanges({ flows: [newFlow] });
+      syncChanges();
     } catch (err) {
       console.error("Error al crear flujo:", err);
       setCreateFlowError(err.message);
@@ -394,7 +443,7 @@ function App() {
     };
 
     try {
-      const response = await fetch(`${API_BASE_URL}/flows/${editingFlow.id}`, {
+      const response = await apiFetch(`/flows/${editingFlow.id}`, {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(flowDataToUpdate),
@@ -405,7 +454,8 @@ function App() {
       }
       const updatedFlow = await response.json();
       setUpdateFlowSuccess(`¡Flujo "${updatedFlow.name}" actualizado!`);
-      fetchFlowsList();
+      applyChanges({ flows: [updatedFlow] });
+      syncChanges();
       handleCloseEditFlowModal();
     } catch (err) {
       console.error("Error al actualizar flujo:", err);
@@ -421,7 +471,7 @@ function App() {
       setDeleteFlowError(null);
       setDeleteFlowSuccess('');
       try {
-        const response = await fetch(`${API_BASE_URL}/flows/${flowId}`, { method: 'DELETE' });
+        const response = await apiFetch(`/flows/${flowId}`, { method: 'DELETE' });
         if (!response.ok) {
             if (response.status !== 204) {
                  const errorData = await response.json().catch(() => ({ detail: `Error HTTP: ${response.status}` }));
@@ -429,7 +479,8 @@ function App() {
             }
         }
         setDeleteFlowSuccess(`Flujo "${flowName}" eliminado.`);
-        fetchFlowsList();
+        applyChanges({ deleted_flow_ids: [flowId] });
+        syncChanges();
         if (selectedFlowIdForInvoke === flowId) {
             setSelectedFlowIdForInvoke('');
         }
@@ -456,11 +507,13 @@ function App() {
     setIsFlowInvoking(true);
     setFlowInvokeResponse(null);
     setFlowInvokeError(null);
+    flowInvokeAbortRef.current = new AbortController();
     try {
-      const response = await fetch(`${API_BASE_URL}/flows/${selectedFlowIdForInvoke}/invoke`, {
+      const response = await apiFetch(`/flows/${selectedFlowIdForInvoke}/invoke`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ initial_user_prompt: initialUserPromptForFlow }),
+        body: JSON.stringify({ initial_user_prompt: initialUserPromptForFlow, verbosity: 'full' }),
+        signal: flowInvokeAbortRef.current.signal,
       });
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({ detail: `Error HTTP: ${response.status}` }));
@@ -469,13 +522,69 @@ function App() {
       const data = await response.json();
       setFlowInvokeResponse(data);
     } catch (err) {
-      console.error("Error al invocar flujo:", err);
-      setFlowInvokeError(err.message);
+      if (err.name === 'AbortError') {
+        setFlowInvokeError("Invocación del flujo cancelada.");
+      } else {
+        console.error("Error al invocar flujo:", err);
+        setFlowInvokeError(err.message);
+      }
     } finally {
+      flowInvokeAbortRef.current = null;
       setIsFlowInvoking(false);
     }
   };
 
+  // --- Chat en Vivo: una conexión WebSocket por sesión; el backend guarda el historial ---
+  const handleChatConnect = () => {
+    if (!chatAgentId) {
+      setChatError("Por favor, selecciona un agente para chatear.");
+      return;
+    }
+    setChatError(null);
+    setChatMessages([]);
+    const socket = new WebSocket(`${API_BASE_URL.replace(/^http/, 'ws')}/agents/${chatAgentId}/session`);
+    socket.onopen = () => setIsChatConnected(true);
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'message') {
+        setChatMessages(prev => [...prev, { role: 'assistant', content: data.content }]);
+        setIsChatWaiting(false);
+      } else if (data.type === 'tool_call') {
+        setChatMessages(prev => [...prev, { role: 'tool', content: `Usando herramienta ${data.name}...` }]);
+      } else if (data.type === 'turn_cancelled') {
+        setChatMessages(prev => [...prev, { role: 'tool', content: `Turno cancelado (${data.reason}).` }]);
+        setIsChatWaiting(false);
+      } else if (data.type === 'error') {
+        setChatError(data.detail);
+        setIsChatWaiting(false);
+      }
+    };
+    socket.onclose = (event) => {
+      setIsChatConnected(false);
+      setIsChatWaiting(false);
+      if (event.code !== 1000 || event.reason) setChatError(event.reason || `Conexión cerrada (código ${event.code}).`);
+      chatSocketRef.current = null;
+    };
+    chatSocketRef.current = socket;
+  };
+
+  const handleChatDisconnect = () => {
+    if (chatSocketRef.current) chatSocketRef.current.close();
+  };
+
+  const handleChatSend = (event) => {
+    event.preventDefault();
+    if (!chatInput.trim() || !chatSocketRef.current) return;
+    setChatError(null);
+    setChatMessages(prev => [...prev, { role: 'user', content: chatInput }]);
+    chatSocketRef.current.send(JSON.stringify({ type: 'message', content: chatInput }));
+    setChatInput('');
+    setIsChatWaiting(true);
+  };
+
+  // Cerrar la sesión si el componente se desmonta
+  useEffect(() => () => { if (chatSocketRef.current) chatSocketRef.current.close(); }, []);
+
   if (rootLoading) {
     return <div className="App-header"><h1>Cargando conexión con el backend...</h1></div>;
   }
@@ -633,7 +742,12 @@ function App() {
                 </div>
                 <button type="submit" disabled={isAgentInvoking}>{isAgentInvoking ? 'Enviando...' : 'Invocar Agente'}</button>
                 </form>
-                {isAgentInvoking && <p className="loading-message">Esperando respuesta del agente...</p>}
+                {isAgentInvoking && (
+                  <p className="loading-message">
+                    Esperando respuesta del agente...{' '}
+                    <button type="button" onClick={() => agentInvokeAbortRef.current && agentInvokeAbortRef.current.abort()}>Cancelar</button>
+                  </p>
+                )}
                 {agentInvokeResponse && (
                 <div className="agent-response-container">
                     <h3>Respuesta del Agente Individual:</h3>
@@ -675,7 +789,12 @@ function App() {
                         {isFlowInvoking ? 'Invocando Flujo...' : 'Invocar Flujo'}
                     </button>
                 </form>
-                {isFlowInvoking && <p className="loading-message">Ejecutando flujo...</p>}
+                {isFlowInvoking && (
+                  <p className="loading-message">
+                    Ejecutando flujo...{' '}
+                    <button type="button" onClick={() => flowInvokeAbortRef.current && flowInvokeAbortRef.current.abort()}>Cancelar</button>
+                  </p>
+                )}
                 {flowInvokeResponse && (
                     <div className="flow-response-container">
                         <h3>Resultado del Flujo: "{flowInvokeResponse.flow_name}"</h3>
@@ -683,12 +802,13 @@ function App() {
                         <pre className="agent-response-text">{flowInvokeResponse.final_output}</pre>
                         <h4>Log de Ejecución:</h4>
                         <div className="flow-log">
-                            {flowInvokeResponse.log.map((step, index) => (
+                            {(flowInvokeResponse.log || []).map((step, index) => (
                                 <details key={index} className="flow-log-step">
                                     <summary>Paso {index + 1}: Agente "{step.agent_name}" (ID: {step.agent_id.substring(0,8)}...)</summary>
                                     <div className="log-step-content">
-                                        <p><strong>System Prompt:</strong></p><pre className="system-prompt-display small-text">{step.system_prompt_used}</pre>
-                                        <p><strong>Entrada:</strong></p><pre className="prompt-display small-text">{step.input_prompt}</pre>
+                                        {/* Los system prompts llegan una sola vez por agente y la entrada de cada paso es la salida del anterior */}
+                                        <p><strong>System Prompt:</strong></p><pre className="system-prompt-display small-text">{(flowInvokeResponse.system_prompts || {})[step.agent_id]}</pre>
+                                        <p><strong>Entrada:</strong></p><pre className="prompt-display small-text">{index === 0 ? step.input_prompt : flowInvokeResponse.log[index - 1].output_response}</pre>
                                         <p><strong>Salida:</strong></p><pre className="prompt-display small-text">{step.output_response}</pre>
                                     </div>
                                 </details>
@@ -697,6 +817,42 @@ function App() {
                     </div>
                 )}
             </section>
+
+            {/* Chat en Vivo con un Agente (WebSocket) */}
+            <section className="card">
+                <h2>Chat en Vivo con Agente</h2>
+                {chatError && <p className="error-message">{chatError}</p>}
+                <div className="form-group">
+                    <label htmlFor="chatAgentId">Agente:</label>
+                    <select id="chatAgentId" value={chatAgentId} onChange={(e) => setChatAgentId(e.target.value)} disabled={isChatConnected || agentsList.length === 0}>
+                        <option value="">-- Selecciona un Agente --</option>
+                        {agentsList.map(agent => (<option key={`chat-${agent.id}`} value={agent.id}>{agent.name}</option>))}
+                    </select>
+                </div>
+                {isChatConnected
+                    ? <button type="button" onClick={handleChatDisconnect}>Terminar Sesión</button>
+                    : <button type="button" onClick={handleChatConnect} disabled={!chatAgentId}>Iniciar Sesión</button>}
+                {chatMessages.length > 0 && (
+                    <div className="flow-log">
+                        {chatMessages.map((message, index) => (
+                            <pre key={index} className={message.role === 'user' ? 'prompt-display small-text' : 'agent-response-text'}>
+                                {message.role === 'user' ? 'Tú: ' : message.role === 'tool' ? '' : 'Agente: '}{message.content}
+                            </pre>
+                        ))}
+                    </div>
+                )}
+                {isChatConnected && (
+                    <form onSubmit={handleChatSend} className="agent-form">
+                        <div className="form-group">
+                            <textarea value={chatInput} onChange={(e) => setChatInput(e.target.value)} rows="2" placeholder="Escribe un mensaje..." />
+                        </div>
+                        <button type="submit" disabled={isChatWaiting || !chatInput.trim()}>{isChatWaiting ? 'Esperando...' : 'Enviar'}</button>
+                        {isChatWaiting && (
+                            <button type="button" onClick={() => chatSocketRef.current && chatSocketRef.current.send(JSON.stringify({ type: 'cancel' }))}>Cancelar</button>
+                        )}
+                    </form>
+                )}
+            </section>
         </div>
       </div>
 